@@ -0,0 +1,30 @@
+"""add matches json gin indexes
+
+Revision ID: 3e8d5b7a1c62
+Revises: 7c2f4e1d9a30
+Create Date: 2026-10-17 14:03:27.512390
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e8d5b7a1c62'
+down_revision = '7c2f4e1d9a30'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    print("Upgrading {}".format(engine_name))
+    op.create_index('ix_gs_matches_match_statistics_jsonb', 'gs_matches',
+                    [sa.text('(match_statistics::jsonb)')], postgresql_using='gin')
+    op.create_index('ix_gs_matches_details_jsonb', 'gs_matches',
+                    [sa.text('(details::jsonb)')], postgresql_using='gin')
+
+
+def downgrade(engine_name):
+    print("Downgrading {}".format(engine_name))
+    op.drop_index('ix_gs_matches_details_jsonb')
+    op.drop_index('ix_gs_matches_match_statistics_jsonb')
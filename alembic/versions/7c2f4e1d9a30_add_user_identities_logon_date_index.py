@@ -0,0 +1,25 @@
+"""add user identities logon date index
+
+Revision ID: 7c2f4e1d9a30
+Revises: 58c1b2a9640f
+Create Date: 2026-10-17 10:12:41.318204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c2f4e1d9a30'
+down_revision = '58c1b2a9640f'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+def upgrade(engine_name):
+    print("Upgrading {}".format(engine_name))
+    op.create_index('ix_ck_user_identities_logon_date', 'ck_user_identities', ['logon_date'])
+
+
+def downgrade(engine_name):
+    print("Downgrading {}".format(engine_name))
+    op.drop_index('ix_ck_user_identities_logon_date')
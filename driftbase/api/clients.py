@@ -24,6 +24,10 @@ from driftbase.richpresence import RichPresenceService
 from drift.core.extensions.jwt import current_user, issue_token
 from drift.core.extensions.urlregistry import Endpoints
 from drift.utils import json_response
+from driftbase.clients import (
+    client_heartbeat_filter, get_client_heartbeat, get_client_heartbeats, record_client_heartbeat,
+    redis_heartbeats_enabled
+)
 from driftbase.config import get_client_heartbeat_config
 from driftbase.models.db import (
     User, CorePlayer, Client, UserIdentity
@@ -128,11 +132,13 @@ class ClientsAPI(MethodView):
         """
         _, heartbeat_timeout = get_client_heartbeat_config()
         min_heartbeat_time = utcnow() - datetime.timedelta(seconds=heartbeat_timeout)
-        query = g.db.query(Client).filter(Client.heartbeat >= min_heartbeat_time)
+        query = g.db.query(Client).filter(client_heartbeat_filter(min_heartbeat_time))
         if args.get("player_id"):
             query = query.filter(Client.player_id == args["player_id"])
         rows = query.all()
-        return rows
+        # The filter allows for heartbeats not yet flushed to the db, so check the selected clients exactly
+        heartbeats = get_client_heartbeats(rows)
+        return [row for row in rows if heartbeats[row.client_id] >= min_heartbeat_time]
 
     @bp.arguments(ClientPostRequestSchema)
     @bp.response(http_client.CREATED, ClientPostResponseSchema)
@@ -297,28 +303,34 @@ class ClientAPI(MethodView):
         now = utcnow()
         heartbeat_period, heartbeat_timeout = get_client_heartbeat_config()
 
-        last_heartbeat = client.heartbeat
+        use_redis = redis_heartbeats_enabled()
+        last_heartbeat = get_client_heartbeat(client) if use_redis else client.heartbeat
         if last_heartbeat + datetime.timedelta(seconds=heartbeat_timeout) < now:
             msg = "Heartbeat timeout. Last heartbeat was at {} and now we are at {}" \
                 .format(last_heartbeat, now)
             log.info(msg)
             abort(http_client.NOT_FOUND, message=msg)
 
-        client.heartbeat = now
-        client.num_heartbeats += 1
-        g.db.commit()
+        if use_redis:
+            # The row is left alone, the heartbeat is written to the db in bulk later
+            num_heartbeats = client.num_heartbeats + record_client_heartbeat(client_id, now)
+        else:
+            client.heartbeat = now
+            client.num_heartbeats += 1
+            g.db.commit()
+            num_heartbeats = client.num_heartbeats
         ret = {
-            "num_heartbeats": client.num_heartbeats,
+            "num_heartbeats": num_heartbeats,
             "last_heartbeat": last_heartbeat,
-            "this_heartbeat": client.heartbeat,
-            "next_heartbeat": client.heartbeat + datetime.timedelta(seconds=heartbeat_period),
+            "this_heartbeat": now,
+            "next_heartbeat": now + datetime.timedelta(seconds=heartbeat_period),
             "next_heartbeat_seconds": heartbeat_period,
             "heartbeat_timeout": utcnow() + datetime.timedelta(seconds=heartbeat_timeout),
             "heartbeat_timeout_seconds": heartbeat_timeout,
         }
 
         log.debug("player %s has updated heartbeat for client %s. Heartbeat count is %s",
-                  current_user["player_id"], client_id, client.num_heartbeats)
+                  current_user["player_id"], client_id, num_heartbeats)
 
         return ret
 
@@ -1,7 +1,9 @@
-import gzip
+import functools
 import http.client as http_client
 import json
 import logging
+import re
+import zlib
 from collections import defaultdict
 from json import JSONDecodeError
 import fnmatch
@@ -32,6 +34,33 @@ def drift_init_extension(app, **kwargs):
 
 default_eventlog_config = dict(eventlog=dict(max_batch_size=5, shoutout_block_list=[]))
 
+# Compressed uploads are decompressed incrementally and rejected once they exceed this size
+MAX_DECOMPRESSED_SIZE = 32 * 1024 * 1024
+DECOMPRESS_CHUNK_SIZE = 64 * 1024
+
+
+def _read_compressed_events():
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # gzip header and trailer
+    data = bytearray()
+    try:
+        while True:
+            chunk = request.stream.read(DECOMPRESS_CHUNK_SIZE)
+            if not chunk:
+                break
+            data += decompressor.decompress(chunk, MAX_DECOMPRESSED_SIZE + 1 - len(data))
+            if len(data) > MAX_DECOMPRESSED_SIZE or decompressor.unconsumed_tail:
+                abort(http_client.REQUEST_ENTITY_TOO_LARGE, "decompressed event data is too large")
+        data += decompressor.flush()
+        return json.loads(data)
+    except (zlib.error, JSONDecodeError, UnicodeDecodeError) as e:
+        log.info(f"failed to decode compressed event data: {e}")
+        abort(http_client.BAD_REQUEST, "failed to decode compressed event data")
+
+
+@functools.lru_cache(maxsize=32)
+def _compile_block_list(block_list):
+    return re.compile("|".join(fnmatch.translate(pattern) for pattern in block_list))
+
 
 def _get_shoutout():
     return current_app.extensions["shoutout"]
@@ -58,12 +87,7 @@ class EventsAPI(MethodView):
         required_keys = ["event_name", "timestamp"]
 
         if request.headers.get('Content-Encoding', '') == 'gzip':
-            try:
-                data = gzip.decompress(request.data)
-                events = json.loads(data)
-            except JSONDecodeError as e:
-                log.info(f"failed to decode compressed event data: {e.msg}")
-                abort(http_client.BAD_REQUEST, "failed to decode compressed event data")
+            events = _read_compressed_events()
         else:
             events = request.json
 
@@ -75,17 +99,22 @@ class EventsAPI(MethodView):
         player_id = current_user.get("player_id", "")
         is_service = "service" in current_user["roles"] or "game_service" in current_user["roles"]
 
+        batch_records = get_feature_switch('enable_eventlog_batch_records')
         for event in events:
             if is_service:
                 event.setdefault("player_id", player_id)
             else:
                 event["player_id"] = player_id  # Always override!
-            eventlogger.info("eventlog", extra={"extra": event})
-        
+            if not batch_records:
+                eventlogger.info("eventlog", extra={"extra": event})
+        if batch_records:
+            eventlogger.info("eventlog_batch", extra={"extra": {"events": events}})
+
         if get_feature_switch('enable_eventlog_shoutout_forwarding') and is_service:
             events_to_shoutout = defaultdict(list)
             shoutout_block_list = get_tenant_config_value('eventlog', 'shoutout_block_list',
                                                        defaults=default_eventlog_config)
+            blocked_events = _compile_block_list(tuple(shoutout_block_list)) if shoutout_block_list else None
             
             for event in events:
                 event_name = event.get("event_name")
@@ -94,11 +123,7 @@ class EventsAPI(MethodView):
                 if event_name and event_name.startswith("drift."):
                     continue
                 
-                if (
-                    event_name
-                    and shoutout_block_list
-                    and any(fnmatch.fnmatch(event_name, blocked_event) for blocked_event in shoutout_block_list)
-                ):
+                if event_name and blocked_events and blocked_events.match(event_name):
                     continue
                 
                 events_to_shoutout[event.get('player_id')].append(event)
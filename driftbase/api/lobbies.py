@@ -4,7 +4,7 @@ Custom game lobbies for private/direct matches
 
 from drift.blueprint import Blueprint
 from drift.core.extensions.urlregistry import Endpoints
-from marshmallow import Schema, fields
+from marshmallow import Schema, fields, validate
 from flask.views import MethodView
 from drift.blueprint import abort
 from flask import url_for
@@ -48,6 +48,7 @@ class LobbyResponseSchema(Schema):
     status = fields.String(metadata=dict(description="The current status of the lobby."))
     members = fields.List(fields.Nested(LobbyMemberResponseSchema), metadata=dict(description="The lobby members."))
     custom_data = fields.String(allow_none=True, metadata=dict(description="Optional custom data for the lobby. Will be forwarded to the match server"))
+    public = fields.Bool(metadata=dict(description="Whether the lobby is listed in the public lobbies."))
 
     connection_string = fields.String(allow_none=True, metadata=dict(description="The IP and port of the lobby match if it has started."))
     connection_options = fields.String(allow_none=True, metadata=dict(description="Connection options for the requesting player"))
@@ -67,6 +68,7 @@ class LobbiesAPI(MethodView):
         lobby_name = fields.String(required=False, metadata=dict(description="Optional initial name of the lobby."))
         map_name = fields.String(required=False, metadata=dict(description="Optional initial map name for the lobby."))
         custom_data = fields.String(required=False, metadata=dict(description="Optional custom data for the lobby. Will be forwarded to the match server"))
+        public = fields.Bool(required=False, load_default=False, metadata=dict(description="Whether the lobby should be listed in the public lobbies."))
 
     @bp.response(http_client.OK, LobbyResponseSchema)
     def get(self):
@@ -102,6 +104,7 @@ class LobbiesAPI(MethodView):
                 args.get("lobby_name"),
                 args.get("map_name"),
                 args.get("custom_data"),
+                args.get("public"),
             )
 
             return _add_lobby_urls(lobby)
@@ -111,6 +114,41 @@ class LobbiesAPI(MethodView):
             abort(http_client.CONFLICT, message=e.msg)
 
 
+class PublicLobbyResponseSchema(Schema):
+    lobby_id = fields.String(metadata=dict(description="The id for the lobby."))
+    lobby_name = fields.String(metadata=dict(description="The name of the lobby."))
+    map_name = fields.String(allow_none=True, metadata=dict(description="The map name for the lobby."))
+    team_capacity = fields.Integer(metadata=dict(description="How many members can be in one team."))
+    team_names = fields.List(fields.String(), metadata=dict(description="The unique names of the teams."))
+    create_date = fields.String(metadata=dict(description="The UTC timestamp of when the lobby was created."))
+    num_members = fields.Integer(metadata=dict(description="How many members are in the lobby."))
+    free_slots = fields.Integer(metadata=dict(description="How many more members the teams have room for."))
+
+    lobby_members_url = fields.Url(metadata=dict(description="URL for joining the lobby."))
+
+
+@bp.route("/public", endpoint="public-lobbies")
+class PublicLobbiesAPI(MethodView):
+    class PublicLobbiesRequestSchema(Schema):
+        map_name = fields.String(required=False, metadata=dict(description="Only return lobbies for this map."))
+        lobby_name = fields.String(required=False, metadata=dict(description="Only return lobbies whose name contains this, ignoring case."))
+        min_free_slots = fields.Integer(required=False, load_default=1, validate=validate.Range(min=0), metadata=dict(description="Only return lobbies with at least this many free slots."))
+        offset = fields.Integer(required=False, load_default=0, validate=validate.Range(min=0), metadata=dict(description="How many matching lobbies to skip."))
+        limit = fields.Integer(required=False, load_default=20, validate=validate.Range(min=1, max=lobbies.MAX_PUBLIC_LOBBIES_PAGE_SIZE), metadata=dict(description="How many lobbies to return."))
+
+    @bp.arguments(PublicLobbiesRequestSchema, location="query")
+    @bp.response(http_client.OK, PublicLobbyResponseSchema(many=True))
+    def get(self, args):
+        """
+        Browse public lobbies which haven't started their match, with the most free slots first.
+        """
+        public_lobbies = lobbies.get_public_lobbies(args.get("map_name"), args.get("lobby_name"),
+                                                    args["min_free_slots"], args["offset"], args["limit"])
+        for lobby in public_lobbies:
+            lobby["lobby_members_url"] = url_for("lobbies.members", lobby_id=lobby["lobby_id"], _external=True)
+        return public_lobbies
+
+
 @bp.route("/<string:lobby_id>", endpoint="lobby")
 class LobbyAPI(MethodView):
     class UpdateLobbyRequestSchema(Schema):
@@ -119,6 +157,7 @@ class LobbyAPI(MethodView):
         lobby_name = fields.String(required=False, metadata=dict(description="Optional initial name of the lobby."))
         map_name = fields.String(required=False, metadata=dict(description="Optional initial map name for the lobby."))
         custom_data = fields.String(required=False, metadata=dict(description="Optional custom data for the lobby. Will be forwarded to the match server"))
+        public = fields.Bool(required=False, metadata=dict(description="Whether the lobby should be listed in the public lobbies."))
 
     @bp.response(http_client.OK, LobbyResponseSchema)
     def get(self, lobby_id: str):
@@ -154,6 +193,7 @@ class LobbyAPI(MethodView):
                 args.get("lobby_name"),
                 args.get("map_name"),
                 args.get("custom_data"),
+                args.get("public"),
             )
         except NotFoundException as e:
             abort(http_client.NOT_FOUND, message=e.msg)
@@ -258,6 +298,7 @@ class LobbyMemberAPI(MethodView):
 def endpoint_info(*args):
     ret = {
         "lobbies": url_for("lobbies.lobbies", _external=True),
+        "public_lobbies": url_for("lobbies.public-lobbies", _external=True),
     }
 
     # Lobby members template
@@ -13,6 +13,7 @@ from marshmallow.decorators import validates_schema
 from drift.core.extensions.jwt import requires_roles
 from drift.core.extensions.urlregistry import Endpoints
 from driftbase.config import get_machine_heartbeat_config
+from driftbase.heartbeats import get_machine_heartbeat, record_machine_heartbeat, redis_heartbeats_enabled
 from driftbase.models.db import Machine, MachineEvent
 
 log = logging.getLogger(__name__)
@@ -221,14 +222,18 @@ class MachineAPI(MethodView):
 
         now = utcnow()
         heartbeat_period, heartbeat_timeout = get_machine_heartbeat_config()
-        last_heartbeat = row.heartbeat_date
+        use_redis = redis_heartbeats_enabled()
+        last_heartbeat = get_machine_heartbeat(row) if use_redis else row.heartbeat_date
         if last_heartbeat + datetime.timedelta(seconds=heartbeat_timeout) < now:
             msg = "Heartbeat timeout. Last heartbeat was at {} and now we are at {}" \
                 .format(last_heartbeat, now)
             log.info(msg)
             abort(http_client.NOT_FOUND, message=msg)
 
-        row.heartbeat_date = now
+        if use_redis:
+            record_machine_heartbeat(machine_id, now)
+        else:
+            row.heartbeat_date = now
         if args.get("status"):
             row.status = args["status"]
         if args.get("details"):
@@ -240,19 +245,21 @@ class MachineAPI(MethodView):
         if args.get("group_name"):
             row.group_name = args["group_name"]
         if args.get("events"):
-            for event in args["events"]:
-                timestamp = parser.parse(event["timestamp"])
-                event_row = MachineEvent(event_type_name=event["event"],
-                                         machine_id=machine_id,
-                                         details=event,
-                                         create_date=timestamp)
-                g.db.add(event_row)
-
-        g.db.commit()
+            g.db.bulk_insert_mappings(MachineEvent, [
+                dict(event_type_name=event["event"],
+                     machine_id=machine_id,
+                     details=event,
+                     create_date=parser.parse(event["timestamp"]))
+                for event in args["events"]
+            ])
+
+        # A plain heartbeat recorded in redis leaves nothing to write
+        if not use_redis or g.db.dirty or args.get("events"):
+            g.db.commit()
         return {
             "last_heartbeat": last_heartbeat,
-            "this_heartbeat": row.heartbeat_date,
-            "next_heartbeat": row.heartbeat_date + datetime.timedelta(seconds=heartbeat_period),
+            "this_heartbeat": now,
+            "next_heartbeat": now + datetime.timedelta(seconds=heartbeat_period),
             "next_heartbeat_seconds": heartbeat_period,
             "heartbeat_timeout": now + datetime.timedelta(seconds=heartbeat_timeout),
             "heartbeat_timeout_seconds": heartbeat_timeout,
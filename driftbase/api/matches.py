@@ -1,4 +1,6 @@
+import collections
 import datetime
+import hashlib
 import http.client as http_client
 import logging
 import marshmallow as ma
@@ -11,9 +13,11 @@ from driftbase.richpresence import RichPresenceService
 
 from drift.core.extensions.jwt import current_user, requires_roles
 from drift.core.extensions.urlregistry import Endpoints
-from sqlalchemy import func, cast, Integer, case, and_
+from sqlalchemy import func, cast, Integer, case, and_, exists
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.engine import Row
 
+from driftbase.heartbeats import get_server_heartbeats, server_heartbeat_filter
 from driftbase.matchqueue import process_match_queue
 from driftbase.models.db import Machine, Server, Match, MatchTeam, MatchPlayer, MatchQueuePlayer, CorePlayer
 from driftbase.utils import log_match_event
@@ -27,6 +31,7 @@ bp = Blueprint("matches", __name__, url_prefix="/matches")
 endpoints = Endpoints()
 
 MATCH_HEARTBEAT_TIMEOUT_SECONDS = 60
+ACTIVE_MATCHES_CACHE_TTL = 2
 
 
 def drift_init_extension(app, **kwargs):
@@ -61,93 +66,124 @@ class ActiveMatchesAPI(MethodView):
         This endpoint used by clients to fetch a list of matches available
         for joining
         """
-        num_rows = args["rows"] or DEFAULT_ROWS
-
-        query = g.db.query(Match, Server, Machine)
-        query = query.filter(Server.machine_id == Machine.machine_id,
-                             Match.server_id == Server.server_id,
-                             Match.status.notin_(["ended", "completed"]),
-                             Server.status.in_(["started", "running", "active", "ready"]),
-                             Server.heartbeat_date >= utcnow() - datetime.timedelta(
-                                 seconds=MATCH_HEARTBEAT_TIMEOUT_SECONDS)
-                             )
-        if args.get("ref"):
-            query = query.filter(Server.ref == args.get("ref"))
-        if args.get("version"):
-            query = query.filter(Server.version == args.get("version"))
-        if args.get("placement"):
-            query = query.filter(Machine.placement == args.get("placement"))
-        if args.get("realm"):
-            query = query.filter(Machine.realm == args.get("realm"))
-        if args.get("match_id"):
-            query = query.filter(Match.match_id.in_(args.get("match_id")))
-        player_ids = args["player_id"]
-
-        query = query.order_by(-Match.num_players, -Match.server_id)
-        query = query.limit(num_rows)
-        rows = query.all()
+        # Players all poll this with the same arguments, so they share a short-lived cached copy of the list.
+        # Services get fresh results.
+        if "service" in current_user["roles"]:
+            matches = _get_active_matches(args)
+        else:
+            cache_key = "matches:active:" + hashlib.sha1(
+                json.dumps(args, sort_keys=True).encode()).hexdigest()
+            cached = g.redis.get(cache_key)
+            if cached:
+                matches = json.loads(cached)
+                for match in matches:
+                    for field in ("create_date", "heartbeat_date"):
+                        if match[field]:
+                            match[field] = datetime.datetime.fromisoformat(match[field])
+            else:
+                matches = _get_active_matches(args)
+                g.redis.set(cache_key, json.dumps(matches, default=_json_serial), expire=ACTIVE_MATCHES_CACHE_TTL)
 
         ret = []
-        for row in rows:
-            include = True
-            if player_ids:
-                include = False
-
-            match = row[0]
-            server = row[1]
-            machine = row[2]
-            record = {}
-            record["create_date"] = match.create_date
-            record["game_mode"] = match.game_mode
-            record["map_name"] = match.map_name
-            record["max_players"] = match.max_players
-            record["match_status"] = match.status
-            record["server_status"] = server.status
-            record["public_ip"] = server.public_ip
-            record["port"] = server.port
-            record["version"] = server.version
-            record["match_id"] = match.match_id
-            record["server_id"] = match.server_id
-            record["machine_id"] = server.machine_id
-            record["heartbeat_date"] = server.heartbeat_date
-            record["realm"] = machine.realm
-            record["placement"] = machine.placement
-            record["ref"] = server.ref
+        for match in matches:
+            record = {k: v for k, v in match.items() if k != "token"}
             record["match_url"] = url_for("matches.entry",
-                                          match_id=match.match_id,
+                                          match_id=match["match_id"],
                                           _external=True)
             record["server_url"] = url_for("servers.entry",
-                                           server_id=server.server_id,
+                                           server_id=match["server_id"],
                                            _external=True)
             record["machine_url"] = url_for("machines.entry",
-                                            machine_id=server.machine_id,
+                                            machine_id=match["machine_id"],
                                             _external=True)
             conn_url = "%s:%s?player_id=%s?token=%s"
-            record["ue4_connection_url"] = conn_url % (server.public_ip,
-                                                       server.port,
+            record["ue4_connection_url"] = conn_url % (match["public_ip"],
+                                                       match["port"],
                                                        current_user["player_id"],
-                                                       server.token)
-            player_array = []
-            players = g.db.query(MatchPlayer) \
-                .filter(MatchPlayer.match_id == match.match_id,
-                        MatchPlayer.status.in_(["active"])) \
-                .all()
-            for player in players:
-                player_array.append({
-                    "player_id": player.player_id,
-                    "player_url": url_player(player.player_id),
-                })
-                if player.player_id in player_ids:
-                    include = True
-            record["players"] = player_array
-            record["num_players"] = len(player_array)
-
-            if include:
-                ret.append(record)
+                                                       match["token"])
+            record["players"] = [{
+                "player_id": player_id,
+                "player_url": url_player(player_id),
+            } for player_id in match["players"]]
+            ret.append(record)
 
         return jsonify(ret)
 
 
+def _get_active_matches(args):
+    num_rows = args["rows"] or DEFAULT_ROWS
+
+    query = g.db.query(Match, Server, Machine)
+    query = query.filter(Server.machine_id == Machine.machine_id,
+                         Match.server_id == Server.server_id,
+                         Match.status.notin_(["ended", "completed"]),
+                         Server.status.in_(["started", "running", "active", "ready"]),
+                         server_heartbeat_filter(utcnow() - datetime.timedelta(
+                             seconds=MATCH_HEARTBEAT_TIMEOUT_SECONDS))
+                         )
+    if args.get("ref"):
+        query = query.filter(Server.ref == args.get("ref"))
+    if args.get("version"):
+        query = query.filter(Server.version == args.get("version"))
+    if args.get("placement"):
+        query = query.filter(Machine.placement == args.get("placement"))
+    if args.get("realm"):
+        query = query.filter(Machine.realm == args.get("realm"))
+    if args.get("match_id"):
+        query = query.filter(Match.match_id.in_(args.get("match_id")))
+    if args["player_id"]:
+        # Only include matches where any of the players are active
+        query = query.filter(exists().where(and_(MatchPlayer.match_id == Match.match_id,
+                                                 MatchPlayer.status == "active",
+                                                 MatchPlayer.player_id.in_(args["player_id"]))))
+
+    query = query.order_by(-Match.num_players, -Match.server_id)
+    query = query.limit(num_rows)
+    rows = query.all()
+
+    heartbeats = get_server_heartbeats([server for _, server, _ in rows])
+    players_by_match = collections.defaultdict(list)
+    if rows:
+        players = g.db.query(MatchPlayer.match_id, MatchPlayer.player_id) \
+            .filter(MatchPlayer.match_id.in_([match.match_id for match, _, _ in rows]),
+                    MatchPlayer.status.in_(["active"])) \
+            .order_by(MatchPlayer.id)
+        for match_id, player_id in players:
+            players_by_match[match_id].append(player_id)
+
+    ret = []
+    for match, server, machine in rows:
+        players = players_by_match[match.match_id]
+        ret.append({
+            "create_date": match.create_date,
+            "game_mode": match.game_mode,
+            "map_name": match.map_name,
+            "max_players": match.max_players,
+            "match_status": match.status,
+            "server_status": server.status,
+            "public_ip": server.public_ip,
+            "port": server.port,
+            "version": server.version,
+            "match_id": match.match_id,
+            "server_id": match.server_id,
+            "machine_id": server.machine_id,
+            "heartbeat_date": heartbeats[server.server_id],
+            "realm": machine.realm,
+            "placement": machine.placement,
+            "ref": server.ref,
+            "token": server.token,
+            "players": players,
+            "num_players": len(players),
+        })
+    return ret
+
+
+def _json_serial(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f"Type {type(obj)} not serializable")
+
+
 def unique_key_in_use(unique_key):
     if unique_key:
         query = g.db.query(Match, Server)
@@ -155,8 +191,8 @@ def unique_key_in_use(unique_key):
                                              Match.status.notin_(["ended", "completed"]),
                                              Match.unique_key == unique_key,
                                              Server.status.in_(["started", "running", "active", "ready"]),
-                                             Server.heartbeat_date >= utcnow() - datetime.timedelta(
-                                                 seconds=MATCH_HEARTBEAT_TIMEOUT_SECONDS)
+                                             server_heartbeat_filter(utcnow() - datetime.timedelta(
+                                                 seconds=MATCH_HEARTBEAT_TIMEOUT_SECONDS))
                                              ).first()
         return existing_unique_match is not None
     return False
@@ -167,6 +203,210 @@ def lock(redis):
     return redis.lock("ensure_match_unique_key")
 
 
+def _make_matches_query(args, is_service):
+    player_id = args.get("player_id")
+    server_id = args.get("server_id")
+    game_mode = args.get("game_mode")
+    map_name = args.get("map_name")
+    statistics_filter = args.get("statistics_filter")
+    details_filter = args.get("details_filter")
+    start_date = args.get("start_date")
+
+    if statistics_filter:
+        try:
+            statistics_filter = json.loads(statistics_filter)
+        except json.JSONDecodeError:
+            abort(http_client.BAD_REQUEST, description="Invalid statistics_filter")
+
+    if details_filter:
+        try:
+            details_filter = json.loads(details_filter)
+        except json.JSONDecodeError:
+            abort(http_client.BAD_REQUEST, description="Invalid details_filter")
+
+    if is_service:
+        matches_query = g.db.query(Match)
+    else:
+        matches_query = g.db.query(
+            Match.match_id,
+            Match.start_date,
+            Match.end_date,
+            Match.max_players,
+            Match.game_mode,
+            Match.map_name,
+            Match.details,
+            Match.match_statistics,
+            Match.create_date,
+        )
+
+    if player_id:
+        matches_query = matches_query.join(
+            MatchPlayer, and_(Match.match_id == MatchPlayer.match_id,
+                              MatchPlayer.player_id == player_id)
+        )
+        matches_query = matches_query.join(
+            MatchTeam, and_(MatchPlayer.team_id == MatchTeam.team_id,
+                            MatchTeam.match_id == Match.match_id)
+        )
+        is_winner = case(
+            [(cast(Match.match_statistics['winning_team_id'].astext, Integer) == MatchTeam.team_id, True)],
+            else_=False
+        ).label("is_winner")
+        matches_query = matches_query.add_columns(is_winner)
+
+    if server_id:
+        matches_query = matches_query.filter(Match.server_id == server_id)
+
+    if game_mode:
+        matches_query = matches_query.filter(Match.game_mode == game_mode)
+
+    if map_name:
+        matches_query = matches_query.filter(Match.map_name == map_name)
+
+    # Containment can use the GIN indexes on the JSON columns, but unlike comparing the values as text it doesn't
+    # match f.ex. "1" with 1, so it's only used by the keyset pagination to not change the meaning of existing queries
+    if statistics_filter:
+        if args["keyset_pagination"]:
+            matches_query = matches_query.filter(cast(Match.match_statistics, JSONB).contains(statistics_filter))
+        else:
+            for key, value in statistics_filter.items():
+                matches_query = matches_query.filter(Match.match_statistics[key].astext == value)
+
+    if details_filter:
+        if args["keyset_pagination"]:
+            matches_query = matches_query.filter(cast(Match.details, JSONB).contains(details_filter))
+        else:
+            for key, value in details_filter.items():
+                matches_query = matches_query.filter(Match.details[key].astext == value)
+
+    if start_date:
+        matches_query = matches_query.filter(func.date(Match.start_date) == start_date)
+
+    return matches_query
+
+
+def _get_matches_keyset_page(matches_query, args, is_service, max_per_page):
+    per_page = min(max(args["per_page"], 1), max_per_page)
+    ret = {"per_page": per_page}
+    if args["include_total"]:
+        ret["total"] = matches_query.order_by(None).count()
+
+    before_match_id = args.get("before_match_id")
+    if before_match_id:
+        matches_query = matches_query.filter(Match.match_id < before_match_id)
+    # Fetch one more to know whether there's a next page
+    rows = matches_query.order_by(-Match.match_id).limit(per_page + 1).all()
+    items = _make_match_records(rows[:per_page], args["include_match_players"], is_service)
+    ret["items"] = items
+    ret["next_before_match_id"] = items[-1]["match_id"] if len(rows) > per_page else None
+    return ret
+
+
+def _make_match_records(match_rows, include_match_players, is_service):
+    matches = []
+    for match_row in match_rows:
+        if isinstance(match_row, Row):
+            if hasattr(match_row, 'Match'):
+                match_record = match_row.Match.as_dict()
+                if hasattr(match_row, 'is_winner'):
+                    match_record["is_winner"] = match_row.is_winner
+            else:
+                match_record = match_row._asdict()
+        elif isinstance(match_row, Match):
+            match_record = match_row.as_dict()
+        else:
+            # pre SQLAlchemy 1.4 this would happen
+            match_record = match_row._asdict()
+
+        match_id = match_record["match_id"]
+
+        match_record["url"] = url_for("matches.entry", match_id=match_id, _external=True)
+        match_record["matchplayers_url"] = url_for("matches.players", match_id=match_id, _external=True)
+        match_record["teams_url"] = url_for("matches.teams", match_id=match_id, _external=True)
+        matches.append(match_record)
+
+    if include_match_players and matches:
+        match_ids = [match_record["match_id"] for match_record in matches]
+        players_by_match_id = _get_match_player_records(match_ids, is_service)
+        teams_by_match_id = _get_match_team_records(match_ids, is_service)
+        for match_record in matches:
+            match_players = players_by_match_id[match_record["match_id"]]
+            match_record["players"] = match_players
+            match_record["num_players"] = len(match_players)
+            match_record["teams"] = teams_by_match_id[match_record["match_id"]]
+
+    return matches
+
+
+def _get_match_player_records(match_ids, is_service):
+    """ Return {match_id: [player record]} with the players of all the matches, loaded in one query. """
+    if is_service:
+        players_query = g.db.query(MatchPlayer, CorePlayer.player_name)
+    else:
+        players_query = g.db.query(
+            MatchPlayer.id,
+            MatchPlayer.match_id,
+            MatchPlayer.player_id,
+            MatchPlayer.team_id,
+            MatchPlayer.join_date,
+            MatchPlayer.leave_date,
+            MatchPlayer.statistics,
+            MatchPlayer.details,
+            MatchPlayer.create_date,
+            CorePlayer.player_name
+        )
+
+    players_query = players_query.join(CorePlayer, MatchPlayer.player_id == CorePlayer.player_id, isouter=True) \
+        .filter(MatchPlayer.match_id.in_(match_ids)) \
+        .order_by(MatchPlayer.match_id, MatchPlayer.player_id)
+
+    players_by_match_id = collections.defaultdict(list)
+    for player_row in players_query.all():
+        if is_service:
+            [match_player, player_name] = player_row
+            player_record = match_player.as_dict()
+            player_record["player_name"] = player_name or ""
+        else:
+            player_record = player_row._asdict()
+            player_record["player_name"] = player_record["player_name"] or ""
+
+        match_id = player_record["match_id"]
+        player_id = player_record["player_id"]
+        player_record["player_url"] = url_for("players.entry", player_id=player_id, _external=True)
+        player_record["matchplayer_url"] = url_for("matches.player", match_id=match_id, player_id=player_id, _external=True)
+        players_by_match_id[match_id].append(player_record)
+    return players_by_match_id
+
+
+def _get_match_team_records(match_ids, is_service):
+    """ Return {match_id: [team record]} with the teams of all the matches, loaded in one query. """
+    if is_service:
+        teams_query = g.db.query(MatchTeam)
+    else:
+        teams_query = g.db.query(
+            MatchTeam.team_id,
+            MatchTeam.match_id,
+            MatchTeam.name,
+            MatchTeam.statistics,
+            MatchTeam.details,
+            MatchTeam.create_date,
+        )
+
+    teams_query = teams_query.filter(MatchTeam.match_id.in_(match_ids)).order_by(MatchTeam.team_id)
+
+    teams_by_match_id = collections.defaultdict(list)
+    for team_row in teams_query.all():
+        if is_service:
+            team_record = team_row.as_dict()
+        else:
+            team_record = team_row._asdict()
+
+        match_id = team_record["match_id"]
+        team_record["url"] = url_for("matches.team", match_id=match_id, team_id=team_record["team_id"], _external=True)
+        teams_by_match_id[match_id].append(team_record)
+    return teams_by_match_id
+
+
 class MatchPutRequestSchema(ma.Schema):
     status = ma.fields.String(required=True)
 
@@ -198,6 +438,13 @@ class MatchesAPI(MethodView):
         statistics_filter = ma.fields.String()
         details_filter = ma.fields.String()
         start_date = ma.fields.Date()
+        keyset_pagination = ma.fields.Boolean(load_default=False, metadata=dict(
+            description="Page through the matches with 'before_match_id' instead of page numbers. The JSON filters "
+                        "match by containment, so their values must have the same type as in the match."))
+        before_match_id = ma.fields.Integer(metadata=dict(
+            description="Return matches older than this one, taken from 'next_before_match_id' of the previous page"))
+        include_total = ma.fields.Boolean(load_default=False, metadata=dict(
+            description="Count the total number of matches when using 'keyset_pagination'"))
 
     @bp.arguments(MatchesAPIGetQuerySchema, location='query')
     def get(self, args):
@@ -213,178 +460,15 @@ class MatchesAPI(MethodView):
         server_id = args.get("server_id")
 
         # To prevent API breakage, use a separate implementation for pagination and make it opt-in.
-        if args["use_pagination"]:
-            player_id = args.get("player_id")
-            game_mode = args.get("game_mode")
-            map_name = args.get("map_name")
-            statistics_filter = args.get("statistics_filter")
-            details_filter = args.get("details_filter")
-            start_date = args.get("start_date")
-
-            if statistics_filter:
-                try:
-                    statistics_filter = json.loads(statistics_filter)
-                except json.JSONDecodeError:
-                    abort(http_client.BAD_REQUEST, description="Invalid statistics_filter")
-
-            if details_filter:
-                try:
-                    details_filter = json.loads(details_filter)
-                except json.JSONDecodeError:
-                    abort(http_client.BAD_REQUEST, description="Invalid details_filter")
-
-            if is_service:
-                matches_query = g.db.query(Match)
-            else:
-                matches_query = g.db.query(
-                    Match.match_id,
-                    Match.start_date,
-                    Match.end_date,
-                    Match.max_players,
-                    Match.game_mode,
-                    Match.map_name,
-                    Match.details,
-                    Match.match_statistics,
-                    Match.create_date,
-                )
-
-            if player_id:
-                matches_query = matches_query.join(
-                    MatchPlayer, and_(Match.match_id == MatchPlayer.match_id,
-                                      MatchPlayer.player_id == player_id)
-                )
-                matches_query = matches_query.join(
-                    MatchTeam, and_(MatchPlayer.team_id == MatchTeam.team_id,
-                                    MatchTeam.match_id == Match.match_id)
-                )
-                is_winner = case(
-                    [(cast(Match.match_statistics['winning_team_id'].astext, Integer) == MatchTeam.team_id, True)],
-                    else_=False
-                ).label("is_winner")
-                matches_query = matches_query.add_columns(is_winner)
-
-            if server_id:
-                matches_query = matches_query.filter(Match.server_id == server_id)
-
-            if game_mode:
-                matches_query = matches_query.filter(Match.game_mode == game_mode)
-
-            if map_name:
-                matches_query = matches_query.filter(Match.map_name == map_name)
-
-            if statistics_filter:
-                for key, value in statistics_filter.items():
-                    matches_query = matches_query.filter(Match.match_statistics[key].astext == value)
-
-            if details_filter:
-                for key, value in details_filter.items():
-                    matches_query = matches_query.filter(Match.details[key].astext == value)
-
-            if start_date:
-                matches_query = matches_query.filter(func.date(Match.start_date) == start_date)
+        if args["use_pagination"] or args["keyset_pagination"]:
+            matches_query = _make_matches_query(args, is_service)
+            if args["keyset_pagination"]:
+                return jsonify(_get_matches_keyset_page(matches_query, args, is_service, num_rows))
 
             matches_query = matches_query.order_by(-Match.match_id)
-
             matches_result = matches_query.paginate(page=args["page"], per_page=args["per_page"], error_out=True, max_per_page=num_rows)
-
-            include_match_players = args["include_match_players"]
-
-            matches = []
-            for match_row in matches_result.items:
-                if isinstance(match_row, Row):
-                    if hasattr(match_row, 'Match'):
-                        match_record = match_row.Match.as_dict()
-                        if hasattr(match_row, 'is_winner'):
-                            match_record["is_winner"] = match_row.is_winner
-                    else:
-                        match_record = match_row._asdict()
-                elif isinstance(match_row, Match):
-                    match_record = match_row.as_dict()
-                else:
-                    # pre SQLAlchemy 1.4 this would happen
-                    match_record = match_row._asdict()
-
-                match_id = match_record["match_id"]
-
-                match_record["url"] = url_for("matches.entry", match_id=match_id, _external=True)
-                match_record["matchplayers_url"] = url_for("matches.players", match_id=match_id, _external=True)
-                match_record["teams_url"] = url_for("matches.teams", match_id=match_id, _external=True)
-
-                if include_match_players:
-                    # Fetch the match players
-                    if is_service:
-                        players_query = g.db.query(MatchPlayer, CorePlayer.player_name)
-                    else:
-                        players_query = g.db.query(
-                            MatchPlayer.id,
-                            MatchPlayer.match_id,
-                            MatchPlayer.player_id,
-                            MatchPlayer.team_id,
-                            MatchPlayer.join_date,
-                            MatchPlayer.leave_date,
-                            MatchPlayer.statistics,
-                            MatchPlayer.details,
-                            MatchPlayer.create_date,
-                            CorePlayer.player_name
-                        )
-
-                    players_query = players_query.join(CorePlayer, MatchPlayer.player_id == CorePlayer.player_id, isouter=True) \
-                        .filter(MatchPlayer.match_id == match_id) \
-                        .order_by(MatchPlayer.player_id)
-
-                    players_result = players_query.all()
-
-                    match_players = []
-                    for player_row in players_result:
-                        if is_service:
-                            [match_player, player_name] = player_row
-                            player_record = match_player.as_dict()
-                            player_record["player_name"] = player_name or ""
-                        else:
-                            player_record = player_row._asdict()
-                            player_record["player_name"] = player_record["player_name"] or ""
-
-                        player_id = player_record["player_id"]
-                        player_record["player_url"] = url_for("players.entry", player_id=player_id, _external=True)
-                        player_record["matchplayer_url"] = url_for("matches.player", match_id=match_id, player_id=player_id, _external=True)
-                        match_players.append(player_record)
-
-                    match_record["players"] = match_players
-                    match_record["num_players"] = len(match_players)
-
-                    # Fetch the teams
-                    if is_service:
-                        teams_query = g.db.query(MatchTeam)
-                    else:
-                        teams_query = g.db.query(
-                            MatchTeam.team_id,
-                            MatchTeam.match_id,
-                            MatchTeam.name,
-                            MatchTeam.statistics,
-                            MatchTeam.details,
-                            MatchTeam.create_date,
-                        )
-
-                    teams_query = teams_query.filter(MatchTeam.match_id == match_id)
-
-                    teams_result = teams_query.all()
-
-                    match_teams = []
-                    for team_row in teams_result:
-                        if is_service:
-                            team_record = team_row.as_dict()
-                        else:
-                            team_record = team_row._asdict()
-
-                        team_record["url"] = url_for("matches.team", match_id=match_id, team_id=team_record["team_id"], _external=True)
-                        match_teams.append(team_record)
-
-                    match_record["teams"] = match_teams
-
-                matches.append(match_record)
-
             ret = {
-                "items": matches,
+                "items": _make_match_records(matches_result.items, args["include_match_players"], is_service),
                 "total": matches_result.total,
                 "page": matches_result.page,
                 "pages": matches_result.pages,
@@ -34,7 +34,7 @@ from marshmallow import Schema, fields, validate
 from flask.views import MethodView
 from flask import url_for, request, current_app
 from drift.core.extensions.jwt import current_user
-from driftbase import flexmatch
+from driftbase import eventqueue, flexmatch
 from datetime import timedelta
 import http.client as http_client
 import logging
@@ -49,9 +49,15 @@ def drift_init_extension(app, **kwargs):
     app.messagebus.register_consumer(flexmatch.handle_party_event, "parties")
     app.messagebus.register_consumer(flexmatch.handle_client_event, "client")
     app.messagebus.register_consumer(flexmatch.handle_match_event, "match")
+    eventqueue.register_handler("flexmatch", flexmatch.process_flexmatch_event)
+    eventqueue.register_handler("gamelift_queue", _publish_queue_event)
     endpoints.init_app(app)
 
 
+def _publish_queue_event(event):
+    current_app.extensions["messagebus"].publish_message("gamelift_queue", event)
+
+
 @bp.route("/regions/", endpoint="regions")
 class FlexMatchPlayerAPI(MethodView):
     class FlexMatchRegionsSchema(Schema):
@@ -256,7 +262,10 @@ class FlexMatchEventAPI(MethodView):
 
     @requires_roles("flexmatch_event")
     def put(self):
-        flexmatch.process_flexmatch_event(request.json)
+        if eventqueue.async_events_enabled():
+            eventqueue.enqueue_event("flexmatch", request.json)
+        else:
+            flexmatch.process_flexmatch_event(request.json)
         return {}, http_client.OK
 
 
@@ -269,7 +278,10 @@ class FlexMatchQueueEventAPI(MethodView):
         # TODO: Have publish message consumer do the try/except in Drift lib
         log.info(f"Queue event: {request.json}")
         try:
-            current_app.extensions["messagebus"].publish_message("gamelift_queue", request.json)
+            if eventqueue.async_events_enabled():
+                eventqueue.enqueue_event("gamelift_queue", request.json)
+            else:
+                _publish_queue_event(request.json)
         except Exception as e:
             log.error(f"Error processing queue event: {e}")
 
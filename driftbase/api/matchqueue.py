@@ -13,6 +13,7 @@ from drift.blueprint import Blueprint, abort
 from drift.core.extensions.jwt import current_user
 from drift.core.extensions.urlregistry import Endpoints
 from drift.utils import json_response
+from driftbase.clients import client_heartbeat_filter
 from driftbase.matchqueue import process_match_queue
 from driftbase.models.db import CorePlayer, MatchQueuePlayer, Match, Client, Server
 from driftbase.utils import url_player
@@ -165,8 +166,8 @@ class MatchQueueAPI(MethodView):
             .filter(CorePlayer.player_id == MatchQueuePlayer.player_id,
                     MatchQueuePlayer.status.in_(statuses),
                     Client.client_id == MatchQueuePlayer.client_id,
-                    Client.heartbeat >= datetime.datetime.utcnow() -
-                    datetime.timedelta(seconds=30)) \
+                    client_heartbeat_filter(datetime.datetime.utcnow() -
+                                            datetime.timedelta(seconds=30))) \
             .all()
         ret = []
         for player in matchqueue_players:
@@ -5,13 +5,12 @@
 import copy
 
 import datetime
-import gevent
 import http.client as http_client
 import json
 import logging
 import marshmallow as ma
 import operator
-from flask import url_for, stream_with_context, Response, jsonify
+from flask import request, url_for, stream_with_context, Response, jsonify
 from flask.views import MethodView
 from drift.blueprint import Blueprint, abort
 
@@ -24,6 +23,13 @@ log = logging.getLogger(__name__)
 bp = Blueprint("messages", "messages", url_prefix="/messages")
 endpoints = Endpoints()
 
+# How often to write whitespace to an idle long poll connection
+LONG_POLL_KEEPALIVE_SECONDS = 1.0
+# How often to write a comment to an idle event stream
+STREAM_KEEPALIVE_SECONDS = 15.0
+# Upper bound on how long a single event stream is kept open before the client has to reconnect
+MAX_STREAM_SECONDS = 60 * 60
+
 
 def drift_init_extension(app, **kwargs):
     app.register_blueprint(bp)
@@ -90,29 +96,36 @@ class MessagesExchangeAPI(MethodView):
 
             def streamer():
                 yield " "
-                while 1:
-                    try:
-                        streamer_messages = driftbase.messages.fetch_messages(exchange, exchange_id, messages_after,
-                                                                              rows)
-                        if streamer_messages:
-                            log.debug("[%s/%s] Returning messages after %.1f seconds",
-                                      my_player_id, exchange_full_name,
-                                      (utcnow() - start_time).total_seconds())
-                            yield json.dumps(_patch_messages(streamer_messages), default=driftbase.messages.json_serial)
-                            return
-                        elif utcnow() > poll_timeout:
-                            log.debug("[%s/%s] Poll timeout with no messages after %.1f seconds",
-                                      my_player_id, exchange_full_name,
-                                      (utcnow() - start_time).total_seconds())
-                            yield json.dumps({})
-                            return
-                        # sleep for 100ms
-                        gevent.sleep(0.1)
-                        yield " "
-                    except Exception as e:
-                        log.error("[%s/%s] Exception %s", my_player_id, exchange_full_name, repr(e))
-                        yield json.dumps({})
-                        return
+                try:
+                    with driftbase.messages.wait_for_messages(exchange, exchange_id) as new_messages:
+                        notified = True
+                        while 1:
+                            remaining = (poll_timeout - utcnow()).total_seconds()
+                            # Only check for messages when notified of one, and once more before giving up
+                            if notified or remaining <= 0:
+                                new_messages.clear()
+                                streamer_messages = driftbase.messages.fetch_messages(exchange, exchange_id,
+                                                                                      messages_after, rows)
+                                if streamer_messages:
+                                    log.debug("[%s/%s] Returning messages after %.1f seconds",
+                                              my_player_id, exchange_full_name,
+                                              (utcnow() - start_time).total_seconds())
+                                    yield json.dumps(_patch_messages(streamer_messages),
+                                                     default=driftbase.messages.json_serial)
+                                    return
+                            if remaining <= 0:
+                                log.debug("[%s/%s] Poll timeout with no messages after %.1f seconds",
+                                          my_player_id, exchange_full_name,
+                                          (utcnow() - start_time).total_seconds())
+                                yield json.dumps({})
+                                return
+                            # Block until a message is posted to the exchange, keeping the connection alive
+                            notified = new_messages.wait(min(remaining, LONG_POLL_KEEPALIVE_SECONDS))
+                            yield " "
+                except Exception as e:
+                    log.error("[%s/%s] Exception %s", my_player_id, exchange_full_name, repr(e))
+                    yield json.dumps({})
+                    return
 
             return Response(stream_with_context(streamer()), mimetype="application/json")
         else:
@@ -120,6 +133,73 @@ class MessagesExchangeAPI(MethodView):
             return jsonify(_patch_messages(messages))
 
 
+class MessagesExchangeStreamQuerySchema(ma.Schema):
+    messages_after = ma.fields.Integer(load_default=0)
+    timeout = ma.fields.Integer(load_default=MAX_STREAM_SECONDS,
+                                validate=ma.validate.Range(min=1, max=MAX_STREAM_SECONDS))
+
+
+def _format_event(message):
+    data = json.dumps(message, default=driftbase.messages.json_serial)
+    return f"id: {message['message_id']}\nevent: message\ndata: {data}\n\n"
+
+
+@bp.route('/<string:exchange>/<int:exchange_id>/stream', endpoint='stream')
+class MessagesExchangeStreamAPI(MethodView):
+
+    @bp.arguments(MessagesExchangeStreamQuerySchema, location='query')
+    def get(self, args, exchange, exchange_id):
+        """
+        Stream messages
+
+        Server-Sent Events stream of the messages in the exchange. Each message is sent as a 'message' event with
+        the message id as the event id. Streaming resumes after the 'Last-Event-ID' header if the client sends one,
+        otherwise after 'messages_after', with the same semantics as for the exchange long poll.
+        The stream is closed after 'timeout' seconds, after which the client should reconnect.
+        """
+        driftbase.messages.check_can_use_exchange(exchange, exchange_id, read=True)
+
+        messages_after = str(request.headers.get("Last-Event-ID") or args["messages_after"])
+        if not messages_after.isdigit():
+            abort(http_client.BAD_REQUEST, message="Invalid Last-Event-ID '%s'" % messages_after)
+        my_player_id = current_user["player_id"] if current_user else None
+        exchange_full_name = "{}-{}".format(exchange, exchange_id)
+        stream_timeout = utcnow() + datetime.timedelta(seconds=args["timeout"])
+
+        def streamer():
+            nonlocal messages_after
+            yield "retry: 1000\n\n"
+            try:
+                with driftbase.messages.wait_for_messages(exchange, exchange_id) as new_messages:
+                    notified = True
+                    while 1:
+                        # Only check for messages when notified of one, or when idle for a keepalive period
+                        if notified:
+                            new_messages.clear()
+                            messages = driftbase.messages.fetch_messages(exchange, exchange_id, messages_after)
+                            messages = [m for queue_messages in _patch_messages(messages).values()
+                                        for m in queue_messages]
+                            if messages:
+                                messages.sort(key=operator.itemgetter("message_number"))
+                                messages_after = messages[-1]["message_id"]
+                                yield "".join(_format_event(m) for m in messages)
+                        remaining = (stream_timeout - utcnow()).total_seconds()
+                        if remaining <= 0:
+                            return
+                        notified = new_messages.wait(min(remaining, STREAM_KEEPALIVE_SECONDS))
+                        if not notified:
+                            yield ": keepalive\n\n"
+                            # Notifications are missed while the listener isn't subscribed, so check anyway
+                            driftbase.messages.ensure_listening()
+                            notified = True
+            except Exception as e:
+                log.error("[%s/%s] Exception in message stream %s", my_player_id, exchange_full_name, repr(e))
+                return
+
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        return Response(stream_with_context(streamer()), mimetype="text/event-stream", headers=headers)
+
+
 class MessagesQueuePostArgs(ma.Schema):
     message = ma.fields.Dict(required=True)
     expire = ma.fields.Integer()
@@ -212,6 +292,8 @@ class MessageQueueAPI(MethodView):
 def endpoint_info(*args):
     ret = {
         "my_messages": url_for("messages.exchange", exchange="players", exchange_id=current_user["player_id"],
-                               _external=True) if current_user else None
+                               _external=True) if current_user else None,
+        "my_messages_stream": url_for("messages.stream", exchange="players", exchange_id=current_user["player_id"],
+                                      _external=True) if current_user else None,
     }
     return ret
\ No newline at end of file
@@ -18,6 +18,7 @@ from driftbase.api.players import (
     summary,
     tickets,
 )
+from driftbase.auth.authenticate import invalidate_user_cache
 from driftbase.models.db import CorePlayer, MatchPlayer
 from driftbase.players import get_playergroup_ids
 from driftbase.utils import url_player
@@ -98,6 +99,7 @@ def _handle_set_player_name_from_seasons(*args, **kwargs):
     old_name = my_player.player_name
     my_player.player_name = new_name
     db_session.commit()
+    invalidate_user_cache(my_player.user_id)
     log.info("Player changed name from '%s' to '%s'", old_name, new_name)
 
     message_data = dict(
@@ -207,6 +209,7 @@ class PlayerAPI(MethodView):
         old_name = my_player.player_name
         my_player.player_name = new_name
         db_session.commit()
+        invalidate_user_cache(my_player.user_id)
         log.info("Player changed name from '%s' to '%s'", old_name, new_name)
 
         message_data = dict(
@@ -18,7 +18,8 @@ from flask_marshmallow.fields import AbsoluteUrlFor
 
 from driftbase.counters import get_counter, get_player, add_count, check_and_update_player_counter, COUNTER_PERIODS, \
     get_all_counters, \
-    batch_get_or_create_counters, batch_create_player_counters, batch_update_counter_entries
+    batch_get_or_create_counters, batch_create_player_counters, batch_update_counter_entries, \
+    write_behind_enabled, buffer_counter_entries
 from driftbase.models.db import CounterEntry, PlayerCounter
 
 COUNTER_TYPE_COUNT = "count"
@@ -31,6 +32,10 @@ log = logging.getLogger(__name__)
 bp = Blueprint("player_counters", __name__, url_prefix='/players')
 
 
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
 class PlayerCounterRequestSchema(ma.Schema):
     timestamp = ma.fields.DateTime()
     value = ma.fields.Integer()
@@ -161,7 +166,7 @@ class CountersApi(MethodView):
         result = {}
         counter_names = []
         counter_updates = {}
-        timestamp = datetime.datetime.utcnow()
+        timestamp = utcnow()
         for update in args:
             log.debug("Adding count for player %s: %s" % (player_id, update))
 
@@ -209,7 +214,22 @@ class CountersApi(MethodView):
                                              )
 
         counter_ids = []
-        if len(counter_updates) > 0:
+        if len(counter_updates) > 0 and write_behind_enabled():
+            # Only go to the db for counters we haven't seen before, the rest is buffered and written in bulk later
+            known_counters = get_all_counters()
+            new_counters = []
+            for name, update_entry in counter_updates.items():
+                counter = known_counters.get(name)
+                if counter:
+                    update_entry["counter_id"] = counter["counter_id"]
+                else:
+                    new_counters.append((name, update_entry["counter_type"]))
+            if new_counters:
+                for (counter_id, name) in batch_get_or_create_counters(new_counters):
+                    counter_updates[name]["counter_id"] = counter_id
+
+            buffer_counter_entries(player_id, counter_updates)
+        elif len(counter_updates) > 0:
             counters = batch_get_or_create_counters([(k, v["counter_type"]) for k, v in counter_updates.items()])
             for (counter_id, name) in counters:
                 counter_updates[name]["counter_id"] = counter_id
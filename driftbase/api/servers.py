@@ -11,6 +11,7 @@ import http.client as http_client
 from drift.core.extensions.jwt import current_user, requires_roles
 from drift.core.extensions.urlregistry import Endpoints
 from driftbase.config import get_server_heartbeat_config
+from driftbase.heartbeats import get_server_heartbeat, record_server_heartbeat, redis_heartbeats_enabled
 from driftbase.models.db import (
     Machine, Server, Match, ServerDaemonCommand
 )
@@ -353,20 +354,25 @@ class ServerHeartbeatAPI(MethodView):
         heartbeat_period, heartbeat_timeout = get_server_heartbeat_config()
 
         now = utcnow()
-        last_heartbeat = server.heartbeat_date
+        use_redis = redis_heartbeats_enabled()
+        last_heartbeat = get_server_heartbeat(server) if use_redis else server.heartbeat_date
         if last_heartbeat + datetime.timedelta(seconds=heartbeat_timeout) < now:
             msg = "Heartbeat timeout. Last heartbeat was at {} and now we are at {}" \
                 .format(last_heartbeat, now)
             log.info(msg)
             abort(http_client.NOT_FOUND, message=msg)
-        server.heartbeat_count += 1
-        server.heartbeat_date = now
-        g.db.commit()
+        if use_redis:
+            # The row is left alone, the heartbeat is written to the db in bulk later
+            record_server_heartbeat(server_id, now)
+        else:
+            server.heartbeat_count += 1
+            server.heartbeat_date = now
+            g.db.commit()
 
         return {
             "last_heartbeat": last_heartbeat,
-            "this_heartbeat": server.heartbeat_date,
-            "next_heartbeat": server.heartbeat_date + datetime.timedelta(seconds=heartbeat_period),
+            "this_heartbeat": now,
+            "next_heartbeat": now + datetime.timedelta(seconds=heartbeat_period),
             "next_heartbeat_seconds": heartbeat_period,
             "heartbeat_timeout": now + datetime.timedelta(seconds=heartbeat_timeout),
             "heartbeat_timeout_seconds": heartbeat_timeout,
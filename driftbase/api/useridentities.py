@@ -12,6 +12,7 @@ from drift.core.extensions.urlregistry import Endpoints
 
 from drift.core.extensions.jwt import current_user, get_cached_token
 
+from driftbase.auth.authenticate import invalidate_identity_cache
 from driftbase.models.db import User, CorePlayer, UserIdentity
 
 # Authentication types that hash their usernames
@@ -213,6 +214,7 @@ class UserIdentitiesAPI(MethodView):
 
         my_identity.user_id = link_with_user.user_id
         g.db.commit()
+        invalidate_identity_cache(my_identity.name)
 
         log.info("User identity %s has been switched from user_id %s to "
                  "user_id %s who has player_id %s",
@@ -1,9 +1,13 @@
+import hashlib
+import hmac
 import http.client
 import http.client as http_client
+import json
 import logging
 import uuid
 
 from drift.blueprint import abort
+from drift.core.extensions.driftconfig import get_feature_switch
 from drift.core.resources.redis import PlayerCache, UserCache
 from flask import g, current_app
 from werkzeug.security import check_password_hash
@@ -12,6 +16,34 @@ from driftbase.models.db import User, CorePlayer, UserIdentity, UserRole
 
 log = logging.getLogger(__name__)
 
+# Resolved logins are cached in Redis so that repeat logins don't need to touch the db, see _authenticate_cached().
+# auth:identity:<username> - The identity, a digest of its password keyed with its password hash, its user, and the
+#   identities sharing its name
+# auth:user:<user_id> - The user name and roles, and the player of an active user
+IDENTITY_CACHE_TTL_SECONDS = 60 * 10
+
+
+def identity_cache_enabled():
+    return get_feature_switch('enable_auth_identity_cache')
+
+
+def invalidate_identity_cache(username):
+    """ Forget the cached login of the identity, f.ex. when it's linked with another user. """
+    g.redis.conn.delete(_make_identity_cache_key(username))
+
+
+def invalidate_user_cache(user_id):
+    """ Forget the cached user and player, f.ex. when the roles of the user or the player name change. """
+    g.redis.conn.delete(_make_user_cache_key(user_id))
+
+
+def _make_identity_cache_key(username):
+    return g.redis.make_key(f"auth:identity:{username}")
+
+
+def _make_user_cache_key(user_id):
+    return g.redis.make_key(f"auth:user:{user_id}")
+
 
 def abort_unauthorized(description):
     """Raise an Unauthorized exception.
@@ -89,11 +121,54 @@ def authenticate_with_provider(auth_info):
 
 
 def authenticate(username, password, automatic_account_creation=True, fallback_username=None):
+    if identity_cache_enabled():
+        # A fully resolved login has nothing to create or upgrade, so it doesn't need the lock
+        ret = _authenticate_cached(username, password)
+        if ret:
+            return ret
     # There's a bunch of possible race conditions that can happen if we don't lock here, so we lock on the username
     with g.redis.lock(f"user_login_lock:{username}", timeout=10):
         return _authenticate(username, password, automatic_account_creation, fallback_username)
 
 
+def _authenticate_cached(username, password):
+    """
+    Authenticate using the cached identity, user and player, returning None if the login can't be completed from the
+    cache and needs the full authentication.
+
+    The password hash, user status and roles are re-read from the db in a single query, so password, status and role
+    changes take effect right away, and a wrong password always goes through the full authentication.
+    """
+    cached_identity = g.redis.conn.get(_make_identity_cache_key(username))
+    if not cached_identity:
+        return None
+    identity = json.loads(cached_identity)
+    cached_user = g.redis.conn.get(_make_user_cache_key(identity["user_id"]))
+    if not cached_user:
+        return None
+    user = json.loads(cached_user)
+
+    rows = g.db.query(UserIdentity.password_hash, User.status, UserRole.role) \
+        .join(User, User.user_id == UserIdentity.user_id) \
+        .outerjoin(UserRole, UserRole.user_id == User.user_id) \
+        .filter(UserIdentity.identity_id == identity["identity_id"], User.user_id == user["user_id"]) \
+        .all()
+    if not rows or rows[0].status != "active":
+        return None
+    if not hmac.compare_digest(_make_password_digest(rows[0].password_hash, password), identity["password_digest"]):
+        return None
+    roles = [row.role for row in rows if row.role]
+
+    return _complete_login(username, identity["identity_id"], user["user_id"], user["user_name"], roles,
+                           user["player_id"], user["player_name"], user["player_uuid"], identity["identities"])
+
+
+def _make_password_digest(password_hash, password):
+    # Keyed with the password hash, which is only in the db, so the cached digest is useless without it, and it no
+    # longer matches once the password is changed
+    return hmac.new(password_hash.encode(), password.encode(), hashlib.sha256).hexdigest()
+
+
 def _authenticate(username, password, automatic_account_creation=True, fallback_username=None):
     """basic authentication"""
     identity_type = ""
@@ -108,12 +183,13 @@ def _authenticate(username, password, automatic_account_creation=True, fallback_
 
     identity_id = 0
 
-    my_identity = (
+    my_identities = (
         g.db.query(UserIdentity)
         .filter(UserIdentity.name == username)
         .order_by(UserIdentity.num_logons.desc())
-        .first()
+        .all()
     )
+    my_identity = my_identities[0] if my_identities else None
 
     if not my_identity and fallback_username:
         my_identity = (
@@ -164,6 +240,7 @@ def _authenticate(username, password, automatic_account_creation=True, fallback_
 
         g.db.add(my_identity)
         g.db.flush()
+        my_identities = [my_identity]
         log.info("Created new user identity", extra={'identity_id': my_identity.identity_id, 'username': username})
         current_app.extensions.get('shoutout').message("identity_created", identity_type=identity_type,
                                                        identity_id=my_identity.identity_id, username=username)
@@ -177,6 +254,7 @@ def _authenticate(username, password, automatic_account_creation=True, fallback_
         if fallback_username and my_identity.name != username:
             my_identity.name = username
             g.db.flush()
+            my_identities = [my_identity]
             log.info("User Identity has been upgraded from the legacy username format",
                      extra={'identity_id': identity_id, 'old_username': fallback_username, 'new_username': username})
 
@@ -262,29 +340,55 @@ def _authenticate(username, password, automatic_account_creation=True, fallback_
 
     g.db.commit()
 
+    player_uuid = player_uuid.hex if player_uuid else None
+    player_identities = [dict(identity_id=identity.identity_id, identity_type=identity.identity_type,
+                              name=identity.name) for identity in my_identities]
+    if identity_cache_enabled() and user_id and player_id:
+        with g.redis.conn.pipeline(transaction=False) as pipe:
+            pipe.set(_make_identity_cache_key(username), json.dumps(dict(
+                identity_id=identity_id,
+                password_digest=_make_password_digest(my_identity.password_hash, password),
+                user_id=user_id,
+                identities=player_identities,
+            )), ex=IDENTITY_CACHE_TTL_SECONDS)
+            pipe.set(_make_user_cache_key(user_id), json.dumps(dict(
+                user_id=user_id,
+                user_name=my_user_name,
+                roles=user_roles,
+                player_id=player_id,
+                player_name=player_name,
+                player_uuid=player_uuid,
+            )), ex=IDENTITY_CACHE_TTL_SECONDS)
+            pipe.execute()
+
+    return _complete_login(username, identity_id, user_id, my_user_name, user_roles, player_id, player_name,
+                           player_uuid, player_identities)
+
+
+def _complete_login(username, identity_id, user_id, user_name, user_roles, player_id, player_name, player_uuid,
+                    player_identities):
+    lst = username.split(":")
+    is_old = len(lst) == 1
+    identity_type = "" if is_old else lst[0]
     provider_id = user_id  # by default
     if identity_type and identity_type != 'user+pass':
         provider_id = username if is_old is False else f"{identity_type}:{username}"
 
     # store the user information in the cache for later lookup
     ret = dict(
-        user_name=my_user_name,
+        user_name=user_name,
         user_id=user_id,
         identity_id=identity_id,
         provider_user_id=provider_id,
         player_id=player_id,
         player_name=player_name,
-        player_uuid=player_uuid.hex if player_uuid else None,
+        player_uuid=player_uuid,
         roles=user_roles
     )
     UserCache().set_all(user_id, ret)
     PlayerCache().set_all(player_id, ret)
     if user_id and player_id and "player" in user_roles:
         message_data = ret.copy()
-        player_identities = []
-        for identity in g.db.query(UserIdentity).filter(UserIdentity.name == username).all():
-            player_identities.append(
-                dict(identity_id=identity.identity_id, identity_type=identity.identity_type, name=identity.name))
         message_data['identities'] = player_identities
         current_app.extensions.get('shoutout').message("player_login", **message_data)
     return ret
@@ -14,7 +14,7 @@ class DiscordValidator(BaseOAuthValidator):
 
     def _get_identity(self, provider_details: dict) -> requests.Response | dict:
         access_token = provider_details['token']
-        return requests.get('https://discord.com/api/users/@me', headers={
+        return self.session.get('https://discord.com/api/users/@me', headers={
             'Authorization': f'Bearer {access_token}'
         })
 
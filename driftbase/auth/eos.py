@@ -13,6 +13,7 @@ from jwt import PyJWKClientError
 from driftbase.auth import get_provider_config
 from .authenticate import authenticate as base_authenticate, AuthenticationException, ServiceUnavailableException, \
     abort_unauthorized, InvalidRequestException, UnauthorizedException
+from .jwk import _get_jwk_client
 
 EPIC_PUBLIC_KEYS_URL = "https://api.epicgames.dev/epic/oauth/v1/.well-known/jwks.json"
 TRUSTED_ISSUER_URL_BASE = 'https://api.epicgames.dev/'
@@ -131,7 +132,7 @@ def _decode_and_verify_jwt(token, key, audience):
 
 def _get_key_from_token(token):
     try:
-        jwk_client = jwt.PyJWKClient(EPIC_PUBLIC_KEYS_URL)
+        jwk_client = _get_jwk_client(EPIC_PUBLIC_KEYS_URL)
         jwk = jwk_client.get_signing_key_from_jwt(token)
     except URLError as e:
         raise ServiceUnavailableException("Failed to fetch public keys for token validation") from e
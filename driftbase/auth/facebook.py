@@ -15,7 +15,7 @@ class FacebookValidator(BaseOAuthValidator):
         self._abort_unauthorized('token validation not implemented')
         '''
         access_token = provider_details['token']
-        return requests.get('https://graph.facebook.com/me', params={
+        return self.session.get('https://graph.facebook.com/me', params={
             'fields': 'id',
             'access_token': access_token})
         '''
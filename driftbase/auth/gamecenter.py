@@ -1,4 +1,5 @@
 import base64
+import functools
 import http.client as http_client
 import struct
 from hashlib import pbkdf2_hmac
@@ -105,7 +106,7 @@ def run_gamecenter_token_validation(gc_token, app_bundles):
 
     # Load certificate
     try:
-        cert = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_ASN1, content)
+        cert = _load_certificate(content)
     except OpenSSL.crypto.Error as e:
         abort_unauthorized(error_title + ". Can't load certificate: %s" % str(e))
 
@@ -128,3 +129,9 @@ def run_gamecenter_token_validation(gc_token, app_bundles):
         abort_unauthorized(error_title + ". Can't verify signature: %s" % str(e))
 
     return gc_token["player_id"]
+
+
+@functools.lru_cache(maxsize=16)
+def _load_certificate(content):
+    # Apple serves the same few certificates to everyone, so only parse each one once
+    return OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_ASN1, content)
@@ -15,7 +15,7 @@ class GoogleValidator(BaseOAuthValidator):
         self._abort_unauthorized('token validation not implemented')
         '''
         access_token = provider_details['token']
-        return requests.get('https://www.googleapis.com/oauth2/v1/userinfo', headers={
+        return self.session.get('https://www.googleapis.com/oauth2/v1/userinfo', headers={
             'Authorization': f'Bearer {access_token}'
         })
         '''        
@@ -8,10 +8,14 @@ import http.client as http_client
 from werkzeug.exceptions import Unauthorized
 
 from driftbase.auth import get_provider_config
+from driftbase.auth.http_session import get_provider_session
+from driftbase.auth.util import get_cached_validation
 from .authenticate import authenticate as base_authenticate
 
 log = logging.getLogger(__name__)
 
+session = get_provider_session('googleplay')
+
 
 class GooglePlayProviderAuthDetailsSchema(ma.Schema):
     user_id = ma.fields.String(required=True)
@@ -58,10 +62,14 @@ def validate_googleplay_token():
     app_client_ids = gp_config.get("client_ids", None)
 
     # Call validation and authenticate if token is good
-    identity_id = run_token_validation(
-        user_id=provider_details['user_id'],
-        id_token=provider_details['id_token'],
-        app_client_ids=app_client_ids
+    identity_id = get_cached_validation(
+        "googleplay", dict(user_id=provider_details['user_id'], id_token=provider_details['id_token'],
+                           app_client_ids=app_client_ids),
+        lambda: run_token_validation(
+            user_id=provider_details['user_id'],
+            id_token=provider_details['id_token'],
+            app_client_ids=app_client_ids
+        )
     )
 
     return identity_id
@@ -77,7 +85,7 @@ def run_token_validation(user_id, id_token, app_client_ids):
     url = token_check_url.format(id_token=id_token)
 
     try:
-        ret = requests.post(url, headers={'Accept': 'application/json'})
+        ret = session.post(url, headers={'Accept': 'application/json'})
     except requests.exceptions.RequestException as e:
         log.warning("Google Play authentication request failed: %s", e)
         abort_unauthorized("Google Play token validation failed. Can't reach Google Play platform.")
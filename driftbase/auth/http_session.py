@@ -0,0 +1,100 @@
+"""
+    Pooled HTTP sessions for calling third-party authentication providers.
+
+    Each provider gets its own keep-alive connection pool, a bound on how many requests can be in flight at once, default
+    connect/read timeouts so a slow provider can't hang the greenlets serving logins, and a circuit breaker which fails
+    logins fast while the provider is down.
+"""
+
+import logging
+import time
+
+import gevent.lock
+import prometheus_client
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT_SECONDS = 3.05
+READ_TIMEOUT_SECONDS = 10
+POOL_SIZE = 20
+# Requests beyond this many in flight to the same provider wait for a slot, for at most the connect timeout
+MAX_CONCURRENT_REQUESTS = 50
+# The circuit opens after this many consecutive failures, and lets a request through again after the cooldown
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN_SECONDS = 30
+
+REQUEST_LATENCY = prometheus_client.Histogram(
+    "driftbase_auth_provider_request_seconds",
+    "Latency of requests to third-party authentication providers",
+    ["provider", "outcome"]
+)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """The provider has been failing, so the request was not attempted."""
+    pass
+
+
+class ProviderSession(object):
+    def __init__(self, provider):
+        self.provider = provider
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._slots = gevent.lock.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+        self._consecutive_failures = 0
+        self._open_until = 0
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """
+        Make a request to the provider, raising requests.exceptions.RequestException if it fails or can't be made.
+        """
+        if self._open_until > time.time():
+            REQUEST_LATENCY.labels(self.provider, "circuit_open").observe(0)
+            raise CircuitOpenError(f"{self.provider} is unavailable, not retrying for a while")
+        kwargs.setdefault("timeout", (CONNECT_TIMEOUT_SECONDS, READ_TIMEOUT_SECONDS))
+        if not self._slots.acquire(timeout=CONNECT_TIMEOUT_SECONDS):
+            REQUEST_LATENCY.labels(self.provider, "busy").observe(0)
+            raise requests.exceptions.ConnectionError(f"Too many requests in flight to {self.provider}")
+        start = time.monotonic()
+        try:
+            response = self._session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self._record_outcome("error", start, failed=True)
+            raise
+        finally:
+            self._slots.release()
+        # Client errors mean the provider is up and rejected the credentials, which doesn't count against it
+        self._record_outcome(str(response.status_code), start, failed=response.status_code >= 500)
+        return response
+
+    def _record_outcome(self, outcome, start, failed):
+        REQUEST_LATENCY.labels(self.provider, outcome).observe(time.monotonic() - start)
+        if not failed:
+            self._consecutive_failures = 0
+            return
+        self._consecutive_failures += 1
+        if self._consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+            log.warning("%s has failed %s times in a row, failing requests for %s seconds",
+                        self.provider, self._consecutive_failures, CIRCUIT_COOLDOWN_SECONDS)
+            self._open_until = time.time() + CIRCUIT_COOLDOWN_SECONDS
+            self._consecutive_failures = 0
+
+
+_sessions = {}
+
+
+def get_provider_session(provider):
+    session = _sessions.get(provider)
+    if session is None:
+        session = _sessions[provider] = ProviderSession(provider)
+    return session
@@ -7,6 +7,8 @@ import http.client as http_client
 
 import logging
 
+from driftbase.auth.http_session import get_provider_session
+
 log = logging.getLogger(__name__)
 
 
@@ -18,6 +20,7 @@ class BaseOAuthValidator:
     def __init__(self, name, details_schema=DefaultOAuthDetailsSchema):
         self.name = name
         self.details_schema = details_schema        
+        self.session = get_provider_session(name)
     
     def _get_identity(self, provider_details: dict) -> requests.Response | dict:
         '''call the identity endpoint with the oauth access token and return the response object'''
@@ -8,10 +8,14 @@ import http.client as http_client
 from werkzeug.exceptions import Unauthorized
 
 from driftbase.auth import get_provider_config
+from driftbase.auth.http_session import get_provider_session
+from driftbase.auth.util import get_cached_validation
 from .authenticate import authenticate as base_authenticate
 
 log = logging.getLogger(__name__)
 
+session = get_provider_session('oculus')
+
 
 class OculusProviderAuthDetailsSchema(ma.Schema):
     user_id = ma.fields.String(required=True)
@@ -56,10 +60,13 @@ def validate_oculus_ticket():
         abort(http_client.SERVICE_UNAVAILABLE, description="Oculus authentication not configured for current tenant")
 
     # Call validation and authenticate if ticket is good
-    identity_id = run_ticket_validation(
-        user_id=provider_details['user_id'],
-        access_token=oculus_config['access_token'],
-        nonce=provider_details['nonce']
+    identity_id = get_cached_validation(
+        "oculus", dict(user_id=provider_details['user_id'], nonce=provider_details['nonce']),
+        lambda: run_ticket_validation(
+            user_id=provider_details['user_id'],
+            access_token=oculus_config['access_token'],
+            nonce=provider_details['nonce']
+        )
     )
 
     return identity_id
@@ -75,7 +82,7 @@ def run_ticket_validation(user_id, access_token, nonce):
     url = token_check_url.format(user_id=user_id, access_token=access_token, nonce=nonce)
 
     try:
-        ret = requests.post(url, headers={'Accept': 'application/json'})
+        ret = session.post(url, headers={'Accept': 'application/json'})
     except requests.exceptions.RequestException as e:
         log.warning("Oculus authentication request failed: %s", e)
         abort_unauthorized("Oculus ticket validation failed. Can't reach Oculus platform.")
@@ -9,10 +9,14 @@ import http.client as http_client
 from werkzeug.exceptions import Unauthorized
 
 from driftbase.auth import get_provider_config
+from driftbase.auth.http_session import get_provider_session
+from driftbase.auth.util import get_cached_validation
 from .authenticate import authenticate as base_authenticate
 
 log = logging.getLogger(__name__)
 
+session = get_provider_session('psn')
+
 # TODO: While these are very much static, putting them in some global config might be better
 psn_issuer_urls = {
     "dev": "https://auth.api.sp-int.sonyentertainmentnetwork.com/2.0/oauth/token",
@@ -56,12 +60,16 @@ def validate_psn_ticket():
         abort(http_client.SERVICE_UNAVAILABLE, description="PSN authentication not configured for current tenant")
 
     # Call validation and authenticate if ticket is good
-    identity_id = run_ticket_validation(
-        user_id=provider_details['psn_id'],
-        auth_code=provider_details['auth_code'],
-        issuer=provider_details['issuer'],
-        client_id=psn_config['client_id'],
-        client_secret=psn_config['client_secret']
+    identity_id = get_cached_validation(
+        "psn", dict(user_id=provider_details['psn_id'], auth_code=provider_details['auth_code'],
+                    issuer=provider_details['issuer'], client_id=psn_config['client_id']),
+        lambda: run_ticket_validation(
+            user_id=provider_details['psn_id'],
+            auth_code=provider_details['auth_code'],
+            issuer=provider_details['issuer'],
+            client_id=psn_config['client_id'],
+            client_secret=psn_config['client_secret']
+        )
     )
 
     return identity_id
@@ -91,7 +99,7 @@ def run_ticket_validation(user_id, auth_code, issuer, client_id, client_secret):
     )
 
     try:
-        ret = requests.post(url, data=payload, headers=headers)
+        ret = session.post(url, data=payload, headers=headers)
     except requests.exceptions.RequestException as e:
         log.warning("PSN authentication request failed: %s", e)
         abort_unauthorized("PSN authentication failed. Can't reach PSN platform.")
@@ -123,7 +131,7 @@ def run_ticket_validation(user_id, auth_code, issuer, client_id, client_secret):
         token=token
     )
     try:
-        ret = requests.get(validation_url, headers=headers)
+        ret = session.get(validation_url, headers=headers)
     except requests.exceptions.RequestException as e:
         log.warning("PSN authentication request failed: %s", e)
         abort_unauthorized("PSN auth token validation failed. Can't reach PSN platform.")
@@ -8,12 +8,15 @@ import http.client as http_client
 from werkzeug.exceptions import Unauthorized
 
 from driftbase.auth import get_provider_config
-from driftbase.auth.util import fetch_url
+from driftbase.auth.http_session import get_provider_session
+from driftbase.auth.util import fetch_url, get_cached_validation
 from .authenticate import authenticate as base_authenticate
 from ..utils.custom_fields import UnionField
 
 log = logging.getLogger(__name__)
 
+session = get_provider_session('steam')
+
 
 def authenticate(auth_info):
     assert auth_info['provider'] == "steam"
@@ -69,18 +72,20 @@ def validate_steam_ticket():
         abort(http_client.SERVICE_UNAVAILABLE, description="Steam tickets cannot be validated at the moment.")
 
     # Call validation and authenticate if ticket is good
-    identity_id = run_ticket_validation(provider_details, key_url=key_url, key=key, appid=appid)
+    identity_id = get_cached_validation(
+        "steam", dict(ticket=provider_details['ticket'], steamid=provider_details.get('steamid'), appid=appid),
+        lambda: run_ticket_validation(provider_details, key_url=key_url, key=key, appid=appid))
     return identity_id
 
 
 # for mocking
 def _call_authenticate_user_ticket(url):
-    return requests.get(url)
+    return session.get(url)
 
 
 # for mocking
 def _call_check_app_ownership(url):
-    return requests.get(url)
+    return session.get(url)
 
 
 def run_ticket_validation(provider_details, key_url=None, key=None, appid=None):
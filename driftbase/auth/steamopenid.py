@@ -37,7 +37,7 @@ class SteamOpenIDValidator(BaseOAuthValidator):
     def _get_identity(self, provider_details: dict) -> requests.Response | dict:
         data = provider_details
         data['openid.mode'] = 'check_authentication'
-        r = requests.post('https://steamcommunity.com/openid/login', data=data)
+        r = self.session.post('https://steamcommunity.com/openid/login', data=data)
     
         if 'is_valid:true' in r.text:
             steam_id = re.search(r'\d+$', provider_details['openid.claimed_id']).group(0)
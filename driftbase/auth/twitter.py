@@ -16,7 +16,7 @@ class TwitterValidator(BaseOAuthValidator):
         self._abort_unauthorized('token validation not implemented')
         '''
         access_token = provider_details['token']
-        return requests.get('https://api.twitter.com/2/users/me', headers={
+        return self.session.get('https://api.twitter.com/2/users/me', headers={
             'Authorization': f'Bearer {access_token}'
         })
         '''        
@@ -1,4 +1,8 @@
+import collections
+import hashlib
+import json
 import logging
+import time
 
 from six.moves.urllib.parse import urlparse
 
@@ -7,9 +11,20 @@ import boto3
 from werkzeug.exceptions import ServiceUnavailable
 from flask import g
 from flask.globals import _app_ctx_stack
+from drift.core.extensions.driftconfig import get_feature_switch
+
+from driftbase.auth.http_session import CONNECT_TIMEOUT_SECONDS, READ_TIMEOUT_SECONDS
 
 log = logging.getLogger(__name__)
 
+# Successful ticket validations are remembered for a short while, so that client retries don't hit the platform again
+VALIDATION_CACHE_SECONDS = 60
+
+# In-process cache in front of the Redis one, {url: (content, expires)}, least recently used first
+_url_cache = collections.OrderedDict()
+# Most urls fetched in the in-process cache, the least recently used ones being evicted first
+MAX_URL_CACHE_ENTRIES = 1000
+
 
 def fetch_url(url, error_title, expire=None):
     """
@@ -20,11 +35,25 @@ def fetch_url(url, error_title, expire=None):
     If 'url' points to S3, it will be signed using implicit AWS credentials.
     """
     expire = expire or 3600  # Cache for one hour.
+    cached = _url_cache.get(url)
+    if cached:
+        if cached[1] > time.time():
+            _url_cache.move_to_end(url)
+            return cached[0]
+        _url_cache.pop(url, None)
+
     redis = None
     content = None
     if _app_ctx_stack.top and hasattr(g, "redis"):
         content = g.redis.get("urlget:" + url)
         redis = g.redis
+        if content:
+            # Don't keep it in-process for longer than it's cached in Redis, which honors the origin's Cache-Control
+            ttl = g.redis.conn.pttl(g.redis.make_key("urlget:" + url))
+            if ttl == -2:
+                expire = 0  # It expired in the meantime
+            elif ttl >= 0:
+                expire = ttl / 1000.0
 
     if not content:
         # TODO: It looks like only auth.gamecenter and auth.steam are using this feature to fetch
@@ -36,7 +65,7 @@ def fetch_url(url, error_title, expire=None):
         signed_url = _aws_s3_sign_url(url)
 
         try:
-            ret = requests.get(signed_url)
+            ret = requests.get(signed_url, timeout=(CONNECT_TIMEOUT_SECONDS, READ_TIMEOUT_SECONDS))
         except requests.exceptions.RequestException as e:
             log.warning(error_title + "Url '%s' can't be fetched. %s", signed_url, e)
             raise ServiceUnavailable()
@@ -44,12 +73,64 @@ def fetch_url(url, error_title, expire=None):
             log.warning(error_title + "Url '%s' can't be fetched. Status code %s", signed_url, ret.status_code)
             raise ServiceUnavailable()
         content = ret.content
-        if redis:
+        max_age = _get_max_age(getattr(ret, "headers", {}))
+        if max_age is not None:
+            expire = max_age
+        if redis and expire:
             g.redis.set("urlget:" + url, content, expire=expire)
 
+    if expire:
+        _cache_url(url, content, time.time() + expire)
     return content
 
 
+def _cache_url(url, content, expires):
+    now = time.time()
+    for cached_url in [u for u, (_, e) in _url_cache.items() if e <= now]:
+        del _url_cache[cached_url]
+    _url_cache[url] = (content, expires)
+    _url_cache.move_to_end(url)
+    while len(_url_cache) > MAX_URL_CACHE_ENTRIES:
+        _url_cache.popitem(last=False)
+
+
+def _get_max_age(headers):
+    """
+    Return how long a response may be cached according to its Cache-Control header, or None if it doesn't say.
+    """
+    cache_control = headers.get("Cache-Control")
+    if not cache_control:
+        return None
+    directives = [directive.strip().lower() for directive in cache_control.split(",")]
+    if "no-store" in directives or "no-cache" in directives:
+        return 0
+    for directive in directives:
+        if directive.startswith("max-age="):
+            try:
+                return int(directive[len("max-age="):])
+            except ValueError:
+                return None
+    return None
+
+
+def get_cached_validation(provider, validation_args, validate):
+    """
+    Return the identity id which 'validate' returns for 'validation_args', or that it returned a moment ago.
+
+    Only successful validations are cached, keyed on a hash of everything that goes into the validation.
+    """
+    if not get_feature_switch('enable_auth_validation_cache'):
+        return validate()
+    args_hash = hashlib.sha256(json.dumps(validation_args, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    key = g.redis.make_key(f"auth:validated:{provider}:{args_hash}")
+    identity_id = g.redis.conn.get(key)
+    if identity_id:
+        return identity_id
+    identity_id = validate()
+    g.redis.conn.set(key, identity_id, ex=VALIDATION_CACHE_SECONDS)
+    return identity_id
+
+
 def _aws_s3_sign_url(url):
     """If url is an S3 url, sign it using implicit credentials"""
     if 'amazonaws.com' in url:
@@ -0,0 +1,73 @@
+import logging
+
+from flask import g
+from drift.core.extensions.driftconfig import get_tenant_config_value, get_feature_switch
+
+from driftbase.config import get_client_heartbeat_config
+from driftbase.heartbeats import HeartbeatStore
+from driftbase.models.db import Client
+from driftbase.utils.background import run_in_background
+
+log = logging.getLogger(__name__)
+
+# Heartbeats recorded in Redis, see record_client_heartbeat()
+CLIENTS_DEFAULTS = dict(clients=dict(
+    heartbeat_flush_interval_seconds=60,  # Flush heartbeats to the db at least this often while clients heartbeat
+))
+client_heartbeats = HeartbeatStore("clients", Client.__table__, "client_id", "heartbeat", "num_heartbeats",
+                                   get_client_heartbeat_config)
+
+
+def redis_heartbeats_enabled():
+    return get_feature_switch('enable_client_redis_heartbeats')
+
+
+def _get_clients_config_value(config_key):
+    return get_tenant_config_value("clients", config_key, CLIENTS_DEFAULTS)
+
+
+def record_client_heartbeat(client_id, now):
+    """
+    Record a heartbeat for the client in Redis instead of updating its row.
+
+    The heartbeat and the number of heartbeats are written to ck_clients in bulk by flush_client_heartbeats().
+    Returns the number of heartbeats recorded for the client since they were last flushed.
+    """
+    num_pending, flush_due = client_heartbeats.record(
+        client_id, now, _get_clients_config_value("heartbeat_flush_interval_seconds"))
+    if flush_due:
+        # The flush is done in the background so the heartbeat which happens to trigger it doesn't wait for it
+        run_in_background(g.redis.make_key("clients:heartbeats:flush"), flush_client_heartbeats)
+    return num_pending
+
+
+def get_client_heartbeats(clients, redis_conn=None):
+    """
+    Return {client_id: heartbeat} for the clients, taking heartbeats recorded in Redis into account.
+    """
+    if not redis_heartbeats_enabled():
+        return {client.client_id: client.heartbeat for client in clients}
+    return client_heartbeats.get_heartbeats(clients, redis_conn)
+
+
+def get_client_heartbeat(client):
+    return get_client_heartbeats([client])[client.client_id]
+
+
+def client_heartbeat_filter(min_heartbeat_time):
+    """
+    Return a filter clause selecting clients which have heartbeat since min_heartbeat_time.
+    """
+    if not redis_heartbeats_enabled():
+        return Client.heartbeat >= min_heartbeat_time
+    return client_heartbeats.heartbeat_filter(min_heartbeat_time,
+                                              _get_clients_config_value("heartbeat_flush_interval_seconds"))
+
+
+def flush_client_heartbeats(db_session=None):
+    """
+    Write the heartbeats recorded in Redis to ck_clients.
+
+    Returns the number of clients updated.
+    """
+    return client_heartbeats.flush(db_session)
@@ -1,22 +1,116 @@
 import datetime
+import functools
 import json
 import logging
 import six
+import textwrap
+import time
+
 from flask import g
-from sqlalchemy.dialects.postgresql import insert
+from drift.core.extensions.driftconfig import get_tenant_config_value, get_feature_switch
+from sqlalchemy import and_, case, cast, delete, func, literal, or_, select, tuple_
+from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg, insert
 from sqlalchemy.exc import OperationalError
 
 from driftbase.models.db import Counter, CorePlayer, PlayerCounter, CounterEntry
+from driftbase.utils.background import run_in_background
+from driftbase.utils.redis_utils import PubSubListener
 
 COUNTER_CACHE_TTL = 60 * 10
+# Each worker keeps its own copy of the catalog, which is normally invalidated when new counters are created
+COUNTER_LOCAL_CACHE_TTL = 60
+# How long a worker remembers that a counter doesn't exist
+COUNTER_MISSING_CACHE_TTL = 10
+MAX_MISSING_COUNTERS = 10000
 
 TOTAL_TIMESTAMP = datetime.datetime.strptime("2000-01-01", "%Y-%m-%d")
 COUNTER_PERIODS = ['total', 'month', 'day', 'hour', 'minute', 'second']
+# With rollups enabled, only these periods are written when counting, see rollup_counter_entries()
+ROLLUP_HOT_PERIODS = ['total', 'second']
+# Each period is rolled up from the next finer one
+ROLLUP_SOURCE_PERIODS = dict(minute='second', hour='minute', day='hour', month='day')
+# How late a bucket may still receive counts, f.ex. from the write-behind buffer, after its time has passed
+ROLLUP_LAG_SECONDS = 120
+ROLLUP_LOCK_TIMEOUT = 300
 
 MAX_RETRIES = 3
 
+# Write-behind buffering of counter entries, see buffer_counter_entries()
+COUNTERS_DEFAULTS = dict(counters=dict(
+    write_behind_flush_interval_seconds=10,  # Flush the buffer at least this often while it's being written to
+    write_behind_flush_size=5000,  # Flush the buffer once it holds this many distinct counter entry buckets
+    rollup_interval_seconds=60,  # Roll the fine buckets up into the coarser periods at least this often
+    rollup_second_retention_hours=24,  # Delete 10-second buckets once they are this old and rolled up
+    rollup_minute_retention_hours=24 * 7,  # Delete minute buckets once they are this old and rolled up
+))
+WRITE_BEHIND_UPSERT_CHUNK_SIZE = 1000
+WRITE_BEHIND_FLUSH_LOCK_TIMEOUT = 60
+
+# Redis keys used by the write-behind buffer:
+# counters:buffer:incr: {counter_id|player_id|period|date_time: delta} - HASH of pending increments
+# counters:buffer:abs: {counter_id|player_id|period|date_time: value} - HASH of pending absolute values
+# counters:buffer:players: [counter_id|player_id, ...] - SET of pending player counters
+# counters:buffer:inflight:* - The buffers being flushed. If a flush dies half-way, these are left behind and picked
+#   up again by the next flush, so buffered counts are not lost.
+# counters:buffer:flushed - Marker with a TTL of the flush interval, used to schedule the next flush
+WRITE_BEHIND_BUFFERS = ("incr", "abs", "players")
+
+# Redis keys used by the rollups:
+# counters:rollup:since - When the last rollup started. Buckets counted into since then are rolled up by the next one.
+# counters:rollup:done - Marker with a TTL of the rollup interval, used to schedule the next rollup
+
 log = logging.getLogger(__name__)
 
+class _CounterCache(object):
+    """
+    Per-worker copy of the counter catalog of a tenant.
+
+    The copy is dropped when a newer catalog version is announced on the invalidation channel, which happens when
+    new counters are created. Counters which weren't found are remembered for a short while so that lookups of
+    non-existent counters don't all end up reloading the catalog from the db.
+    """
+
+    def __init__(self, conn, channel):
+        self.counters = None
+        self.version = 0
+        self.expires = 0
+        self.missing = {}
+        self._listener = PubSubListener(conn, channel, self._on_version, self.clear)
+
+    def ensure_listening(self):
+        self._listener.ensure_listening()
+
+    def clear(self):
+        self.counters = None
+        self.missing = {}
+
+    def _on_version(self, version):
+        if int(version) > self.version:
+            self.clear()
+
+
+_counter_caches = {}
+
+
+def _get_local_counter_cache():
+    channel = g.redis.make_key("counters:invalidate")
+    cache = _counter_caches.get(channel)
+    if cache is None:
+        cache = _counter_caches[channel] = _CounterCache(g.redis.conn, channel)
+    cache.ensure_listening()
+    return cache
+
+
+def _index_counters(counters):
+    """ Index the counters by id, both as int and as string, and by name """
+    all_counters = {}
+    for counter in counters:
+        all_counters[counter["counter_id"]] = counter
+        all_counters[six.text_type(counter["counter_id"])] = counter
+        all_counters[counter["name"]] = counter
+    return all_counters
+
+
 def get_all_counters(force=False):
     def get_all_counters_from_db():
         counters = g.db.query(Counter).all()
@@ -31,10 +125,14 @@ def get_all_counters(force=False):
             all_counters[c.name] = counter
         return all_counters
 
+    cache = _get_local_counter_cache()
+    if not force and cache.counters is not None and cache.expires > time.time():
+        return cache.counters
+
+    version = int(g.redis.conn.get(_make_counters_version_key()) or 0)
     val = g.redis.get("counters")
     if not val or force:
         all_counters = get_all_counters_from_db()
-        # FIXME: Since trying to fetch a non-existing counter will cause a cache refresh, what's the point of the TTL?
         g.redis.set("counters", json.dumps(all_counters), expire=COUNTER_CACHE_TTL)
     else:
         try:
@@ -42,18 +140,42 @@ def get_all_counters(force=False):
         except Exception:
             log.error("Cannot decode '%s'", val)
             raise
+    all_counters = _index_counters(all_counters.values())
+
+    cache.counters = all_counters
+    cache.version = version
+    cache.expires = time.time() + COUNTER_LOCAL_CACHE_TTL
     return all_counters
 
 
 def get_counter(counter_key):
+    counter_key = six.text_type(counter_key)
     counters = get_all_counters()
     try:
-        return counters[six.text_type(counter_key)]
+        return counters[counter_key]
     except KeyError:
+        cache = _get_local_counter_cache()
+        if cache.missing.get(counter_key, 0) > time.time():
+            return None
         log.info("Counter '%s' not found in cache. Fetching from db", counter_key)
-        log.info("Counter cache contains: %s" % (counters.keys()))
         counters = get_all_counters(force=True)
-        return counters.get(counter_key, None)
+        counter = counters.get(counter_key, None)
+        if counter is None:
+            if len(cache.missing) >= MAX_MISSING_COUNTERS:
+                cache.missing = {}
+            cache.missing[counter_key] = time.time() + COUNTER_MISSING_CACHE_TTL
+        return counter
+
+
+def _invalidate_counter_caches():
+    """ Drop the shared and every worker's copy of the counter catalog """
+    version = g.redis.conn.incr(_make_counters_version_key())
+    g.redis.delete("counters")
+    g.redis.conn.publish(g.redis.make_key("counters:invalidate"), version)
+
+
+def _make_counters_version_key():
+    return g.redis.make_key("counters:version")
 
 
 def get_player(player_id):
@@ -64,6 +186,8 @@ def get_player(player_id):
 def batch_get_or_create_counters(counters, db_session=None):
     """
     return [(counter_id, name), ...]
+
+    If any of the counters are new, the session is committed and the counter caches invalidated.
     """
     if not db_session:
         db_session = g.db
@@ -74,13 +198,18 @@ def batch_get_or_create_counters(counters, db_session=None):
     # https://dba.stackexchange.com/questions/194756/deadlock-with-multi-row-inserts-despite-on-conflict-do-nothing/195220#195220
     counters.sort(key=lambda x: x[0])
     values = [{"name": name, "counter_type": counter_type} for (name, counter_type) in counters]
+    known_counters = get_all_counters()
     for retry in range(0, MAX_RETRIES):
         try:
             insert_clause = insert(Counter).returning(Counter.counter_id, Counter.name).values(values)
             # This is essentially a no-op, but it's required to ensure we get all the IDs back in the result
             update_clause = insert_clause.on_conflict_do_update(index_elements=['name'],
                                                                 set_=dict(name=insert_clause.excluded.name))
-            result = db_session.execute(update_clause)
+            result = db_session.execute(update_clause).fetchall()
+            if any(name not in known_counters for (name, _) in counters):
+                # Make the new counters visible to everyone before announcing them
+                db_session.commit()
+                _invalidate_counter_caches()
             return result
         except OperationalError:
             log.info(f"Failed to upsert counters due to concurrency conflicts, retrying {retry + 1}/{MAX_RETRIES}...")
@@ -103,10 +232,19 @@ def batch_update_counter_entries(player_id, entries, db_session=None):
     if not db_session:
         db_session = g.db
 
+    absolute_values, counter_values = _make_counter_entry_values(player_id, entries)
+    _upsert_counter_entries(absolute_values, counter_values, db_session)
+    db_session.commit()
+    if rollups_enabled():
+        schedule_rollup()
+
+
+def _make_counter_entry_values(player_id, entries):
     absolute_values = []
     counter_values = []
+    periods = ROLLUP_HOT_PERIODS if rollups_enabled() else COUNTER_PERIODS
     for k, e in entries.items():
-        for period in COUNTER_PERIODS:
+        for period in periods:
             date_time = get_date_time_for_period(period, e["timestamp"])
             entry = dict(counter_id=e["counter_id"], player_id=player_id, period=period, date_time=date_time,
                          value=e["value"])
@@ -114,7 +252,10 @@ def batch_update_counter_entries(player_id, entries, db_session=None):
                 absolute_values.append(entry)
             else:
                 counter_values.append(entry)
+    return absolute_values, counter_values
+
 
+def _upsert_counter_entries(absolute_values, counter_values, db_session):
     if len(absolute_values):
         insert_clause = insert(CounterEntry).values(absolute_values)
         update_clause = insert_clause.on_conflict_do_update(
@@ -129,7 +270,229 @@ def batch_update_counter_entries(player_id, entries, db_session=None):
             set_=dict(value=CounterEntry.value + insert_clause.excluded.value))
         db_session.execute(update_clause)
 
-    db_session.commit()
+
+def write_behind_enabled():
+    return get_feature_switch('enable_counter_write_behind')
+
+
+def rollups_enabled():
+    return get_feature_switch('enable_counter_rollups')
+
+
+def _get_counters_config_value(config_key):
+    return get_tenant_config_value("counters", config_key, COUNTERS_DEFAULTS)
+
+
+def _make_buffer_key(name):
+    return g.redis.make_key(f"counters:buffer:{name}")
+
+
+def _make_buffer_field(counter_id, player_id, period, date_time):
+    return f"{counter_id}|{player_id}|{period}|{date_time.isoformat()}"
+
+
+def _parse_buffer_field(field):
+    counter_id, player_id, period, date_time = field.split("|")
+    return dict(counter_id=int(counter_id), player_id=int(player_id), period=period,
+                date_time=datetime.datetime.fromisoformat(date_time))
+
+
+def buffer_counter_entries(player_id, entries):
+    """
+    Write-behind alternative to batch_create_player_counters and batch_update_counter_entries.
+
+    Merges the entries into a Redis buffer, keyed by counter, player, period and bucket, which is flushed to the
+    database in bulk by flush_counter_buffer(), in the background. Absolute values replace any increments buffered
+    before them for the same bucket, so applying absolute values before increments on flush preserves the ordering
+    of the updates.
+    Values will not be visible in the database until the buffer has been flushed.
+    """
+    incr_key = _make_buffer_key("incr")
+    abs_key = _make_buffer_key("abs")
+    players_key = _make_buffer_key("players")
+    absolute_values, counter_values = _make_counter_entry_values(player_id, entries)
+    with g.redis.conn.pipeline(transaction=True) as pipe:
+        pipe.sadd(players_key, *[f"{e['counter_id']}|{player_id}" for e in entries.values()])
+        for entry in absolute_values:
+            field = _make_buffer_field(entry["counter_id"], player_id, entry["period"], entry["date_time"])
+            pipe.hset(abs_key, field, entry["value"])
+            pipe.hdel(incr_key, field)
+        for entry in counter_values:
+            field = _make_buffer_field(entry["counter_id"], player_id, entry["period"], entry["date_time"])
+            pipe.hincrbyfloat(incr_key, field, entry["value"])
+        pipe.hlen(incr_key)
+        pipe.hlen(abs_key)
+        result = pipe.execute()
+    num_buffered = result[-1] + result[-2]
+
+    flush_marker_key = _make_buffer_key("flushed")
+    flush_interval = _get_counters_config_value("write_behind_flush_interval_seconds")
+    interval_elapsed = g.redis.conn.set(flush_marker_key, 1, ex=flush_interval, nx=True)
+    if interval_elapsed or num_buffered >= _get_counters_config_value("write_behind_flush_size"):
+        run_in_background(g.redis.make_key("counters:flush"), flush_counter_buffer)
+
+
+def flush_counter_buffer(db_session=None):
+    """
+    Write all buffered counter entries to the database as merged upserts.
+
+    Only one flush runs at a time; if another worker is already flushing, this is a no-op and the entries buffered
+    in the meantime will be picked up by the next flush.
+    Returns the number of counter entry rows written.
+    """
+    if not db_session:
+        db_session = g.db
+
+    lock = g.redis.lock("counters:buffer:flush", timeout=WRITE_BEHIND_FLUSH_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return 0
+    try:
+        inflight_keys = {name: _make_buffer_key(f"inflight:{name}") for name in WRITE_BEHIND_BUFFERS}
+        _get_take_over_buffers_script()(
+            keys=[_make_buffer_key(name) for name in WRITE_BEHIND_BUFFERS] + list(inflight_keys.values()))
+        with g.redis.conn.pipeline() as pipe:
+            pipe.smembers(inflight_keys["players"])
+            pipe.hgetall(inflight_keys["abs"])
+            pipe.hgetall(inflight_keys["incr"])
+            buffered_players, buffered_absolute, buffered_increments = pipe.execute()
+
+        player_counter_values = []
+        for member in buffered_players:
+            counter_id, player_id = member.split("|")
+            player_counter_values.append(dict(counter_id=int(counter_id), player_id=int(player_id)))
+        absolute_values = [dict(_parse_buffer_field(field), value=float(value))
+                           for field, value in buffered_absolute.items()]
+        counter_values = [dict(_parse_buffer_field(field), value=float(value))
+                          for field, value in buffered_increments.items()]
+
+        chunk_size = WRITE_BEHIND_UPSERT_CHUNK_SIZE
+        for i in range(0, len(player_counter_values), chunk_size):
+            insert_clause = insert(PlayerCounter).values(player_counter_values[i: i + chunk_size])
+            db_session.execute(insert_clause.on_conflict_do_nothing(index_elements=['counter_id', 'player_id']))
+        for i in range(0, len(absolute_values), chunk_size):
+            _upsert_counter_entries(absolute_values[i: i + chunk_size], [], db_session)
+        for i in range(0, len(counter_values), chunk_size):
+            _upsert_counter_entries([], counter_values[i: i + chunk_size], db_session)
+        db_session.commit()
+        g.redis.conn.delete(*inflight_keys.values())
+
+        num_rows = len(absolute_values) + len(counter_values)
+        if num_rows:
+            log.info("Flushed %s buffered counter entries for %s player counters",
+                     num_rows, len(player_counter_values))
+    finally:
+        if lock.owned():
+            lock.release()
+    if rollups_enabled():
+        schedule_rollup()
+    return num_rows
+
+
+@functools.lru_cache
+def _get_take_over_buffers_script():
+    """
+    Move the buffers, KEYS[1..n], to the in-flight buffers, KEYS[n+1..2n], all at once so that entries buffered in
+    the meantime aren't split between flushes. A previous flush which failed before completing leaves the in-flight
+    buffers behind, in which case those are retried before taking over the current buffers.
+    """
+    return g.redis.conn.register_script(textwrap.dedent("""
+        local n = #KEYS / 2
+        for i = 1, n do
+            if redis.call('EXISTS', KEYS[n + i]) == 1 then
+                return 0
+            end
+        end
+        for i = 1, n do
+            if redis.call('EXISTS', KEYS[i]) == 1 then
+                redis.call('RENAME', KEYS[i], KEYS[n + i])
+            end
+        end
+        return 1
+        """))
+
+
+def schedule_rollup():
+    """
+    Roll up the counter entries in the background if it's been more than the rollup interval since the last rollup.
+    """
+    marker_key = _make_rollup_key("done")
+    if g.redis.conn.set(marker_key, 1, ex=_get_counters_config_value("rollup_interval_seconds"), nx=True):
+        run_in_background(g.redis.make_key("counters:rollup"), rollup_counter_entries)
+
+
+def rollup_counter_entries(db_session=None, now=None):
+    """
+    Derive the minute, hour, day and month buckets from the 10-second ones, and delete old fine buckets.
+
+    With rollups enabled, counting only writes the total and the 10-second buckets. Each rollup recomputes the
+    coarser buckets, from the next finer period, for the player counters which have been counted since the previous
+    rollup, so the buckets read through the API are the same as if they had been counted directly, only later.
+    Only one rollup runs at a time; if another worker is already rolling up, this is a no-op.
+    Returns the number of buckets written.
+    """
+    if not db_session:
+        db_session = g.db
+    now = now or datetime.datetime.utcnow()
+
+    lock = g.redis.lock("counters:rollup", timeout=ROLLUP_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return 0
+    try:
+        since_key = _make_rollup_key("since")
+        since = g.redis.conn.get(since_key)
+        second_retention = datetime.timedelta(hours=_get_counters_config_value("rollup_second_retention_hours"))
+        if since:
+            since = datetime.datetime.fromisoformat(since) - datetime.timedelta(seconds=ROLLUP_LAG_SECONDS)
+        else:
+            since = now - second_retention
+        since = max(since, now - second_retention)  # Older buckets may be gone, so they can't be recomputed
+
+        touched = select(CounterEntry.counter_id, CounterEntry.player_id) \
+            .where(CounterEntry.period == "second", CounterEntry.date_time >= since) \
+            .distinct()
+        num_rows = 0
+        for period in ("minute", "hour", "day", "month"):
+            num_rows += db_session.execute(
+                _make_rollup_statement(period, ROLLUP_SOURCE_PERIODS[period], since, touched)).rowcount
+
+        # Only delete buckets which have been rolled up into the next period
+        minute_retention = datetime.timedelta(hours=_get_counters_config_value("rollup_minute_retention_hours"))
+        db_session.execute(delete(CounterEntry).where(
+            or_(and_(CounterEntry.period == "second", CounterEntry.date_time < min(now - second_retention, since)),
+                and_(CounterEntry.period == "minute", CounterEntry.date_time < min(now - minute_retention, since)))))
+        db_session.commit()
+        g.redis.conn.set(since_key, now.isoformat())
+        log.info("Rolled up %s counter entry buckets counted since %s", num_rows, since)
+        return num_rows
+    finally:
+        if lock.owned():
+            lock.release()
+
+
+def _make_rollup_statement(period, source_period, since, touched):
+    """
+    Upsert the 'period' buckets from 'since' on, aggregated from the 'source_period' buckets of the touched player
+    counters. Counts are summed, and absolute counters take the latest value.
+    """
+    date_time = func.date_trunc(period, CounterEntry.date_time)
+    latest_value = array_agg(aggregate_order_by(CounterEntry.value, CounterEntry.date_time.desc()))[1]
+    value = case((Counter.counter_type == "absolute", latest_value), else_=func.sum(CounterEntry.value))
+    rollup = select(CounterEntry.counter_id, CounterEntry.player_id,
+                    cast(literal(period), CounterEntry.period.type), date_time, value) \
+        .join(Counter, Counter.counter_id == CounterEntry.counter_id) \
+        .where(CounterEntry.period == source_period,
+               CounterEntry.date_time >= func.date_trunc(period, since),
+               tuple_(CounterEntry.counter_id, CounterEntry.player_id).in_(touched)) \
+        .group_by(CounterEntry.counter_id, CounterEntry.player_id, date_time, Counter.counter_type)
+    insert_clause = insert(CounterEntry).from_select(
+        ["counter_id", "player_id", "period", "date_time", "value"], rollup)
+    return insert_clause.on_conflict_do_update(
+        index_elements=['counter_id', 'player_id', 'period', 'date_time'],
+        set_=dict(value=insert_clause.excluded.value))
+
+
+def _make_rollup_key(name):
+    return g.redis.make_key(f"counters:rollup:{name}")
 
 
 def get_date_time_for_period(period, timestamp):
@@ -162,7 +525,8 @@ def add_count(counter_id, player_id, timestamp, value, is_absolute=False,
         db_session = g.db
     log.debug("add_count(%s, %s, %s, %s, %s, %s)" %
               (counter_id, player_id, timestamp, value, is_absolute, context_id))
-    for period in COUNTER_PERIODS:
+    periods = ROLLUP_HOT_PERIODS if rollups_enabled() else COUNTER_PERIODS
+    for period in periods:
         date_time = get_date_time_for_period(period, timestamp)
         row = db_session.query(CounterEntry).filter(CounterEntry.counter_id == counter_id,
                                                     CounterEntry.player_id == player_id,
@@ -0,0 +1,200 @@
+"""
+    Redis stream backed queue for webhook events, so that they can be acknowledged right away and processed
+    outside the webhook request.
+"""
+
+import json
+import logging
+import time
+
+import gevent
+import prometheus_client
+import redis
+from drift.core.extensions.driftconfig import get_feature_switch
+from flask import g
+
+from driftbase.utils.background import spawn_for_tenant
+
+log = logging.getLogger(__name__)
+
+# Redis keys used by the queue:
+# event-queue:<stream>: STREAM of received events, read through the 'workers' consumer group
+# event-queue:<stream>:dead: STREAM of events which failed to process MAX_DELIVERIES times
+# event-queue:<stream>:worker - Lock held by the worker processing the stream. The events are processed by one worker
+#   at a time, in the order they were received, so the events for any one player are processed in order.
+CONSUMER_GROUP = "workers"
+# Only the worker holding the lock reads the stream, so all workers can share the consumer, and its pending entries
+# are the ones which the previous worker failed to process
+CONSUMER_NAME = "worker"
+STREAM_MAX_LENGTH = 100000
+READ_COUNT = 100
+MAX_DELIVERIES = 5
+RETRY_DELAY_SECONDS = 1.0
+# How long a worker waits for new events before it exits
+WORKER_IDLE_TIMEOUT_SECONDS = 5.0
+WORKER_LOCK_TIMEOUT = 60
+
+QUEUE_DEPTH = prometheus_client.Gauge(
+    "driftbase_event_queue_depth",
+    "Number of events received but not yet processed",
+    ["tenant", "stream"]
+)
+PROCESSING_LAG = prometheus_client.Histogram(
+    "driftbase_event_queue_lag_seconds",
+    "Time from receiving an event until it has been processed",
+    ["tenant", "stream"]
+)
+
+_handlers = {}
+_workers = {}
+# Streams which have received events while their worker was running
+_wakeups = set()
+
+
+def async_events_enabled():
+    return get_feature_switch('enable_async_matchmaking_events')
+
+
+def register_handler(stream, handler):
+    """ Register 'handler' to be called with each event enqueued in 'stream'. """
+    _handlers[stream] = handler
+
+
+def enqueue_event(stream, event):
+    """
+    Add the event to the stream and make sure a worker is processing it.
+    """
+    g.redis.conn.xadd(_make_stream_key(stream), {"event": json.dumps(event)},
+                      maxlen=STREAM_MAX_LENGTH, approximate=True)
+    _start_worker(stream)
+
+
+def _start_worker(stream):
+    worker_key = _make_stream_key(stream)
+    worker = _workers.get(worker_key)
+    if worker is not None and not worker.dead:
+        _wakeups.add(worker_key)  # Make sure the running worker picks the event up, even if it's about to exit
+        return
+    _workers[worker_key] = spawn_for_tenant(_run_worker, stream, worker_key)
+
+
+def _run_worker(stream, worker_key):
+    while True:
+        _wakeups.discard(worker_key)
+        try:
+            process_event_stream(stream)
+        except Exception:
+            log.exception(f"Event queue worker for '{stream}' failed")
+        if worker_key not in _wakeups:
+            break
+
+
+def process_event_stream(stream, idle_timeout=WORKER_IDLE_TIMEOUT_SECONDS):
+    """
+    Process the events in the stream, until no new events have arrived for 'idle_timeout' seconds.
+
+    Events which fail to process are retried, stalling the stream to preserve the ordering of events, until they have
+    been attempted MAX_DELIVERIES times, at which point they are moved to the dead letter stream.
+    Only one worker processes a stream at a time; if another worker doesn't finish within twice the idle timeout,
+    this is a no-op. The worker lock is renewed before every event, and processing stops if it has been lost.
+    Returns the number of events processed.
+    """
+    stream_key = _make_stream_key(stream)
+    lock = g.redis.conn.lock(_make_stream_key(stream, "worker"), timeout=WORKER_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=True, blocking_timeout=idle_timeout * 2):
+        return 0
+    num_processed = 0
+    try:
+        _ensure_consumer_group(stream_key)
+        block = int(idle_timeout * 1000) or None
+        read_from = "0"  # Start with the entries which the previous worker failed to process
+        while True:
+            if not _renew_lock(lock, stream):
+                break
+            response = g.redis.conn.xreadgroup(CONSUMER_GROUP, CONSUMER_NAME, {stream_key: read_from},
+                                               count=1 if read_from == "0" else READ_COUNT,
+                                               block=None if read_from == "0" else block)
+            entries = response[0][1] if response else []
+            if not entries:
+                if read_from == "0":
+                    read_from = ">"
+                    continue
+                break
+            for entry_id, fields in entries:
+                # The lock is renewed for every event, so that a batch of slow events can't outlive it
+                if not _renew_lock(lock, stream):
+                    return num_processed
+                if not _process_entry(stream, stream_key, entry_id, fields):
+                    gevent.sleep(RETRY_DELAY_SECONDS)
+                    read_from = "0"
+                    break
+                num_processed += 1
+        return num_processed
+    finally:
+        if lock.owned():
+            lock.release()
+        _update_queue_depth(stream, stream_key)
+
+
+def _renew_lock(lock, stream):
+    """ Renew the worker lock, returning False if another worker may have taken over the stream. """
+    try:
+        lock.reacquire()
+    except redis.exceptions.LockError:
+        log.warning(f"Event queue worker for '{stream}' lost its lock, stopping")
+        return False
+    return True
+
+
+def _process_entry(stream, stream_key, entry_id, fields):
+    """ Process a single event, returning False if it should be retried. """
+    if not fields or "event" not in fields:  # Trimmed from the stream while pending
+        g.redis.conn.xack(stream_key, CONSUMER_GROUP, entry_id)
+        return True
+    try:
+        _handlers[stream](json.loads(fields["event"]))
+    except Exception as e:
+        log.exception(f"Failed to process event {entry_id} in '{stream}'")
+        g.db.rollback()
+        pending = g.redis.conn.xpending_range(stream_key, CONSUMER_GROUP, min=entry_id, max=entry_id, count=1)
+        deliveries = pending[0]["times_delivered"] if pending else MAX_DELIVERIES
+        if deliveries < MAX_DELIVERIES:
+            return False
+        log.error(f"Giving up on event {entry_id} in '{stream}' after {deliveries} attempts")
+        with g.redis.conn.pipeline() as pipe:
+            pipe.xadd(_make_stream_key(stream, "dead"), dict(fields, entry_id=entry_id, error=repr(e)),
+                      maxlen=STREAM_MAX_LENGTH, approximate=True)
+            pipe.xack(stream_key, CONSUMER_GROUP, entry_id)
+            pipe.execute()
+        return True
+
+    g.redis.conn.xack(stream_key, CONSUMER_GROUP, entry_id)
+    received = int(entry_id.split("-")[0]) / 1000.0
+    PROCESSING_LAG.labels(_get_tenant_name(), stream).observe(max(time.time() - received, 0))
+    return True
+
+
+def _ensure_consumer_group(stream_key):
+    try:
+        g.redis.conn.xgroup_create(stream_key, CONSUMER_GROUP, id="0", mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def _update_queue_depth(stream, stream_key):
+    try:
+        groups = g.redis.conn.xinfo_groups(stream_key)
+    except redis.exceptions.ResponseError:
+        return  # No stream
+    for group in groups:
+        if group["name"] == CONSUMER_GROUP:
+            QUEUE_DEPTH.labels(_get_tenant_name(), stream).set(group["pending"] + (group.get("lag") or 0))
+
+
+def _make_stream_key(stream, name=None):
+    return g.redis.make_key(f"event-queue:{stream}" + (f":{name}" if name else ""))
+
+
+def _get_tenant_name():
+    return g.conf.tenant.get('tenant_name')
@@ -0,0 +1,130 @@
+"""
+    Per-endpoint request instrumentation.
+
+    Records the latency of each request and the number of SQL statements and Redis commands it ran, labeled by the
+    blueprint endpoint, and flags requests which run the same SQL statement over and over (N+1 queries).
+    Streamed responses, such as long polls, are recorded once the response has been sent.
+"""
+
+import collections
+import functools
+import logging
+import time
+
+import flask
+import prometheus_client
+import redis
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+
+# A request running the same SQL statement at least this many times is counted as an N+1 pattern
+N_PLUS_ONE_THRESHOLD = 10
+
+_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+REQUEST_LATENCY = prometheus_client.Histogram(
+    "driftbase_request_duration_seconds",
+    "Time spent serving requests",
+    ["endpoint", "method", "status"]
+)
+REQUEST_SQL_STATEMENTS = prometheus_client.Histogram(
+    "driftbase_request_sql_statements",
+    "Number of SQL statements executed per request",
+    ["endpoint"],
+    buckets=_COUNT_BUCKETS
+)
+REQUEST_REDIS_COMMANDS = prometheus_client.Histogram(
+    "driftbase_request_redis_commands",
+    "Number of Redis commands executed per request",
+    ["endpoint"],
+    buckets=_COUNT_BUCKETS
+)
+REQUEST_N_PLUS_ONE = prometheus_client.Counter(
+    "driftbase_request_n_plus_one",
+    "Requests which executed the same SQL statement at least N_PLUS_ONE_THRESHOLD times",
+    ["endpoint"]
+)
+
+_hooks_installed = False
+
+
+class _RequestStats(object):
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.num_redis_commands = 0
+        self.sql_statements = collections.Counter()
+
+
+def drift_init_extension(app, **kwargs):
+    _install_hooks()
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+
+def _install_hooks():
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    event.listen(Engine, "before_cursor_execute", _on_cursor_execute)
+    # redis-py has no hooks for observing commands, so we wrap the methods all commands go through. Pipelines queue
+    # their commands through their own execute_command and send them in execute().
+    redis.Redis.execute_command = _wrap_redis_call(redis.Redis.execute_command, lambda client: 1)
+    redis.client.Pipeline.execute = _wrap_redis_call(redis.client.Pipeline.execute,
+                                                     lambda pipe: len(pipe.command_stack))
+    _hooks_installed = True
+
+
+def _get_request_stats():
+    if not flask.has_request_context():
+        return None
+    return flask.g.get("request_stats")
+
+
+def _on_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _get_request_stats()
+    if stats is not None:
+        stats.sql_statements[statement] += 1
+
+
+def _wrap_redis_call(method, count_commands):
+    @functools.wraps(method)
+    def wrapper(client, *args, **kwargs):
+        stats = _get_request_stats()
+        if stats is not None:
+            stats.num_redis_commands += count_commands(client)
+        return method(client, *args, **kwargs)
+    return wrapper
+
+
+def _before_request():
+    flask.g.request_stats = _RequestStats()
+
+
+def _after_request(response):
+    stats = flask.g.get("request_stats")
+    if stats is None:
+        return response
+    record_stats = functools.partial(_record_request_stats, stats, request.endpoint or "unmatched", request.method,
+                                     response.status_code)
+    if response.is_streamed:
+        # Long polls and event streams do their work while the body is streamed, after the request has been handled
+        response.call_on_close(record_stats)
+    else:
+        flask.g.pop("request_stats")
+        record_stats()
+    return response
+
+
+def _record_request_stats(stats, endpoint, method, status_code):
+    REQUEST_LATENCY.labels(endpoint, method, status_code).observe(time.perf_counter() - stats.start)
+    REQUEST_SQL_STATEMENTS.labels(endpoint).observe(sum(stats.sql_statements.values()))
+    REQUEST_REDIS_COMMANDS.labels(endpoint).observe(stats.num_redis_commands)
+    if stats.sql_statements:
+        statement, times = stats.sql_statements.most_common(1)[0]
+        if times >= N_PLUS_ONE_THRESHOLD:
+            REQUEST_N_PLUS_ONE.labels(endpoint).inc()
+            log.warning("%s %s executed the same statement %s times: %s",
+                        method, endpoint, times, statement[:200])
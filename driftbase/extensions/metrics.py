@@ -1,4 +1,7 @@
+import json
 import logging
+import threading
+import time
 from datetime import datetime, timedelta, timezone
 
 import prometheus_client
@@ -12,13 +15,21 @@ from sqlalchemy import select, distinct, cast, Date
 from sqlalchemy.sql.functions import count
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 
-from driftbase.config import DEFAULT_CLIENT_HEARTBEAT_TIMEOUT_SECONDS
+from driftbase.clients import CLIENTS_DEFAULTS
+from driftbase.config import DEFAULT_CLIENT_HEARTBEAT_PERIOD, DEFAULT_CLIENT_HEARTBEAT_TIMEOUT_SECONDS
 from driftbase.models.db import tbl_client, tbl_user, tbl_user_identity
 
 log = logging.getLogger(__name__)
 
 _registered = False
 
+# How long a scrape result is served to other scrapers before the metrics are computed again
+SCRAPE_CACHE_SECONDS = 30
+# With client heartbeats recorded in Redis, the heartbeats in the db lag by up to the flush interval plus a heartbeat
+# period, so online clients are counted within that much of the timeout, the same as client_heartbeat_filter() does
+CLIENT_HEARTBEAT_FLUSH_LAG_SECONDS = \
+    CLIENTS_DEFAULTS["clients"]["heartbeat_flush_interval_seconds"] + DEFAULT_CLIENT_HEARTBEAT_PERIOD
+
 
 def drift_init_extension(app, **kwargs):
     app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {'/metrics': make_wsgi_app()})
@@ -36,12 +47,46 @@ def drift_init_extension(app, **kwargs):
         _registered = True
 
 
+def _make_active_users_query(now):
+    """
+    Count the active users per identity type for all the calendar and rolling periods in a single pass over the
+    identities which have logged on since the start of the longest period.
+    """
+    period_starts = {
+        'day': now.date(),
+        'week': (now - timedelta(days=now.weekday())).date(),
+        'month': (now - timedelta(days=now.day - 1)).date(),
+    }
+    rolling_starts = {days: now - timedelta(days=days) for days in (1, 7, 30)}
+    earliest = min(min(period_starts.values()), min(rolling_starts.values()).date())
+    logon_date = tbl_user_identity.c.logon_date
+    user_id = tbl_user.c.user_id
+    columns = [
+        count(distinct(user_id)).filter(cast(logon_date, Date()) >= start).label(period)
+        for period, start in period_starts.items()
+    ] + [
+        count(distinct(user_id)).filter(logon_date >= start).label(f"rolling_{days}")
+        for days, start in rolling_starts.items()
+    ]
+    return (
+        select(tbl_user_identity.c.identity_type, *columns)
+        .join(tbl_user, tbl_user_identity.c.user_id == tbl_user.c.user_id)
+        .where(tbl_user_identity.c.user_id.isnot(None))
+        .where(logon_date >= datetime.combine(earliest, datetime.min.time()))
+        .group_by(tbl_user_identity.c.identity_type)
+    )
+
+
 class MetricsCollector(Collector):
 
     def __init__(self, app):
         self.app = app
         self.deployable_name = app.config.get('name')
         self.metric_prefix = f"{self.deployable_name.replace('-', '_')}"
+        self._engines = {}
+        self._lock = threading.Lock()
+        self._cached_metrics = None
+        self._cache_expires = 0
 
     def describe(self):
         """
@@ -60,6 +105,20 @@ class MetricsCollector(Collector):
         yield self._make_rolling_monthly_active_users_gauge()
 
     def collect(self):
+        """
+        Return the metrics for all tenants.
+
+        The metrics are computed at most once per SCRAPE_CACHE_SECONDS, concurrent scrapes wait for and share the
+        result of a single computation.
+        """
+        with self._lock:
+            if self._cached_metrics is None or time.monotonic() >= self._cache_expires:
+                self._cached_metrics = list(self._collect())
+                self._cache_expires = time.monotonic() + SCRAPE_CACHE_SECONDS
+            metrics = self._cached_metrics
+        yield from metrics
+
+    def _collect(self):
         """
         Iterate over all tenants and generate whatever metrics are desired.
         """
@@ -78,65 +137,44 @@ class MetricsCollector(Collector):
         rolling_daily_active_users = self._make_rolling_daily_active_users_gauge()
         rolling_weekly_active_users = self._make_rolling_weekly_active_users_gauge()
         rolling_monthly_active_users = self._make_rolling_monthly_active_users_gauge()
+        active_tenants = set()
         for tenant in tenant_rows:
             postgres_config = tenant.get('postgres')
-            if postgres_config:
-                # FIXME: Creating the engine each time is not really efficient, but since it happens
-                #        relatively seldom, a few times per minute at most, optimising it is not urgent.
-                db_engine = connect(postgres_config)
-                with db_engine.begin() as conn:
-                    num_users = conn.execute(
-                        select(count(tbl_user.c.user_id)).where(tbl_user.c.status == 'active')
-                    ).scalar_one()
-                users.add_metric([tier_name, tenant['tenant_name'].replace('-', '_')], num_users)
-
-                with db_engine.begin() as conn:
-                    num_clients = conn.execute(
-                        select(count(tbl_client.c.client_id)).where(tbl_client.c.status == 'active').where(
-                            tbl_client.c.heartbeat > datetime.utcnow() - timedelta(
-                                seconds=DEFAULT_CLIENT_HEARTBEAT_TIMEOUT_SECONDS))
-                    ).scalar_one()
-                clients.add_metric([tier_name, tenant['tenant_name'].replace('-', '_')], num_clients)
-
-                with db_engine.begin() as conn:
-                    identities_and_types = conn.execute(
-                        select(tbl_user_identity.c.identity_type, count(tbl_user_identity.c.identity_type)).where(
-                            tbl_user_identity.c.user_id.isnot(None)).group_by(
-                            tbl_user_identity.c.identity_type)
-                    ).all()
-                for entry in identities_and_types:
-                    identities.add_metric([tier_name, tenant['tenant_name'], entry.identity_type], entry.count)
-
-                now = datetime.now(timezone.utc)
-
-                for period, gauge in {'day': daily_active_users, 'week': weekly_active_users,
-                                      'month': monthly_active_users}.items():
-                    days_since_period_start = now.weekday() if period == 'week' else now.day - 1 if period == 'month' else 0
-                    period_start = (now - timedelta(days=days_since_period_start)).date()
-                    with db_engine.begin() as conn:
-                        logins_and_types = conn.execute(
-                            select(tbl_user_identity.c.identity_type, count(distinct(tbl_user.c.user_id)))
-                            .join(tbl_user, tbl_user_identity.c.user_id == tbl_user.c.user_id)
-                            .where(tbl_user_identity.c.user_id.isnot(None))
-                            .where(cast(tbl_user_identity.c.logon_date, Date()) >= period_start)
-                            .group_by(tbl_user_identity.c.identity_type)
-                        ).all()
-                    for entry in logins_and_types:
-                        gauge.add_metric([tier_name, tenant['tenant_name'], entry.identity_type], entry.count)
-
-                for period, gauge in {1: rolling_daily_active_users, 7: rolling_weekly_active_users,
-                                      30: rolling_monthly_active_users}.items():
-                    period_start = now - timedelta(days=period)
-                    with db_engine.begin() as conn:
-                        logins_and_types = conn.execute(
-                            select(tbl_user_identity.c.identity_type, count(distinct(tbl_user.c.user_id)))
-                            .join(tbl_user, tbl_user_identity.c.user_id == tbl_user.c.user_id)
-                            .where(tbl_user_identity.c.user_id.isnot(None))
-                            .where(tbl_user_identity.c.logon_date >= period_start)
-                            .group_by(tbl_user_identity.c.identity_type)
-                        ).all()
-                    for entry in logins_and_types:
-                        gauge.add_metric([tier_name, tenant['tenant_name'], entry.identity_type], entry.count)
+            if not postgres_config:
+                continue
+            active_tenants.add(tenant['tenant_name'])
+            db_engine = self._get_engine(tenant['tenant_name'], postgres_config)
+            now = datetime.now(timezone.utc)
+            with db_engine.begin() as conn:
+                num_users = conn.execute(
+                    select(count(tbl_user.c.user_id)).where(tbl_user.c.status == 'active')
+                ).scalar_one()
+                num_clients = conn.execute(
+                    select(count(tbl_client.c.client_id)).where(tbl_client.c.status == 'active').where(
+                        tbl_client.c.heartbeat > datetime.utcnow() - timedelta(
+                            seconds=DEFAULT_CLIENT_HEARTBEAT_TIMEOUT_SECONDS + CLIENT_HEARTBEAT_FLUSH_LAG_SECONDS))
+                ).scalar_one()
+                identities_and_types = conn.execute(
+                    select(tbl_user_identity.c.identity_type, count(tbl_user_identity.c.identity_type)).where(
+                        tbl_user_identity.c.user_id.isnot(None)).group_by(
+                        tbl_user_identity.c.identity_type)
+                ).all()
+                active_users = conn.execute(_make_active_users_query(now)).all()
+
+            users.add_metric([tier_name, tenant['tenant_name'].replace('-', '_')], num_users)
+            clients.add_metric([tier_name, tenant['tenant_name'].replace('-', '_')], num_clients)
+            for entry in identities_and_types:
+                identities.add_metric([tier_name, tenant['tenant_name'], entry.identity_type], entry.count)
+            for entry in active_users:
+                labels = [tier_name, tenant['tenant_name'], entry.identity_type]
+                daily_active_users.add_metric(labels, entry.day)
+                weekly_active_users.add_metric(labels, entry.week)
+                monthly_active_users.add_metric(labels, entry.month)
+                rolling_daily_active_users.add_metric(labels, entry.rolling_1)
+                rolling_weekly_active_users.add_metric(labels, entry.rolling_7)
+                rolling_monthly_active_users.add_metric(labels, entry.rolling_30)
+
+        self._dispose_engines(keep=active_tenants)
 
         yield users
         yield clients
@@ -148,6 +186,25 @@ class MetricsCollector(Collector):
         yield rolling_weekly_active_users
         yield rolling_monthly_active_users
 
+    def _get_engine(self, tenant_name, postgres_config):
+        """
+        Return the engine for the tenant, creating a new one if there is none, or if the tenant's config has changed.
+        """
+        config_key = json.dumps(postgres_config, sort_keys=True, default=str)
+        cached = self._engines.get(tenant_name)
+        if cached and cached[0] == config_key:
+            return cached[1]
+        if cached:
+            cached[1].dispose()
+        db_engine = connect(postgres_config)
+        self._engines[tenant_name] = (config_key, db_engine)
+        return db_engine
+
+    def _dispose_engines(self, keep):
+        for tenant_name in set(self._engines) - keep:
+            _, db_engine = self._engines.pop(tenant_name)
+            db_engine.dispose()
+
     def _make_users_gauge(self):
         return GaugeMetricFamily(
             f"{self.metric_prefix}_users",
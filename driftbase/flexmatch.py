@@ -1,6 +1,7 @@
 import copy
 import logging
 import boto3
+import gevent.event
 import json
 import re
 from collections import defaultdict
@@ -8,8 +9,8 @@ from botocore.exceptions import ClientError, ParamValidationError
 from flask import g, url_for
 from drift.core.extensions.driftconfig import get_tenant_config_value, get_feature_switch
 from aws_assume_role_lib import assume_role
-from driftbase.parties import get_player_party, get_party_members
-from driftbase.messages import post_message
+from driftbase.parties import get_player_party, get_party_members, make_player_party_key
+from driftbase.messages import post_messages_bulk, post_messages_batch
 from driftbase.models.db import CorePlayer
 from datetime import datetime, timezone, timedelta
 
@@ -53,6 +54,11 @@ EXPIRED_STATE = {
 
 AWS_HOME_REGION = "eu-west-1"
 
+# How long game sessions and their player sessions are cached, when the read cache is enabled
+GAME_SESSION_CACHE_TTL_SECONDS = 5
+PLAYER_SESSIONS_CACHE_TTL_SECONDS = 5
+COALESCED_REQUEST_TIMEOUT_SECONDS = 30
+
 log = logging.getLogger(__name__)
 
 # Latency reporting
@@ -398,6 +404,99 @@ def create_player_session(**kwargs):
         raise GameliftClientException("Invalid parameters to request", str(e))
     except ClientError as e:
         raise GameliftClientException("Failed to create player session", str(e))
+    finally:
+        if gamelift_read_cache_enabled() and kwargs.get("GameSessionId"):
+            g.redis.conn.delete(_make_player_sessions_cache_key(kwargs["GameSessionId"]))
+
+
+# Cached GameLift reads
+#
+# Game sessions and their player sessions are cached in Redis for a few seconds, and concurrent lookups of the same
+# game session within a worker share a single GameLift request. Queue events for a game session invalidate its cache.
+
+def gamelift_read_cache_enabled():
+    return get_feature_switch("enable_gamelift_read_cache")
+
+
+def get_game_session(game_session_arn: str) -> dict | None:
+    """ Return the game session with the given arn, or None if it doesn't exist. """
+    return get_game_sessions([game_session_arn])[game_session_arn]
+
+
+def get_game_sessions(game_session_arns: list[str]) -> dict[str, dict | None]:
+    """
+    Return a dict of game session arn to the game session, or None if it doesn't exist.
+
+    Cached game sessions are read in a single round trip. GameLift can only describe one game session by arn per
+    request, so each of the others is described separately.
+    """
+    game_session_arns = list(dict.fromkeys(game_session_arns))
+    if not gamelift_read_cache_enabled():
+        return {arn: _describe_game_session(arn) for arn in game_session_arns}
+
+    cache_keys = [_make_game_session_cache_key(arn) for arn in game_session_arns]
+    game_sessions = {}
+    for arn, cache_key, cached in zip(game_session_arns, cache_keys, g.redis.conn.mget(cache_keys)):
+        if cached is not None:
+            game_sessions[arn] = json.loads(cached)
+        else:
+            game_sessions[arn] = _coalesce(cache_key, _describe_game_session, arn,
+                                           ttl=GAME_SESSION_CACHE_TTL_SECONDS)
+    return game_sessions
+
+
+def get_player_sessions(game_session_arn: str) -> list[dict]:
+    """ Return the player sessions in the game session with the given arn. """
+    if not gamelift_read_cache_enabled():
+        return _describe_player_sessions(game_session_arn)
+
+    cache_key = _make_player_sessions_cache_key(game_session_arn)
+    cached = g.redis.conn.get(cache_key)
+    if cached is not None:
+        return json.loads(cached)
+    return _coalesce(cache_key, _describe_player_sessions, game_session_arn, ttl=PLAYER_SESSIONS_CACHE_TTL_SECONDS)
+
+
+def invalidate_game_session_cache(game_session_arn: str):
+    if gamelift_read_cache_enabled():
+        g.redis.conn.delete(_make_game_session_cache_key(game_session_arn),
+                            _make_player_sessions_cache_key(game_session_arn))
+
+
+def _describe_game_session(game_session_arn: str) -> dict | None:
+    game_sessions = describe_game_sessions(GameSessionId=game_session_arn)
+    if not isinstance(game_sessions, dict) or len(game_sessions.get("GameSessions", [])) != 1:
+        log.info(f"game session arn '{game_session_arn}' doesn't map to a single game session: '{game_sessions}'")
+        return None
+    return game_sessions["GameSessions"][0]
+
+
+def _describe_player_sessions(game_session_arn: str) -> list[dict]:
+    return describe_player_sessions(GameSessionId=game_session_arn)["PlayerSessions"]
+
+
+_requests_in_flight = {}
+
+
+def _coalesce(cache_key, fetch, *args, ttl):
+    """
+    Fetch and cache a value, or wait for the result if another greenlet in this worker is already fetching it.
+    """
+    in_flight = _requests_in_flight.get(cache_key)
+    if in_flight is not None:
+        return in_flight.get(timeout=COALESCED_REQUEST_TIMEOUT_SECONDS)
+    in_flight = _requests_in_flight[cache_key] = gevent.event.AsyncResult()
+    try:
+        value = fetch(*args)
+        # GameLift responses contain datetimes, which we don't use
+        g.redis.conn.set(cache_key, json.dumps(value, default=str), ex=ttl)
+        in_flight.set(value)
+        return value
+    except Exception as e:
+        in_flight.set_exception(e)
+        raise
+    finally:
+        del _requests_in_flight[cache_key]
 
 
 def check_event_tenant_account(event: dict) -> bool:
@@ -426,6 +525,12 @@ def _get_player_regions(player_id):
         return g.redis.conn.smembers(_make_player_regions_key(player_id))
     return set()
 
+def _make_game_session_cache_key(game_session_arn):
+    return g.redis.make_key(f"gamelift:game-session:{game_session_arn}")
+
+def _make_player_sessions_cache_key(game_session_arn):
+    return g.redis.make_key(f"gamelift:player-sessions:{game_session_arn}")
+
 def _make_player_latency_key(player_id):
     return g.redis.make_key(f"player:{player_id}:latencies:")
 
@@ -444,6 +549,16 @@ def _get_player_ticket_key(player_id):
         return _make_party_ticket_key(player_party_id)
     return _make_player_ticket_key(player_id)
 
+def _get_player_ticket_keys(player_ids):
+    """ Return {player_id: ticket key} for the players, looking up their parties in a single round trip. """
+    player_ids = list(player_ids)
+    with g.redis.conn.pipeline(transaction=False) as pipe:
+        for player_id in player_ids:
+            pipe.get(make_player_party_key(player_id))
+        party_ids = pipe.execute()
+    return {player_id: _make_party_ticket_key(int(party_id)) if party_id else _make_player_ticket_key(player_id)
+            for player_id, party_id in zip(player_ids, party_ids)}
+
 def _get_player_party_member_ids(player_id):
     """ Return the full list of players who share a party with 'player_id', including 'player_id'. If 'player_id' isn't
     a party member, the returned list will contain only 'player_id'"""
@@ -484,8 +599,18 @@ def _post_matchmaking_event_to_members(receiving_player_ids, event, event_data=N
         "event": event,
         "data": event_data or {}
     }
-    for receiver_id in receiving_player_ids:
-        post_message("players", int(receiver_id), "matchmaking", payload, expiry, sender_system=True)
+    post_messages_bulk("players", [int(receiver_id) for receiver_id in receiving_player_ids], "matchmaking", payload,
+                       expiry, sender_system=True)
+
+
+def _post_matchmaking_events_to_members(event, event_data_by_player_id, expiry=30):
+    """ Insert an event into the 'matchmaking' queue of the 'players' exchange, with per-player event data. """
+    log.info(f"Posting '{event}' to players {list(event_data_by_player_id)}")
+    payloads = {
+        int(receiver_id): {"event": event, "data": event_data or {}}
+        for receiver_id, event_data in event_data_by_player_id.items()
+    }
+    post_messages_batch("players", "matchmaking", payloads, expiry, sender_system=True)
 
 
 def _get_event_details(event):
@@ -501,14 +626,18 @@ def _is_backfill_ticket(ticket_id):
     return res is not None
 
 def _process_searching_event(event):
+    ticket_ids_by_player_id = {}
     for ticket_id, player in _ticket_players(event):
         player_id = int(player["playerId"])
         if _is_backfill_ticket(ticket_id):
             log.info(f"Ignoring backfill ticket {ticket_id} containing player {player_id}")
             continue
-        ticket_key = _get_player_ticket_key(player_id)
-        with _LockedTicket(ticket_key) as ticket_lock:
-            player_ticket = ticket_lock.ticket
+        ticket_ids_by_player_id[player_id] = ticket_id
+    ticket_keys = _get_player_ticket_keys(ticket_ids_by_player_id)
+    players_to_notify = []
+    with _LockedTickets(ticket_keys.values()) as ticket_locks:
+        for player_id, ticket_id in ticket_ids_by_player_id.items():
+            player_ticket = ticket_locks[ticket_keys[player_id]].ticket
             if player_ticket is None:  # Might be an event for an already deleted ticket.
                 log.warning(f"Ignoring 'SEARCHING' event on ticket {ticket_id} containing player {player_id} as this player has no ticket in our store.")
                 continue
@@ -525,7 +654,9 @@ def _process_searching_event(event):
             if player_ticket["Status"] != "SEARCHING":
                 log.info(f"Updating ticket {player_ticket['TicketId']} from {player_ticket['Status']} to SEARCHING")
                 player_ticket["Status"] = "SEARCHING"
-            _post_matchmaking_event_to_members([player_id], "MatchmakingSearching")
+            players_to_notify.append(player_id)
+    if players_to_notify:
+        _post_matchmaking_event_to_members(players_to_notify, "MatchmakingSearching")
 
 def _process_potential_match_event(event):
     playerids_by_teamid = defaultdict(set)
@@ -541,11 +672,11 @@ def _process_potential_match_event(event):
     acceptance_timeout = event.get("acceptanceTimeout", None)
     new_state = "REQUIRES_ACCEPTANCE" if acceptance_required else "PLACING"
     game_session_info = event["gameSessionInfo"]
-    for player in game_session_info["players"]:
-        player_id = int(player["playerId"])
-        ticket_key = _get_player_ticket_key(player_id)
-        with _LockedTicket(ticket_key) as ticket_lock:
-            player_ticket = ticket_lock.ticket
+    ticket_keys = _get_player_ticket_keys(int(player["playerId"]) for player in game_session_info["players"])
+    players_to_notify = []
+    with _LockedTickets(ticket_keys.values()) as ticket_locks:
+        for player_id, ticket_key in ticket_keys.items():
+            player_ticket = ticket_locks[ticket_key].ticket
             if player_ticket is None:  # This has to be a backfill ticket, i.e. not issued by us.
                 # We should consider iterating over tickets instead of players here
                 log.warning(f"PotentialMatchCreated event received for player {player_id} who has no ticket.")
@@ -570,14 +701,16 @@ def _process_potential_match_event(event):
                 player_ticket["MatchId"] = match_id
             else:
                 log.info(f"Party ticket {player_ticket['TicketId']} for player key {ticket_key} already updated.")
+            players_to_notify.append(player_id)
 
-            message_data = {
-                "teams": team_data,
-                "acceptance_required": acceptance_required,
-                "match_id":  match_id,
-                "acceptance_timeout": acceptance_timeout
-            }
-            _post_matchmaking_event_to_members([player_id], "PotentialMatchCreated", event_data=message_data)
+    if players_to_notify:
+        message_data = {
+            "teams": team_data,
+            "acceptance_required": acceptance_required,
+            "match_id":  match_id,
+            "acceptance_timeout": acceptance_timeout
+        }
+        _post_matchmaking_event_to_members(players_to_notify, "PotentialMatchCreated", event_data=message_data)
 
 def _process_matchmaking_succeeded_event(event):
     game_session_info = event["gameSessionInfo"]
@@ -595,11 +728,11 @@ def _process_matchmaking_succeeded_event(event):
             continue
         connection_info_by_player_id[player_id] = f"PlayerSessionId={player['playerSessionId']}?PlayerId={player_id}"
 
-    for player in game_session_info["players"]:
-        player_id = int(player["playerId"])
-        ticket_key = _get_player_ticket_key(player_id)
-        with _LockedTicket(ticket_key) as ticket_lock:
-            player_ticket = ticket_lock.ticket
+    ticket_keys = _get_player_ticket_keys(int(player["playerId"]) for player in game_session_info["players"])
+    event_data_by_player_id = {}
+    with _LockedTickets(ticket_keys.values()) as ticket_locks:
+        for player_id, ticket_key in ticket_keys.items():
+            player_ticket = ticket_locks[ticket_key].ticket
             if player_ticket is None:  # This has to be a backfill ticket, i.e. not issued by us.
                 log.info(f"MatchmakingSucceeded event received for a player who has no ticket. Probably backfill.")
                 continue
@@ -634,14 +767,16 @@ def _process_matchmaking_succeeded_event(event):
             for ticket_player in player_ticket["Players"]:
                 try:  # wrap this for good measure so a failure for one player doesn't block the others.
                     receiver_id = int(ticket_player["PlayerId"])
-                    event_data = {
+                    event_data_by_player_id[receiver_id] = {
                         "connection_string": connection_string,
                         "options": connection_info_by_player_id[receiver_id]
                     }
-                    _post_matchmaking_event_to_members([receiver_id], "MatchmakingSuccess", event_data=event_data)
                 except Exception as e:
                     log.error(f"Failed to post 'MatchmakingSuccess' update to player {receiver_id}: {e}")
 
+    if event_data_by_player_id:
+        _post_matchmaking_events_to_members("MatchmakingSuccess", event_data_by_player_id)
+
 def _process_matchmaking_cancelled_event(event):
     for ticket_id, player in _ticket_players(event):
         player_id = player["playerId"]
@@ -826,36 +961,49 @@ class _LockedTicket(object):
 
     def __enter__(self):
         self._lock.acquire(blocking=True)
-        ticket_key = self._redis.conn.get(self._key)
-        if ticket_key:
-            self._ticket_id = ticket_key.split(":")[-1]
-        if self._ticket_id is not None:
-            ticket = json.loads(self._redis.conn.get(self._make_ticket_key()))
-            self._entry_ticket_str = str(ticket)
-            self._ticket = ticket
+        try:
+            ticket_key = self._redis.conn.get(self._key)
+            if ticket_key:
+                self._ticket_id = ticket_key.split(":")[-1]
+            if self._ticket_id is not None:
+                self._set_loaded_ticket(self._redis.conn.get(self._make_ticket_key()))
+        except Exception:
+            self._lock.release()
+            raise
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self._lock.owned():  # If we don't own the lock at this point, we don't want to update anything
             with self._redis.conn.pipeline() as pipe:
-                if self._entry_ticket_str != str(self._ticket) and exc_type in (None, GameliftClientException):
-                    if self._ticket_id:
-                        pipe.delete(self._make_ticket_key())  # Always update the ticket wholesale, i.e. don't leave stale fields behind.
-                    if self._ticket is None:
-                        pipe.delete(self._key)
-                    else:
-                        self._ticket_id = self._ticket["TicketId"]
-                        ticket_key = self._make_ticket_key()
-                        ttl = self.TICKET_TTL_SECONDS
-                        if self._ticket["Status"] in ("COMPLETED", "MATCH_COMPLETE"):
-                            ttl = self.MAX_REJOIN_TIME
-                        elif self._ticket["Status"] == "PLACING":
-                            ttl = self.PLACEMENT_TIMEOUT
-                        pipe.set(self._key, ticket_key, ex=ttl)
-                        pipe.set(ticket_key, self._jsonify_ticket(), ex=self.TICKET_TTL_SECONDS)
+                if exc_type in (None, GameliftClientException):
+                    self._write_ticket(pipe)
                 pipe.execute()
             self._lock.release()
 
+    def _set_loaded_ticket(self, ticket_str):
+        # The ticket may have expired since it was looked up
+        ticket = json.loads(ticket_str) if ticket_str is not None else None
+        self._entry_ticket_str = str(ticket)
+        self._ticket = ticket
+
+    def _write_ticket(self, pipe):
+        if self._entry_ticket_str == str(self._ticket):
+            return
+        if self._ticket_id:
+            pipe.delete(self._make_ticket_key())  # Always update the ticket wholesale, i.e. don't leave stale fields behind.
+        if self._ticket is None:
+            pipe.delete(self._key)
+        else:
+            self._ticket_id = self._ticket["TicketId"]
+            ticket_key = self._make_ticket_key()
+            ttl = self.TICKET_TTL_SECONDS
+            if self._ticket["Status"] in ("COMPLETED", "MATCH_COMPLETE"):
+                ttl = self.MAX_REJOIN_TIME
+            elif self._ticket["Status"] == "PLACING":
+                ttl = self.PLACEMENT_TIMEOUT
+            pipe.set(self._key, ticket_key, ex=ttl)
+            pipe.set(ticket_key, self._jsonify_ticket(), ex=self.TICKET_TTL_SECONDS)
+
     def _make_ticket_key(self):
         if self._ticket_id is None:
             raise RuntimeError("Cannot make ticket key when there's no TicketId")
@@ -868,6 +1016,65 @@ class _LockedTicket(object):
         return json.dumps(self._ticket)
 
 
+class _LockedTickets(object):
+    """
+    Context manager for synchronizing modification of multiple matchmaking tickets at once.
+
+    The ticket locks are acquired in key order, so that concurrent events sharing tickets can't deadlock, and the
+    tickets are loaded and written back in single pipelines. Entering returns a dict of key to _LockedTicket.
+    """
+
+    def __init__(self, keys):
+        self._tickets = {key: _LockedTicket(key) for key in sorted(set(keys))}
+
+    def __enter__(self):
+        acquired = []
+        try:
+            for ticket_lock in self._tickets.values():
+                ticket_lock._lock.acquire(blocking=True)
+                acquired.append(ticket_lock)
+        except Exception:
+            for ticket_lock in reversed(acquired):
+                ticket_lock._lock.release()
+            raise
+        try:
+            self._load_tickets()
+        except Exception:
+            for ticket_lock in reversed(acquired):
+                ticket_lock._lock.release()
+            raise
+        return self._tickets
+
+    def _load_tickets(self):
+        conn = g.redis.conn
+        with conn.pipeline(transaction=False) as pipe:
+            for key in self._tickets:
+                pipe.get(key)
+            ticket_keys = pipe.execute()
+        loading = []
+        for ticket_lock, ticket_key in zip(self._tickets.values(), ticket_keys):
+            if ticket_key:
+                ticket_lock._ticket_id = ticket_key.split(":")[-1]
+                loading.append(ticket_lock)
+        if loading:
+            with conn.pipeline(transaction=False) as pipe:
+                for ticket_lock in loading:
+                    pipe.get(ticket_lock._make_ticket_key())
+                for ticket_lock, ticket_str in zip(loading, pipe.execute()):
+                    ticket_lock._set_loaded_ticket(ticket_str)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # If we don't own a lock at this point, we don't want to update its ticket
+        owned = [ticket_lock for ticket_lock in self._tickets.values() if ticket_lock._lock.owned()]
+        if owned and exc_type in (None, GameliftClientException):
+            with g.redis.conn.pipeline() as pipe:
+                for ticket_lock in owned:
+                    ticket_lock._write_ticket(pipe)
+                pipe.execute()
+        for ticket_lock in reversed(owned):
+            ticket_lock._lock.release()
+
+
 class GameliftClientException(Exception):
     def __init__(self, user_message, debug_info):
         super().__init__(user_message, debug_info)
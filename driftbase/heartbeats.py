@@ -0,0 +1,234 @@
+import datetime
+import logging
+
+import redis
+from flask import g
+from drift.core.extensions.driftconfig import get_tenant_config_value, get_feature_switch
+from sqlalchemy import DateTime, Integer, column, func, update, values
+
+from driftbase.config import get_machine_heartbeat_config, get_server_heartbeat_config
+from driftbase.models.db import Machine, Server
+from driftbase.utils.background import run_in_background
+
+log = logging.getLogger(__name__)
+
+# Heartbeats of battle servers and machines recorded in Redis, see HeartbeatStore
+HEARTBEATS_DEFAULTS = dict(heartbeats=dict(
+    server_flush_interval_seconds=10,  # Flush server heartbeats to the db at least this often
+    machine_flush_interval_seconds=10,  # Flush machine heartbeats to the db at least this often
+))
+HEARTBEAT_UPDATE_CHUNK_SIZE = 1000
+HEARTBEAT_FLUSH_LOCK_TIMEOUT = 60
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _to_timestamp(dt):
+    return (dt - EPOCH).total_seconds()
+
+
+def _from_timestamp(timestamp):
+    return EPOCH + datetime.timedelta(seconds=float(timestamp))
+
+
+class HeartbeatStore(object):
+    """
+    Heartbeats of the rows of a table, recorded in Redis instead of updating the rows, and written to the table in
+    bulk by flush().
+
+    Redis keys used, for a store named <name>:
+    <name>:heartbeats: {id: timestamp} - ZSET of the last heartbeat of each row
+    <name>:heartbeats:pending: {id: count} - HASH of heartbeats not yet written to the db
+    <name>:heartbeats:inflight - The pending heartbeats being flushed. If a flush dies half-way, this is left behind
+      and picked up again by the next flush.
+    <name>:heartbeats:flushed - Marker with a TTL of the flush interval, used to schedule the next flush
+    """
+
+    def __init__(self, name, table, id_column, heartbeat_column, count_column=None, get_heartbeat_config=None):
+        self.name = name
+        self.table = table
+        self.id_column = id_column
+        self.heartbeat_column = heartbeat_column
+        self.count_column = count_column
+        self.get_heartbeat_config = get_heartbeat_config
+
+    def _make_key(self, name=None, redis_conn=None):
+        redis_conn = redis_conn or g.redis
+        return redis_conn.make_key(f"{self.name}:heartbeats" + (f":{name}" if name else ""))
+
+    def record(self, row_id, now, flush_interval):
+        """
+        Record a heartbeat for the row.
+
+        Returns the number of heartbeats recorded for the row since they were last flushed, and whether a flush is
+        due.
+        """
+        with g.redis.conn.pipeline(transaction=True) as pipe:
+            pipe.zadd(self._make_key(), {row_id: _to_timestamp(now)})
+            pipe.hincrby(self._make_key("pending"), row_id, 1)
+            _, num_pending = pipe.execute()
+        flush_due = g.redis.conn.set(self._make_key("flushed"), 1, ex=flush_interval, nx=True)
+        return num_pending, bool(flush_due)
+
+    def get_heartbeats(self, rows, redis_conn=None):
+        """
+        Return {id: heartbeat} for the rows, taking heartbeats recorded in Redis into account.
+        """
+        heartbeats = {getattr(row, self.id_column): getattr(row, self.heartbeat_column) for row in rows}
+        if not heartbeats:
+            return heartbeats
+        redis_conn = redis_conn or g.redis
+        row_ids = list(heartbeats)
+        key = self._make_key(redis_conn=redis_conn)
+        with redis_conn.conn.pipeline(transaction=False) as pipe:
+            for row_id in row_ids:
+                pipe.zscore(key, row_id)
+            scores = pipe.execute()
+        for row_id, score in zip(row_ids, scores):
+            if score is not None:
+                heartbeat = _from_timestamp(score)
+                heartbeats[row_id] = max(heartbeats[row_id], heartbeat) if heartbeats[row_id] else heartbeat
+        return heartbeats
+
+    def heartbeat_filter(self, min_heartbeat_time, flush_interval):
+        """
+        Return a filter clause selecting rows which have heartbeat since min_heartbeat_time.
+
+        Only the heartbeats flushed to the table are used, so no ids are read from Redis. Those lag the heartbeats
+        recorded in Redis by at most the flush interval plus the heartbeat period, so the window is widened by that
+        much, and rows may be selected for that long after their last heartbeat. Use get_heartbeats() on the
+        selected rows where the exact heartbeat matters.
+        """
+        heartbeat_period, _ = self.get_heartbeat_config()
+        max_flush_lag = datetime.timedelta(seconds=flush_interval + heartbeat_period)
+        return self.table.c[self.heartbeat_column] >= min_heartbeat_time - max_flush_lag
+
+    def flush(self, db_session=None):
+        """
+        Write the heartbeats recorded in Redis to the table, as UPDATE ... FROM (VALUES ...) statements.
+
+        Only one flush runs at a time; if another worker is already flushing, this is a no-op and the heartbeats
+        recorded in the meantime will be picked up by the next flush.
+        Returns the number of rows updated.
+        """
+        if not db_session:
+            db_session = g.db
+
+        lock = g.redis.lock(f"{self.name}:heartbeats:flush", timeout=HEARTBEAT_FLUSH_LOCK_TIMEOUT)
+        if not lock.acquire(blocking=False):
+            return 0
+        try:
+            heartbeats_key = self._make_key()
+            inflight_key = self._make_key("inflight")
+            # A previous flush which failed before completing leaves the in-flight heartbeats behind, in which case
+            # we retry those before taking over the pending ones
+            if not g.redis.conn.exists(inflight_key):
+                try:
+                    g.redis.conn.rename(self._make_key("pending"), inflight_key)
+                except redis.exceptions.ResponseError:
+                    pass  # Nothing pending
+            pending = g.redis.conn.hgetall(inflight_key)
+            row_ids = list(pending)
+            with g.redis.conn.pipeline(transaction=False) as pipe:
+                for row_id in row_ids:
+                    pipe.zscore(heartbeats_key, row_id)
+                scores = pipe.execute()
+
+            rows = [(int(row_id), _from_timestamp(score), int(pending[row_id]))
+                    for row_id, score in zip(row_ids, scores) if score is not None]
+            for i in range(0, len(rows), HEARTBEAT_UPDATE_CHUNK_SIZE):
+                db_session.execute(self._make_update(rows[i: i + HEARTBEAT_UPDATE_CHUNK_SIZE]))
+            db_session.commit()
+            g.redis.conn.delete(inflight_key)
+
+            # Heartbeats older than the timeout have all been flushed by now and the rows have timed out
+            _, heartbeat_timeout = self.get_heartbeat_config()
+            expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=heartbeat_timeout)
+            g.redis.conn.zremrangebyscore(heartbeats_key, "-inf", _to_timestamp(expired))
+
+            if rows:
+                log.info("Flushed heartbeats for %s %s", len(rows), self.name)
+            return len(rows)
+        finally:
+            if lock.owned():
+                lock.release()
+
+    def _make_update(self, rows):
+        heartbeats = values(column("row_id", Integer), column("heartbeat", DateTime), column("count", Integer),
+                            name="heartbeats").data(rows)
+        heartbeat_column = self.table.c[self.heartbeat_column]
+        new_values = {
+            self.heartbeat_column: func.greatest(func.coalesce(heartbeat_column, heartbeats.c.heartbeat),
+                                                 heartbeats.c.heartbeat)
+        }
+        if self.count_column:
+            new_values[self.count_column] = self.table.c[self.count_column] + heartbeats.c.count
+        return update(self.table) \
+            .where(self.table.c[self.id_column] == heartbeats.c.row_id) \
+            .values(new_values)
+
+
+server_heartbeats = HeartbeatStore("servers", Server.__table__, "server_id", "heartbeat_date", "heartbeat_count",
+                                   get_server_heartbeat_config)
+machine_heartbeats = HeartbeatStore("machines", Machine.__table__, "machine_id", "heartbeat_date",
+                                    get_heartbeat_config=get_machine_heartbeat_config)
+
+
+def redis_heartbeats_enabled():
+    return get_feature_switch('enable_server_redis_heartbeats')
+
+
+def _get_heartbeats_config_value(config_key):
+    return get_tenant_config_value("heartbeats", config_key, HEARTBEATS_DEFAULTS)
+
+
+def record_server_heartbeat(server_id, now):
+    _, flush_due = server_heartbeats.record(server_id, now,
+                                            _get_heartbeats_config_value("server_flush_interval_seconds"))
+    if flush_due:
+        # The flush is done in the background so the heartbeat which happens to trigger it doesn't wait for it
+        run_in_background(g.redis.make_key("servers:heartbeats:flush"), flush_server_heartbeats)
+
+
+def record_machine_heartbeat(machine_id, now):
+    _, flush_due = machine_heartbeats.record(machine_id, now,
+                                             _get_heartbeats_config_value("machine_flush_interval_seconds"))
+    if flush_due:
+        run_in_background(g.redis.make_key("machines:heartbeats:flush"), flush_machine_heartbeats)
+
+
+def flush_server_heartbeats(db_session=None):
+    return server_heartbeats.flush(db_session)
+
+
+def flush_machine_heartbeats(db_session=None):
+    return machine_heartbeats.flush(db_session)
+
+
+def get_server_heartbeats(servers, redis_conn=None):
+    """
+    Return {server_id: heartbeat_date} for the servers, taking heartbeats recorded in Redis into account.
+    """
+    if not redis_heartbeats_enabled():
+        return {server.server_id: server.heartbeat_date for server in servers}
+    return server_heartbeats.get_heartbeats(servers, redis_conn)
+
+
+def get_server_heartbeat(server):
+    return get_server_heartbeats([server])[server.server_id]
+
+
+def get_machine_heartbeat(machine):
+    if not redis_heartbeats_enabled():
+        return machine.heartbeat_date
+    return machine_heartbeats.get_heartbeats([machine])[machine.machine_id]
+
+
+def server_heartbeat_filter(min_heartbeat_time):
+    """
+    Return a filter clause selecting servers which have heartbeat since min_heartbeat_time.
+    """
+    if not redis_heartbeats_enabled():
+        return Server.heartbeat_date >= min_heartbeat_time
+    return server_heartbeats.heartbeat_filter(min_heartbeat_time,
+                                              _get_heartbeats_config_value("server_flush_interval_seconds"))
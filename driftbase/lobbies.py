@@ -1,5 +1,7 @@
+import functools
 import logging
 import json
+import textwrap
 import typing
 import random
 import string
@@ -8,8 +10,8 @@ import copy
 from collections import defaultdict
 from flask import g
 from driftbase.models.db import CorePlayer
-from driftbase.messages import post_message
-from driftbase.utils.redis_utils import timeout_pipe, JsonLock
+from driftbase.messages import post_messages_bulk
+from driftbase.utils.redis_utils import timeout_pipe, JsonLock, get_json, update_json
 from driftbase.utils.exceptions import NotFoundException, UnauthorizedException, ConflictException, InvalidRequestException
 from driftbase import flexmatch, parties
 from redis.exceptions import WatchError
@@ -21,6 +23,10 @@ LOBBY_ID_LENGTH = 6
 DEFAULT_LOBBY_NAME = "Lobby"
 LOBBY_MATCH_STARTING_LEAVE_LOCK_DURATION_SECONDS = 60
 MAX_LOBBY_CUSTOM_DATA_BYTES = 4096
+MAX_PUBLIC_LOBBIES_PAGE_SIZE = 100
+# Searching public lobbies by name examines at most this many lobbies per query
+MAX_PUBLIC_LOBBIES_EXAMINED = 10000
+PUBLIC_LOBBIES_BATCH_SIZE = 100
 
 
 def get_player_lobby(player_id: int, expected_lobby_id: typing.Optional[str] = None):
@@ -38,32 +44,83 @@ def get_player_lobby(player_id: int, expected_lobby_id: typing.Optional[str] = N
                     f"that lobby. Player is in lobby '{lobby_id}'")
         raise UnauthorizedException(f"You don't have permission to access lobby {expected_lobby_id}")
 
-    with JsonLock(_get_lobby_key(lobby_id)) as lobby_lock:
+    # Reading the lobby doesn't need the lobby lock, so members refreshing the lobby don't contend with updates
+    lobby = get_json(_get_lobby_key(lobby_id))
+
+    if not lobby:
         if lobby_id != g.redis.conn.get(player_lobby_key):
             log.warning(f"Player '{player_id}' attempted to get lobby '{lobby_id}', but left the lobby "
-                        f"while acquiring the lobby lock")
+                        f"while fetching it")
             raise ConflictException(f"You left the lobby while attempting to fetch it")
+        log.warning(f"Player '{player_id}' is assigned to lobby '{lobby_id}' but the lobby doesn't exist")
+        g.redis.conn.delete(player_lobby_key)
+        raise NotFoundException("No lobby found")
 
-        lobby = lobby_lock.value
-
-        if not lobby:
-            log.warning(f"Player '{player_id}' is assigned to lobby '{lobby_id}' but the lobby doesn't exist")
-            g.redis.conn.delete(player_lobby_key)
-            raise NotFoundException("No lobby found")
-
-        log.info(f"Returning lobby '{lobby_id}' for player '{player_id}'")
+    log.info(f"Returning lobby '{lobby_id}' for player '{player_id}'")
 
-        # Sanity check that the player is a member of the lobby
-        if not _get_lobby_member(lobby, player_id):
-            log.error(f"Player '{player_id}' is supposed to be in lobby '{lobby_id}' but isn't a member of the lobby")
-            g.redis.conn.delete(player_lobby_key)
-            raise NotFoundException("No lobby found")
+    # Sanity check that the player is a member of the lobby
+    if not _get_lobby_member(lobby, player_id):
+        if lobby_id != g.redis.conn.get(player_lobby_key):
+            log.warning(f"Player '{player_id}' attempted to get lobby '{lobby_id}', but left the lobby "
+                        f"while fetching it")
+            raise ConflictException(f"You left the lobby while attempting to fetch it")
+        log.error(f"Player '{player_id}' is supposed to be in lobby '{lobby_id}' but isn't a member of the lobby")
+        g.redis.conn.delete(player_lobby_key)
+        raise NotFoundException("No lobby found")
+
+    return _get_personalized_lobby(lobby, player_id)
+
+
+def get_public_lobbies(map_name: typing.Optional[str] = None, lobby_name: typing.Optional[str] = None,
+                       min_free_slots: int = 1, offset: int = 0, limit: int = 20) -> list[dict]:
+    """
+    Return public lobbies which haven't started their match, with the most free slots first.
+
+    Lobbies are looked up in indexes maintained as lobbies change, filtered by map, by having at least
+    'min_free_slots' free slots and by containing 'lobby_name' in their name, before any lobbies are read.
+    At most MAX_PUBLIC_LOBBIES_EXAMINED lobbies are examined per query.
+    """
+    index_key = _get_public_lobbies_map_key(map_name) if map_name else _get_public_lobbies_key()
+    name = (lobby_name or "").lower()
+    limit = min(limit, MAX_PUBLIC_LOBBIES_PAGE_SIZE)
+    lobbies = []
+    skipped = start = examined = 0
+    while len(lobbies) < limit and examined < MAX_PUBLIC_LOBBIES_EXAMINED:
+        lobby_ids = g.redis.conn.zrevrangebyscore(index_key, "+inf", min_free_slots,
+                                                  start=start, num=PUBLIC_LOBBIES_BATCH_SIZE)
+        if not lobby_ids:
+            break
+        start += len(lobby_ids)
+        examined += len(lobby_ids)
+        if name:
+            lobby_infos = g.redis.conn.hmget(_get_public_lobbies_info_key(), lobby_ids)
+            lobby_ids = [lobby_id for lobby_id, lobby_info in zip(lobby_ids, lobby_infos)
+                         if lobby_info and name in json.loads(lobby_info)["lobby_name"]]
+            if not lobby_ids:
+                continue
 
-        return _get_personalized_lobby(lobby, player_id)
+        lobby_jsons = g.redis.conn.mget([_get_lobby_key(lobby_id) for lobby_id in lobby_ids])
+        for lobby_id, lobby_json in zip(lobby_ids, lobby_jsons):
+            if lobby_json is None:
+                # The lobby expired without being removed from the indexes
+                _remove_expired_public_lobby(lobby_id)
+                start -= 1
+                continue
+            lobby = json.loads(lobby_json)
+            # The indexes are updated along with the lobby, but don't trust them blindly
+            if lobby["status"] != "idle" or not lobby.get("public"):
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            lobbies.append(_get_public_lobby_summary(lobby))
+            if len(lobbies) == limit:
+                break
+    return lobbies
 
 
 def create_lobby(player_id: int, team_capacity: int, team_names: list[str], lobby_name: typing.Optional[str],
-                 map_name: typing.Optional[str], custom_data: typing.Optional[str]):
+                 map_name: typing.Optional[str], custom_data: typing.Optional[str], public: bool = False):
     # Check party
     if parties.get_player_party(player_id) is not None:
         log.warning(f"Failed to create lobby for player '{player_id}' due to player being in a party")
@@ -120,6 +177,7 @@ def create_lobby(player_id: int, team_capacity: int, team_names: list[str], lobb
                         "placement_date": None,
                         "status": "idle",
                         "custom_data": custom_data,
+                        "public": public,
                         "members": [
                             {
                                 "player_id": player_id,
@@ -138,7 +196,9 @@ def create_lobby(player_id: int, team_capacity: int, team_names: list[str], lobb
 
                     pipe.execute()
 
-                    return new_lobby
+                    _update_public_lobby_index(lobby_id, new_lobby)
+
+                return new_lobby
 
             raise RuntimeError(f"Failed to generate unique lobby id for player '{player_id}'. "
                                f"Retried '{MAX_LOBBY_ID_GENERATION_RETRIES}' times")
@@ -149,7 +209,8 @@ def create_lobby(player_id: int, team_capacity: int, team_names: list[str], lobb
 
 
 def update_lobby(player_id: int, expected_lobby_id: str, team_capacity: typing.Optional[int], team_names: list[str],
-                 lobby_name: typing.Optional[str], map_name: typing.Optional[str], custom_data: typing.Optional[str]):
+                 lobby_name: typing.Optional[str], map_name: typing.Optional[str], custom_data: typing.Optional[str],
+                 public: typing.Optional[bool] = None):
     # Validate custom data
     if custom_data and _get_number_of_bytes(custom_data) > MAX_LOBBY_CUSTOM_DATA_BYTES:
         log.warning(f"Failed to update lobby for player '{player_id}' due to custom data exceeding "
@@ -262,8 +323,18 @@ def update_lobby(player_id: int, expected_lobby_id: str, team_capacity: typing.O
                          f"for lobby '{lobby_id}'")
                 lobby["custom_data"] = custom_data
 
+        if public is not None:
+            old_public = lobby.get("public", False)
+
+            if old_public != public:
+                lobby_updated = True
+                log.info(f"Host player '{player_id}' changed public from '{old_public}' to '{public}' "
+                         f"for lobby '{lobby_id}'")
+                lobby["public"] = public
+
         if lobby_updated:
             lobby_lock.value = lobby
+            _update_public_lobby_index(lobby_id, lobby)
 
             # Notify members
             receiving_player_ids = _get_lobby_member_player_ids(lobby)
@@ -328,13 +399,17 @@ def update_lobby_member(player_id: int, member_id: int, lobby_id: str, team_name
                     f"being in the lobby")
         raise UnauthorizedException(f"You don't have permission to access lobby {lobby_id}")
 
-    with JsonLock(_get_lobby_key(lobby_id)) as lobby_lock:
+    def update_member(lobby: typing.Optional[dict]) -> bool:
+        # Called again with the latest lobby if the lobby changes before the update is written
         if lobby_id != g.redis.conn.get(player_lobby_key):
             log.warning(f"Player '{player_id}' failed to update lobby '{lobby_id}' due to leaving the lobby while "
-                        f"waiting for lobby lock")
+                        f"updating it")
             raise ConflictException(f"You left the lobby while updating the lobby")
 
-        lobby = lobby_lock.value
+        if not lobby:
+            log.warning(f"Player '{player_id}' attempted to update member '{member_id}' in lobby '{lobby_id}' "
+                        f"which doesn't exist")
+            raise NotFoundException(f"Lobby {lobby_id} doesn't exist")
 
         if player_id != member_id:
             host_player_id = _get_lobby_host_player_id(lobby)
@@ -354,6 +429,7 @@ def update_lobby_member(player_id: int, member_id: int, lobby_id: str, team_name
             raise InvalidRequestException(f"Cannot update lobby after the lobby match has been initialized")
 
         member_updated = False
+        member_ready = ready
 
         for member in lobby["members"]:
             if member["player_id"] != member_id:
@@ -369,32 +445,35 @@ def update_lobby_member(player_id: int, member_id: int, lobby_id: str, team_name
             if current_team and team_name != current_team:
                 log.info(f"Player '{player_id}' in lobby '{lobby_id}' left team '{current_team}'")
                 member_updated = True
-                ready = False
+                member_ready = False
 
             if team_name and team_name != current_team and _can_join_team(lobby, team_name):
                 log.info(f"Player '{player_id}' in lobby '{lobby_id}' joined team '{team_name}'")
                 member_updated = True
-                ready = False
+                member_ready = False
 
             if not team_name:
-                ready = False
+                member_ready = False
 
             member["team_name"] = team_name
 
-            if ready != member["ready"]:
+            if member_ready != member["ready"]:
                 member_updated = True
-                log.info(f"Player '{player_id}' in lobby '{lobby_id}' updated ready status to '{ready}'")
+                log.info(f"Player '{player_id}' in lobby '{lobby_id}' updated ready status to '{member_ready}'")
 
-            member["ready"] = bool(ready)
+            member["ready"] = bool(member_ready)
             break
 
-        if member_updated:
-            lobby_lock.value = lobby
+        return member_updated
 
-            # Notify members
-            receiving_player_ids = _get_lobby_member_player_ids(lobby)
-            _post_lobby_event_to_members(receiving_player_ids, "LobbyMemberUpdated", {"lobby_id": lobby_id, "members":
-                lobby["members"]})
+    # Member updates are the most frequent lobby updates, so they're done without the lobby lock
+    lobby, member_updated = update_json(_get_lobby_key(lobby_id), update_member)
+
+    if member_updated:
+        # Notify members
+        receiving_player_ids = _get_lobby_member_player_ids(lobby)
+        _post_lobby_event_to_members(receiving_player_ids, "LobbyMemberUpdated", {"lobby_id": lobby_id, "members":
+            lobby["members"]})
 
 
 def kick_member(player_id: int, member_id: int, lobby_id: str):
@@ -454,6 +533,7 @@ def kick_member(player_id: int, member_id: int, lobby_id: str):
             log.info(f"Host player '{player_id}' kicked member player '{member_id}' from lobby '{lobby_id}'")
 
             lobby_lock.value = lobby
+            _update_public_lobby_index(lobby_id, lobby)
 
             # Notify members and kicked player
             _post_lobby_event_to_members(receiving_player_ids, "LobbyMemberKicked", {"lobby_id": lobby_id,
@@ -495,6 +575,7 @@ def _internal_join_lobby(player_id: int, lobby_id: str) -> dict:
             })
 
             lobby_lock.value = lobby
+            _update_public_lobby_index(lobby_id, lobby)
 
             g.redis.conn.set(player_lobby_key, lobby_id)
 
@@ -507,7 +588,7 @@ def _internal_join_lobby(player_id: int, lobby_id: str) -> dict:
         else:
             log.info(f"Player '{player_id}' attempted to join lobby '{lobby_id}' while already being a member")
 
-        return _get_personalized_lobby(lobby, player_id)
+    return _get_personalized_lobby(lobby, player_id)
 
 
 def _get_personalized_lobby(lobby: dict, player_id: int) -> dict:
@@ -558,14 +639,13 @@ def _ensure_player_session(lobby: dict, player_id: int, member: dict) -> typing.
                                f"No game session arn exists for placement id '{placement_id}'")
 
         # Check if the game session is still valid
-        game_sessions = flexmatch.describe_game_sessions(GameSessionId=game_session_arn)
-        if len(game_sessions["GameSessions"]) == 0:
+        game_session = flexmatch.get_game_session(game_session_arn)
+        if game_session is None:
             log.warning(f"Unable to ensure a player session for player '{player_id}' in lobby '{lobby_id}'. "
                         f"Game session '{game_session_arn}' not found. "
                         f"Assuming the game session has been deleted/cleaned up")
             return None
 
-        game_session = game_sessions["GameSessions"][0]
         game_session_status = game_session["Status"]
         if game_session_status not in ("ACTIVE", "ACTIVATING"):
             log.warning(f"Unable to ensure a player session for player '{player_id}' in lobby '{lobby_id}'. "
@@ -573,8 +653,7 @@ def _ensure_player_session(lobby: dict, player_id: int, member: dict) -> typing.
             return None
 
         # Check if player has a valid player session
-        player_sessions = flexmatch.describe_player_sessions(GameSessionId=game_session_arn)
-        for player_session in player_sessions["PlayerSessions"]:
+        for player_session in flexmatch.get_player_sessions(game_session_arn):
             if player_session["PlayerId"] == str(player_id) and player_session["Status"] in ("RESERVED", "ACTIVE"):
                 return player_session["PlayerSessionId"]
 
@@ -655,6 +734,8 @@ def _internal_leave_lobby(player_id: int, lobby_id: str):
                 # No one left in the lobby, delete the lobby
                 log.info(f"No one left in lobby '{lobby_id}'. Lobby deleted.")
                 lobby_lock.value = None
+
+            _update_public_lobby_index(lobby_id, lobby_lock.value)
         else:
             log.warning(f"Lobby member player '{player_id}' attempted to leave lobby '{lobby_id}'"
                         f" without being a member")
@@ -690,6 +771,7 @@ def _internal_delete_lobby(player_id: int, lobby_id: str):
 
         # Delete the lobby
         lobby_lock.value = None
+        _update_public_lobby_index(lobby_id, None)
 
         # Notify members
         receiving_player_ids = _get_lobby_member_player_ids(lobby, [player_id])
@@ -712,6 +794,84 @@ def _can_join_team(lobby: dict, team: str) -> bool:
     return team_count < team_capacity
 
 
+def _get_free_slots(lobby: dict) -> int:
+    return max(lobby["team_capacity"] * len(lobby["team_names"]) - len(lobby["members"]), 0)
+
+
+def _get_public_lobby_summary(lobby: dict) -> dict:
+    return {
+        "lobby_id": lobby["lobby_id"],
+        "lobby_name": lobby["lobby_name"],
+        "map_name": lobby["map_name"],
+        "team_capacity": lobby["team_capacity"],
+        "team_names": lobby["team_names"],
+        "create_date": lobby["create_date"],
+        "num_members": len(lobby["members"]),
+        "free_slots": _get_free_slots(lobby),
+    }
+
+
+def _update_public_lobby_index(lobby_id: str, lobby: typing.Optional[dict]):
+    """
+    Add, update or remove the lobby in the public lobby indexes, depending on whether it's public.
+
+    Public lobbies are indexed in a sorted set of all public lobbies and one per map, scored by free slots. Each
+    lobby's map and lowercase name are kept in a hash, to remove it from the right map index and to match names.
+    Call this while holding the lobby lock, so the indexes are updated in the same order as the lobby.
+    """
+    lobbies_key = _get_public_lobbies_key()
+    info_key = _get_public_lobbies_info_key()
+    lobby_info = g.redis.conn.hget(info_key, lobby_id)
+    with g.redis.conn.pipeline() as pipe:
+        if lobby_info and json.loads(lobby_info)["map_name"]:
+            pipe.zrem(_get_public_lobbies_map_key(json.loads(lobby_info)["map_name"]), lobby_id)
+        if lobby and lobby.get("public"):
+            free_slots = _get_free_slots(lobby)
+            map_name = lobby["map_name"] or ""
+            pipe.zadd(lobbies_key, {lobby_id: free_slots})
+            if map_name:
+                pipe.zadd(_get_public_lobbies_map_key(map_name), {lobby_id: free_slots})
+            pipe.hset(info_key, lobby_id, json.dumps({"map_name": map_name, "lobby_name": lobby["lobby_name"].lower()}))
+        else:
+            pipe.zrem(lobbies_key, lobby_id)
+            pipe.hdel(info_key, lobby_id)
+        pipe.execute()
+
+
+def _remove_expired_public_lobby(lobby_id: str):
+    """
+    Remove a lobby which expired without being removed from the public lobby indexes, without the lobby lock.
+
+    The lobby is only removed if it still doesn't exist, isn't locked and its index entry hasn't changed, so a new
+    lobby reusing the id isn't dropped from the indexes.
+    """
+    info_key = _get_public_lobbies_info_key()
+    lobby_info = g.redis.conn.hget(info_key, lobby_id)
+    lobby_key = _get_lobby_key(lobby_id)
+    keys = [lobby_key, lobby_key + "LOCK", _get_public_lobbies_key(), info_key]
+    if lobby_info and json.loads(lobby_info)["map_name"]:
+        keys.append(_get_public_lobbies_map_key(json.loads(lobby_info)["map_name"]))
+    _get_remove_expired_public_lobby_script()(keys=keys, args=[lobby_id, lobby_info or ""])
+
+
+@functools.lru_cache
+def _get_remove_expired_public_lobby_script():
+    return g.redis.conn.register_script(textwrap.dedent("""
+        if redis.call('EXISTS', KEYS[1]) == 1 or redis.call('EXISTS', KEYS[2]) == 1 then
+            return 0
+        end
+        if (redis.call('HGET', KEYS[4], ARGV[1]) or '') ~= ARGV[2] then
+            return 0
+        end
+        redis.call('ZREM', KEYS[3], ARGV[1])
+        redis.call('HDEL', KEYS[4], ARGV[1])
+        if KEYS[5] then
+            redis.call('ZREM', KEYS[5], ARGV[1])
+        end
+        return 1
+        """))
+
+
 def _get_lobby_member(lobby: dict, player_id: int) -> typing.Optional[dict]:
     return next((member for member in lobby["members"] if member["player_id"] == player_id), None)
 
@@ -724,6 +884,18 @@ def _get_lobby_key(lobby_id: str) -> str:
     return g.redis.make_key(f"lobby:{lobby_id}:")
 
 
+def _get_public_lobbies_key() -> str:
+    return g.redis.make_key("lobbies:public:")
+
+
+def _get_public_lobbies_map_key(map_name: str) -> str:
+    return g.redis.make_key(f"lobbies:public:map:{map_name}")
+
+
+def _get_public_lobbies_info_key() -> str:
+    return g.redis.make_key("lobbies:public:info:")
+
+
 def _get_player_lobby_key(player_id: int) -> str:
     return g.redis.make_key(f"player:{player_id}:lobby:")
 
@@ -757,8 +929,8 @@ def _post_lobby_event_to_members(receiving_player_ids: list[int], event: str, ev
         "data": event_data or {}
     }
 
-    for receiver_id in receiving_player_ids:
-        post_message("players", int(receiver_id), "lobby", payload, expiry, sender_system=True)
+    post_messages_bulk("players", [int(receiver_id) for receiver_id in receiving_player_ids], "lobby", payload,
+                       expiry, sender_system=True)
 
 
 def _get_number_of_bytes(s: str) -> int:
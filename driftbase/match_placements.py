@@ -4,6 +4,7 @@ import datetime
 import typing
 import uuid
 import copy
+import time
 from flask import g
 from driftbase.models.db import Match, CorePlayer
 from driftbase import flexmatch
@@ -11,10 +12,23 @@ from driftbase.parties import get_player_party, get_party_members
 from driftbase.lobbies import _post_lobby_event_to_members, _get_lobby_member_player_ids, _get_lobby_key, _get_lobby_host_player_id, _get_player_lobby_key
 from driftbase.utils.exceptions import InvalidRequestException, NotFoundException, UnauthorizedException, ConflictException, ForbiddenException, TryLaterException
 from driftbase.utils.redis_utils import JsonLock, DEFAULT_LOCK_TTL_SECONDS
-from driftbase.messages import post_message
+from driftbase.messages import post_messages_bulk
 
 MATCH_PROVIDER = "gamelift"
 
+# How long to trust a game session status when listing public match placements
+GAME_SESSION_STATUS_TTL_SECONDS = 10
+# How long a backfill of the public match placement index may run before another worker retries it
+PUBLIC_PLACEMENTS_BACKFILL_TIMEOUT_SECONDS = 60
+
+# Redis keys used:
+# match-placement:PLACEMENT_ID: - JSON document of the match placement
+# match-placements:public: [PLACEMENT_ID, ...] - ZSET of public, completed placements, scored by completion time
+# match-placements:public:backfilled - Set once placements from before the index existed have been indexed, with a
+#   TTL while the backfill is running
+# match-placement:game-session-status:GAME_SESSION_ARN - Short-lived cache of the GameLift game session status
+# player:PLAYER_ID:match-placement: - The player's current match placement id
+
 """
 Only lobby matches with GameLift provider supported at the time of writing!!!
 """
@@ -37,34 +51,86 @@ def get_match_placement(player_id: int, match_placement_id: str) -> dict:
 
 
 def get_public_match_placement() -> list[dict]:
-    """ Total hack to get all public placements. Won't scale at all for many reasons, e.g. keys() and querying aws for
-    every game session."""
+    """ Get all public, completed match placements with a live game session.
+
+    Placements are read from an index maintained as placements complete, along with a short-lived cache of the game
+    session status. GameLift is only queried for game sessions with no cached status."""
+    _backfill_public_match_placements()
+    index_key = _get_public_match_placements_key()
+    with g.redis.conn.pipeline() as pipe:
+        pipe.zremrangebyscore(index_key, "-inf", time.time() - DEFAULT_LOCK_TTL_SECONDS)
+        pipe.zrange(index_key, 0, -1)
+        _, placement_ids = pipe.execute()
+    if not placement_ids:
+        return []
+
+    match_placements = []
+    expired_placement_ids = []
+    placement_jsons = g.redis.conn.mget([_get_match_placement_key(placement_id) for placement_id in placement_ids])
+    for placement_id, placement_json in zip(placement_ids, placement_jsons):
+        if placement_json is None:
+            expired_placement_ids.append(placement_id)
+            continue
+        match_placement = json.loads(placement_json)
+        # The index is written along with the placement, but don't trust it blindly
+        if _is_public_match_placement(match_placement):
+            match_placements.append(match_placement)
+    if expired_placement_ids:
+        g.redis.conn.zrem(index_key, *expired_placement_ids)
+    if not match_placements:
+        return []
+
+    game_session_statuses = g.redis.conn.mget([_get_game_session_status_key(match_placement["game_session_arn"])
+                                               for match_placement in match_placements])
     placements = []
-    for key in g.redis.conn.keys(g.redis.make_key(f"match-placement:*")):
-        with JsonLock(key) as match_placement_lock:
-            match_placement = match_placement_lock.value
-            if match_placement is None:
-                continue
-            if not match_placement.get("public"):
-                continue
-            if match_placement['status'] != 'completed':
-                continue
-            # Check if the game session is still valid
-            game_session_arn = match_placement.get("game_session_arn", None)
-            game_sessions = flexmatch.describe_game_sessions(GameSessionId=game_session_arn)
-            if not isinstance(game_sessions, dict):
-                log.info(f"game session arn '{game_session_arn}' not found or invalid '{game_sessions}'. Skipping.")
-                continue
-            if len(game_sessions["GameSessions"]) != 1:
-                log.info(f"game session arn '{game_session_arn}' doesn't map to a single game session. Skipping.")
-                continue
-            game_session = game_sessions["GameSessions"][0]
-            if game_session["Status"] not in ("ACTIVE", "ACTIVATING"):
-                continue
+    for match_placement, game_session_status in zip(match_placements, game_session_statuses):
+        if not game_session_status:
+            game_session_status = _refresh_game_session_status(match_placement)
+        if game_session_status in ("ACTIVE", "ACTIVATING"):
             placements.append(match_placement)
     return placements
 
 
+def _refresh_game_session_status(match_placement: dict) -> str:
+    game_session_arn = match_placement["game_session_arn"]
+    game_session = flexmatch.get_game_session(game_session_arn)
+    game_session_status = game_session["Status"] if game_session else "MISSING"
+
+    with g.redis.conn.pipeline() as pipe:
+        pipe.set(_get_game_session_status_key(game_session_arn), game_session_status,
+                 ex=GAME_SESSION_STATUS_TTL_SECONDS)
+        if game_session_status not in ("ACTIVE", "ACTIVATING"):
+            # The game session is gone or on its way out, it's not coming back
+            pipe.zrem(_get_public_match_placements_key(), match_placement["placement_id"])
+        pipe.execute()
+    return game_session_status
+
+
+def _backfill_public_match_placements():
+    """
+    Index public placements which completed before the index was maintained. Runs once per tenant.
+
+    The marker expires if the backfill doesn't finish, f.ex. because the worker died, so that it's retried.
+    """
+    backfilled_key = _get_public_match_placements_backfilled_key()
+    if not g.redis.conn.set(backfilled_key, "running", ex=PUBLIC_PLACEMENTS_BACKFILL_TIMEOUT_SECONDS, nx=True):
+        return
+    placement_key_prefix = _get_match_placement_key("")[:-1]
+    with g.redis.conn.pipeline() as pipe:
+        for key in g.redis.conn.scan_iter(match=f"{placement_key_prefix}*", count=1000):
+            placement_id = key[len(placement_key_prefix):-1]
+            if not key.endswith(":") or ":" in placement_id:
+                continue  # Not a placement document
+            placement_json = g.redis.conn.get(key)
+            if placement_json is None:
+                continue
+            match_placement = json.loads(placement_json)
+            if _is_public_match_placement(match_placement):
+                pipe.zadd(_get_public_match_placements_key(), {placement_id: time.time()}, nx=True)
+        pipe.set(backfilled_key, "done")
+        pipe.execute()
+
+
 def get_player_match_placement(player_id: int, expected_match_placement_id: typing.Optional[str] = None) -> dict:
     player_match_placement_key = _get_player_match_placement_key(player_id)
     placement_id = g.redis.conn.get(player_match_placement_key)
@@ -119,21 +185,19 @@ def add_player_to_public_match_placement(player_id: int, placement_id: str) -> t
             raise RuntimeError(f"Failed to create player session for player '{player_id}'. "
                                f"No game session arn exists for placement id '{placement_id}'")
         # Check if the game session is still valid
-        game_sessions = flexmatch.describe_game_sessions(GameSessionId=game_session_arn)
-        if len(game_sessions["GameSessions"]) == 0:
+        game_session = flexmatch.get_game_session(game_session_arn)
+        if game_session is None:
             log.warning(f"Unable to ensure a player session for player '{player_id}'. "
                         f"Game session '{game_session_arn}' not found. "
                         f"Assuming the game session has been deleted/cleaned up")
             raise NotFoundException("Match placement is gone.")
-        game_session = game_sessions["GameSessions"][0]
         game_session_status = game_session["Status"]
         if game_session_status not in ("ACTIVE", "ACTIVATING"):
             log.warning(f"Unable to ensure a player session for player '{player_id}'. "
                         f"Game session '{game_session_arn}' is in status '{game_session_status}'")
             raise NotFoundException("Match placement isn't valid (yet)")
         # Check if player has a valid player session
-        player_sessions = flexmatch.describe_player_sessions(GameSessionId=game_session_arn)
-        for player_session in player_sessions["PlayerSessions"]:
+        for player_session in flexmatch.get_player_sessions(game_session_arn):
             if player_session["PlayerId"] == str(player_id) and player_session["Status"] in ("RESERVED", "ACTIVE"):
                 return player_session
         # Create new player session since no valid one was found
@@ -471,6 +535,7 @@ def stop_player_match_placement(player_id: int, expected_match_placement_id: str
             log.info(f"Player '{player_id}' stopped match placement '{placement_id}'")
 
             match_placement_lock.value = None
+            g.redis.conn.zrem(_get_public_match_placements_key(), placement_id)
         else:
             log.warning(f"Player '{player_id}' attempted to stop match placement '{placement_id}', "
                         f"but the match placement doesn't exist")
@@ -488,6 +553,9 @@ def process_gamelift_queue_event(queue_name: str, message: dict):
 
     log.info(f"Incoming '{event_type}' queue event: '{event_details}'")
 
+    if event_details.get("gameSessionArn"):
+        flexmatch.invalidate_game_session_cache(event_details["gameSessionArn"])
+
     if event_type == "PlacementFulfilled":
         return _process_fulfilled_queue_event(event_details)
     if event_type == "PlacementCancelled":
@@ -565,8 +633,8 @@ def _post_match_placement_event_to_members(receiving_player_ids: list[int], even
         "data": event_data or {}
     }
 
-    for receiver_id in receiving_player_ids:
-        post_message("players", int(receiver_id), "match_placements", payload, expiry, sender_system=True)
+    post_messages_bulk("players", [int(receiver_id) for receiver_id in receiving_player_ids], "match_placements",
+                       payload, expiry, sender_system=True)
 
 
 def _get_player_locks(player_ids: typing.List[int]):
@@ -590,9 +658,26 @@ def _save_match_placement(match_placement: dict, player_ids: typing.List[int]):
             placement_key = _get_player_match_placement_key(player_id_entry)
             pipe.set(placement_key, placement_id, ex=DEFAULT_LOCK_TTL_SECONDS)
 
+        _update_public_match_placement_index(pipe, match_placement)
         pipe.execute()
 
 
+def _update_public_match_placement_index(pipe, match_placement: dict):
+    """ Add or remove the match placement from the public placements index, depending on its state. """
+    index_key = _get_public_match_placements_key()
+    if _is_public_match_placement(match_placement):
+        pipe.zadd(index_key, {match_placement["placement_id"]: time.time()})
+        # The game session is new, so forget anything we may have cached about it
+        pipe.delete(_get_game_session_status_key(match_placement["game_session_arn"]))
+    else:
+        pipe.zrem(index_key, match_placement["placement_id"])
+
+
+def _is_public_match_placement(match_placement: dict) -> bool:
+    return bool(match_placement.get("public") and match_placement["status"] == "completed"
+                and match_placement.get("game_session_arn"))
+
+
 def _get_match_placement_key(placement_id: str) -> str:
     return g.redis.make_key(f"match-placement:{placement_id}:")
 
@@ -601,6 +686,18 @@ def _get_player_match_placement_key(player_id: int) -> str:
     return g.redis.make_key(f"player:{player_id}:match-placement:")
 
 
+def _get_public_match_placements_key() -> str:
+    return g.redis.make_key("match-placements:public:")
+
+
+def _get_public_match_placements_backfilled_key() -> str:
+    return g.redis.make_key("match-placements:public:backfilled")
+
+
+def _get_game_session_status_key(game_session_arn: str) -> str:
+    return g.redis.make_key(f"match-placement:game-session-status:{game_session_arn}")
+
+
 def _get_event_details(event: dict):
     if event.get("detail-type", None) != "GameLift Queue Placement Event":
         raise RuntimeError("Event is not a GameLift Queue Placement Event!")
@@ -658,7 +755,8 @@ def _process_fulfilled_queue_event(event_details: dict):
         placement["game_session_arn"] = event_details["gameSessionArn"]
         placement["connection_string"] = connection_string
 
-        match_placement_lock.value = placement
+        # Write the placement and its index entry together, while still holding the lock
+        _save_match_placement(placement, [])
 
         # Gather connection info for each player
         connection_options_by_player_id = {}
@@ -760,7 +858,8 @@ def _process_cancelled_queue_event(event_details: dict):
 
         placement["status"] = "cancelled"
 
-        match_placement_lock.value = placement
+        # Write the placement and its index entry together, while still holding the lock
+        _save_match_placement(placement, [])
 
         log.info(f"Placement '{placement_id}' cancelled. Duration: '{duration}s'")
 
@@ -809,7 +908,8 @@ def _process_timed_out_queue_event(event_details: dict):
 
         placement["status"] = "timed_out"
 
-        match_placement_lock.value = placement
+        # Write the placement and its index entry together, while still holding the lock
+        _save_match_placement(placement, [])
 
         log.info(f"Placement '{placement_id}' timed out. Duration: '{duration}s'")
 
@@ -858,7 +958,8 @@ def _process_failed_queue_event(event_details: dict):
 
         placement["status"] = "failed"
 
-        match_placement_lock.value = placement
+        # Write the placement and its index entry together, while still holding the lock
+        _save_match_placement(placement, [])
 
         log.info(f"Placement '{placement_id}' failed. Duration: '{duration}s'")
 
@@ -1,15 +1,24 @@
 import datetime
 import collections
+import heapq
+import itertools
+import operator
+import time
 
 from flask import g
+from sqlalchemy import case
 
+from driftbase.clients import get_client_heartbeats
 from driftbase.config import get_server_heartbeat_config
+from driftbase.heartbeats import get_server_heartbeats, server_heartbeat_filter
 from driftbase.models.db import Match, MatchQueuePlayer, Client, Server, Machine
 
 import logging
 
 log = logging.getLogger(__name__)
 
+BULK_UPDATE_CHUNK_SIZE = 1000
+
 
 def utcnow():
     return datetime.datetime.utcnow()
@@ -32,13 +41,37 @@ def check_ref_and_placement(player, match, server, machine):
     return True
 
 
+def _candidate_buckets(server, machine):
+    """ Keys of the player buckets, by (ref, placement), whose players can join a match on this server """
+    refs = dict.fromkeys([server.ref or None, None])
+    placements = dict.fromkeys([machine.placement or None, None])
+    return list(itertools.product(refs, placements))
+
+
+def _pick_players(buckets, bucket_keys, num_players):
+    """
+    Pick the first 'num_players' players, in queue order, from the buckets without removing them.
+    Each bucket is a deque of players ordered by queue position.
+    """
+    iterators = [iter(buckets[key]) for key in bucket_keys if buckets.get(key)]
+    return list(itertools.islice(heapq.merge(*iterators, key=operator.attrgetter("id")), num_players))
+
+
 def process_match_queue(redis=None, db_session=None):
+    """
+    Assign waiting players to idle matches.
+
+    Players are bucketed by the ref and placement they want, so filling a match only looks at the players who can
+    actually join it, and all assignments are written in bulk at the end of the pass.
+    Returns a dict of statistics for the pass.
+    """
     log.info("process_match_queue...")
     if redis is None:
         redis = g.redis
     if db_session is None:
         db_session = g.db
     with lock(redis, timeout=60*15):
+        start_time = time.time()
         # find all valid players waiting in the queue
         queued_players = db_session.query(MatchQueuePlayer, Client) \
             .filter(Client.client_id == MatchQueuePlayer.client_id,
@@ -47,32 +80,40 @@ def process_match_queue(redis=None, db_session=None):
             .order_by(MatchQueuePlayer.id) \
             .all()  # noqa: E711
         _, heartbeat_timeout = get_server_heartbeat_config()
+        min_heartbeat_time = utcnow() - datetime.timedelta(seconds=heartbeat_timeout)
         query = db_session.query(Machine, Server, Match)
         query = query.filter(Match.server_id == Server.server_id,
                              Server.machine_id == Machine.machine_id,
                              Match.num_players == 0,
                              Match.status == "idle",
                              Server.server_id == Match.server_id,
-                             Server.heartbeat_date >= utcnow() - datetime.timedelta(
-                                 seconds=heartbeat_timeout))
+                             server_heartbeat_filter(min_heartbeat_time)) \
+            .order_by(Match.match_id)
         idle_matches = query.all()
-
-        eligible_players = []
+        # The filter may select servers up to the heartbeat flush lag past their last heartbeat
+        server_heartbeats = get_server_heartbeats([server for _, server, _ in idle_matches], redis)
+        idle_matches = [(machine, server, match) for machine, server, match in idle_matches
+                        if server_heartbeats[server.server_id] >= min_heartbeat_time]
+        query_time = time.time()
+
+        heartbeats = get_client_heartbeats([client for _, client in queued_players], redis)
+        offline_player_ids = []
+        player_buckets = collections.defaultdict(collections.deque)
         challenge_players = collections.defaultdict(list)
         for r in queued_players:
             player, client = r
             log.debug("Found %s in the queue", r[0].player_id)
-            if client.heartbeat < utcnow() - datetime.timedelta(seconds=60):
+            if heartbeats[client.client_id] < utcnow() - datetime.timedelta(seconds=60):
                 log.info("Player %s is in the queue but has missed his heartbeat. "
                          "Removing him from the queue", player.player_id)
-                db_session.delete(player)
+                offline_player_ids.append(player.id)
             elif not player.token:
-                eligible_players.append(player)
+                player_buckets[(player.ref or None, player.placement or None)].append(player)
             else:
                 challenge_players[player.token].append(player)
-        db_session.commit()
 
-        matched_players = set()
+        match_assignments = {}  # MatchQueuePlayer.id -> match_id
+        matched_match_ids = []
         for machine, server, match in idle_matches:
             possibly_matched_players = []
             # start by processing player challenges
@@ -82,7 +123,7 @@ def process_match_queue(redis=None, db_session=None):
 
                 # if either player specifies a ref or placement, use that for picking match
                 check_player = players[0]
-                if players[1].ref or players[1].placement:
+                if len(players) > 1 and (players[1].ref or players[1].placement):
                     check_player = players[1]
                 if not check_ref_and_placement(check_player, match, server, machine):
                     continue
@@ -91,33 +132,56 @@ def process_match_queue(redis=None, db_session=None):
                 del challenge_players[token]
 
             if len(possibly_matched_players) == 0:
-                for p in eligible_players:
-                    if p.player_id in matched_players:
-                        continue
-
-                    if not check_ref_and_placement(p, match, server, machine):
-                        continue
-
-                    possibly_matched_players.append(p)
-
-                    log.debug("Possibly adding player %s to match %s",
-                              player.player_id, match.match_id)
-                    if len(possibly_matched_players) == match.max_players:
-                        break
+                bucket_keys = _candidate_buckets(server, machine)
+                possibly_matched_players = _pick_players(player_buckets, bucket_keys, match.max_players)
+                if len(possibly_matched_players) >= match.max_players:
+                    # Players are picked in queue order, so they are always at the front of their bucket
+                    for p in possibly_matched_players:
+                        player_buckets[(p.ref or None, p.placement or None)].popleft()
 
             # if we found enough players to populate this match, mark them as matched and add them
             # to the match. Also set the match to the 'queue' status.
             if len(possibly_matched_players) >= match.max_players:
                 for p in possibly_matched_players:
-                    matched_players.add(p.player_id)
-                    p.match_id = match.match_id
-                    p.status = "matched"
+                    match_assignments[p.id] = match.match_id
                     log.info("Adding player %s to match %s", p.player_id, match.match_id)
-
-                match.status = "queue"
-                match.status_date = utcnow()
-                db_session.commit()
+                matched_match_ids.append(match.match_id)
             elif len(possibly_matched_players) > 0:
                 log.info("Only found %s players for match %s which needs %s players "
                          "so I cannot populate it",
                          len(possibly_matched_players), match.match_id, match.max_players)
+        match_time = time.time()
+
+        if offline_player_ids:
+            db_session.query(MatchQueuePlayer) \
+                .filter(MatchQueuePlayer.id.in_(offline_player_ids)) \
+                .delete(synchronize_session=False)
+        if match_assignments:
+            assignments = list(match_assignments.items())
+            for i in range(0, len(assignments), BULK_UPDATE_CHUNK_SIZE):
+                chunk = dict(assignments[i: i + BULK_UPDATE_CHUNK_SIZE])
+                db_session.query(MatchQueuePlayer) \
+                    .filter(MatchQueuePlayer.id.in_(chunk.keys())) \
+                    .update({MatchQueuePlayer.match_id: case(chunk, value=MatchQueuePlayer.id),
+                             MatchQueuePlayer.status: "matched"},
+                            synchronize_session=False)
+            db_session.query(Match) \
+                .filter(Match.match_id.in_(matched_match_ids)) \
+                .update({Match.status: "queue", Match.status_date: utcnow()},
+                        synchronize_session=False)
+        db_session.commit()
+        end_time = time.time()
+
+        stats = {
+            "num_queued_players": len(queued_players),
+            "num_idle_matches": len(idle_matches),
+            "num_offline_players": len(offline_player_ids),
+            "num_matched_players": len(match_assignments),
+            "num_matched_matches": len(matched_match_ids),
+            "query_seconds": query_time - start_time,
+            "match_seconds": match_time - query_time,
+            "commit_seconds": end_time - match_time,
+            "total_seconds": end_time - start_time,
+        }
+        log.info("process_match_queue done in %.3fs", stats["total_seconds"], extra={"extra": stats})
+        return stats
@@ -2,6 +2,7 @@ from http import client as http_client
 
 import collections
 import datetime
+import contextlib
 import functools
 import json
 import logging
@@ -10,6 +11,7 @@ from flask import g
 from webargs.flaskparser import abort
 
 from drift.core.extensions.jwt import current_user
+from driftbase.utils.redis_utils import KeyNotifier
 
 log = logging.getLogger(__name__)
 
@@ -135,42 +137,129 @@ def check_can_use_exchange(exchange, exchange_id, read=False):
                   message="You can only read from an exchange that belongs to you!")
 
 
+_notifiers = {}
+
+
+@contextlib.contextmanager
+def wait_for_messages(exchange, exchange_id):
+    """
+    Yield an event which is set when a message is posted to the exchange.
+
+    The event should be cleared before checking for messages, and waited on if none were found, so that messages
+    posted in between are not missed.
+    """
+    with _get_notifier().waiter(_make_exchange_messages_key(exchange, exchange_id)) as event:
+        yield event
+
+
+def ensure_listening():
+    """
+    Make sure this worker is subscribed to message notifications, resubscribing if needed.
+
+    Returns False if the subscription couldn't be confirmed, in which case notifications may be missed.
+    """
+    return _get_notifier().ensure_listening()
+
+
+def _get_notifier():
+    channel = _make_messages_notification_channel()
+    notifier = _notifiers.get(channel)
+    if notifier is None:
+        notifier = _notifiers[channel] = KeyNotifier(g.redis.conn, channel)
+    return notifier
+
+
 @functools.lru_cache
 def _get_add_message_script():
     return g.redis.conn.register_script(textwrap.dedent(f"""
         local id = redis.call('INCRBY', KEYS[2], 1)
         redis.call('XADD', KEYS[1], 'MAXLEN', '~', {MAX_PENDING_MESSAGES}, id, unpack(ARGV))
+        redis.call('PUBLISH', KEYS[3], KEYS[1])
         return tostring(id)
         """))
 
 
 def post_message(exchange, exchange_id, queue, payload, expire_seconds=None, sender_system=False):
+    message = _make_message(exchange, queue, payload, expire_seconds, sender_system)
+    message['exchange_id'] = exchange_id
+
+    message_id = _get_add_message_script()(keys=_make_add_message_keys(exchange, exchange_id),
+                                           args=_flatten_message(message))
+
+    return {
+        'message_id': message_id,
+    }
+
+
+def post_messages_bulk(exchange, exchange_ids, queue, payload, expire_seconds=None, sender_system=False):
+    """
+    Post the same message to multiple exchange ids in a single round trip.
+
+    Returns a dict of exchange_id to the posted message info, as returned by post_message.
+    """
+    # The message only differs by exchange id, so it's only made once
+    message = _flatten_message(_make_message(exchange, queue, payload, expire_seconds, sender_system))
+    return _add_messages(exchange, {exchange_id: message + ['exchange_id', exchange_id]
+                                    for exchange_id in exchange_ids})
+
+
+def post_messages_batch(exchange, queue, payloads, expire_seconds=None, sender_system=False):
+    """
+    Post a message to each of multiple exchange ids in a single round trip, 'payloads' being a dict of exchange_id
+    to the payload for that exchange id.
+
+    Returns a dict of exchange_id to the posted message info, as returned by post_message.
+    """
+    messages = {}
+    for exchange_id, payload in payloads.items():
+        message = _make_message(exchange, queue, payload, expire_seconds, sender_system)
+        message['exchange_id'] = exchange_id
+        messages[exchange_id] = _flatten_message(message)
+    return _add_messages(exchange, messages)
+
+
+def _add_messages(exchange, messages):
+    """ Add each flattened message in 'messages', a dict of exchange_id to message, to its exchange id. """
+    if not messages:
+        return {}
+
+    add_message = _get_add_message_script()
+    with g.redis.conn.pipeline(transaction=False) as pipe:
+        for exchange_id, message in messages.items():
+            add_message(keys=_make_add_message_keys(exchange, exchange_id), args=message, client=pipe)
+        message_ids = pipe.execute()
+
+    return {exchange_id: {'message_id': message_id} for exchange_id, message_id in zip(messages, message_ids)}
+
+
+def _make_message(exchange, queue, payload, expire_seconds, sender_system):
     if not is_key_legal(exchange) or not is_key_legal(queue):
         abort(http_client.BAD_REQUEST, message="Exchange or Queue name is invalid.")
 
     expire_seconds = expire_seconds or DEFAULT_EXPIRE_SECONDS
     timestamp = utcnow()
     expires = timestamp + datetime.timedelta(seconds=expire_seconds)
-    message = {
+    return {
         'timestamp': timestamp.isoformat() + "Z",
         'expires': expires.isoformat() + "Z",
         'sender_id': 0 if sender_system else current_user["player_id"],
         'payload': json.dumps(payload, default=json_serial),
         'queue': queue,
         'exchange': exchange,
-        'exchange_id': exchange_id,
     }
 
+
+def _flatten_message(message):
     pieces = []
     for pair in iter(message.items()):
         pieces.extend(pair)
-    message_id = _get_add_message_script()(keys=[_make_exchange_messages_key(exchange, exchange_id),
-                                                 _make_exchange_messages_id_key(exchange, exchange_id)],
-                                           args=pieces)
+    return pieces
 
-    return {
-        'message_id': message_id,
-    }
+
+def _make_add_message_keys(exchange, exchange_id):
+    return [_make_exchange_messages_key(exchange, exchange_id),
+            _make_exchange_messages_id_key(exchange, exchange_id),
+            _make_messages_notification_channel()]
 
 
 def _make_exchange_messages_id_key(exchange, exchange_id):
@@ -185,6 +274,10 @@ def _make_exchange_messages_key(exchange, exchange_id):
     return g.redis.make_key(f"messages:{exchange}:{exchange_id}:")
 
 
+def _make_messages_notification_channel():
+    return g.redis.make_key("messages:notify:")
+
+
 def _next_message_id(message_id: str) -> str:
     """ Return the minimum valid increment to the passed in message_id """
     return str(int(message_id) + 1)
@@ -14,8 +14,8 @@ from sqlalchemy import (
     Float,
     Boolean,
 )
-from sqlalchemy import DDL, event
-from sqlalchemy.dialects.postgresql import ENUM, INET, JSON, UUID
+from sqlalchemy import DDL, event, cast
+from sqlalchemy.dialects.postgresql import ENUM, INET, JSON, JSONB, UUID
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.schema import Sequence, Index
@@ -97,7 +97,7 @@ class UserIdentity(ModelBase):
     user_id = Column(Integer, ForeignKey("ck_users.user_id"), index=True)
     extra_info = Column(JSON, nullable=True)
 
-    logon_date = Column("logon_date", DateTime, nullable=False, server_default=utc_now)
+    logon_date = Column("logon_date", DateTime, nullable=False, server_default=utc_now, index=True)
     num_logons = Column("num_logons", Integer, default=0)
     last_ip_address = Column(INET, nullable=True)
 
@@ -177,10 +177,12 @@ class Client(ModelBase):
 
     @hybrid_property
     def is_online(self):
+        # The last heartbeat may still be in Redis. Imported here since driftbase.clients imports the models.
+        from driftbase.clients import get_client_heartbeat
         _, heartbeat_timeout = get_client_heartbeat_config()
         if (
                 self.status == "active"
-                and self.heartbeat + datetime.timedelta(seconds=heartbeat_timeout)
+                and get_client_heartbeat(self) + datetime.timedelta(seconds=heartbeat_timeout)
                 >= utcnow()
         ):
             return True
@@ -357,6 +359,12 @@ class Match(ModelBase):
     status_date = Column(DateTime, nullable=True)
     unique_key = Column(String(50), nullable=True)
 
+
+# For filtering matches by containment on their JSON columns
+Index("ix_gs_matches_match_statistics_jsonb", cast(Match.match_statistics, JSONB), postgresql_using="gin")
+Index("ix_gs_matches_details_jsonb", cast(Match.details, JSONB), postgresql_using="gin")
+
+
 class MatchPlayer(ModelBase):
     __tablename__ = "gs_matchplayers"
 
@@ -1,4 +1,6 @@
+import functools
 import logging
+import textwrap
 from time import time
 
 from flask import g, url_for, current_app
@@ -35,74 +37,44 @@ def get_max_players_per_party():
 
 
 def accept_party_invite(invite_id, sending_player, accepting_player, leave_existing_party = False):
-    max_players_per_party = get_max_players_per_party()
-    sending_player_party_key = make_player_party_key(sending_player)
-    accepting_player_party_key = make_player_party_key(accepting_player)
-    sending_player_invites_key = make_player_invites_key(sending_player)
-    invite_key = make_party_invite_key(invite_id)
-    party_id_key = g.redis.make_key("party:id:")
     end = time() + OPERATION_TIMEOUT
-
-    with g.redis.conn.pipeline() as pipe:
-        while time() < end:
-            try:
-                pipe.watch(invite_key, accepting_player_party_key, sending_player_party_key, sending_player_invites_key)
-
-                # Get player and invite details
-                pipe.multi()
-                pipe.get(sending_player_party_key)
-                pipe.get(accepting_player_party_key)
-                pipe.hgetall(invite_key)
-                sending_player_party_id, accepting_player_party_id, invite = pipe.execute()
-
-                # Check that everything is valid
-                if not invite:
-                    abort(http_client.NOT_FOUND)
-
-                if int(invite['from']) != sending_player or int(invite['to']) != accepting_player:
-                    abort(http_client.BAD_REQUEST, message="Invite doesn't match players")
-
-                # Check existing party
-                if accepting_player_party_id and sending_player_party_id != accepting_player_party_id:
-                    if not leave_existing_party:
-                        abort(http_client.BAD_REQUEST, message="You must leave your current party first")
-
-                    leave_party(accepting_player, int(accepting_player_party_id))
-
-                if sending_player_party_id and len(get_party_members(int(sending_player_party_id))) >= max_players_per_party:
-                    log.debug("deleting invite {} since party is full".format(invite_key))
-                    pipe.delete(invite_key)
-                    pipe.execute()
-                    abort(http_client.CONFLICT, message="Party is full")
-
-                pipe.watch(invite_key, accepting_player_party_key, sending_player_party_key, sending_player_invites_key)
-
-                # If the inviting player is not in a party, form one now
-                if sending_player_party_id is None:
-                    sending_player_party_id = pipe.incr(party_id_key)
-                    party_players_key = make_party_players_key(sending_player_party_id)
-                    pipe.multi()
-                    # Add inviting player to the new party
-                    pipe.sadd(party_players_key, sending_player)
-                    pipe.set(sending_player_party_key, sending_player_party_id)
-                else:
-                    party_players_key = make_party_players_key(int(sending_player_party_id))
-                    pipe.multi()
-                # Delete the invite
-                log.debug("deleting invite {}".format(invite_key))
-                pipe.delete(invite_key)
-                pipe.zrem(sending_player_invites_key, invite_id)
-                # Add invited player to the party
-                pipe.sadd(party_players_key, accepting_player)
-                pipe.set(accepting_player_party_key, sending_player_party_id)
-                # Get all the members
-                pipe.smembers(party_players_key)
-                result = pipe.execute()
-                return int(sending_player_party_id), [int(entry) for entry in result[-1]]
-            except WatchError:
-                pass
-
-    abort(http_client.CONFLICT)
+    while time() < end:
+        # The parties involved are looked up first, so the script can be passed their keys, and it retries if they
+        # changed in the meantime
+        sending_player_party_id, accepting_player_party_id = g.redis.conn.mget(
+            [make_player_party_key(sending_player), make_player_party_key(accepting_player)])
+        # If the inviting player is not in a party, the script forms one with this id
+        party_id = sending_player_party_id or g.redis.conn.incr(g.redis.make_key("party:id:"))
+        keys = [make_party_invite_key(invite_id), make_player_party_key(sending_player),
+                make_player_party_key(accepting_player), make_player_invites_key(sending_player),
+                make_party_players_key(party_id)]
+        args = [invite_id, sending_player, accepting_player, int(bool(leave_existing_party)),
+                get_max_players_per_party(), sending_player_party_id or '', party_id, accepting_player_party_id or '']
+        if leave_existing_party and accepting_player_party_id and accepting_player_party_id != sending_player_party_id:
+            leave_keys, leave_args = _get_leave_party_keys_and_args(accepting_player, accepting_player_party_id)
+            keys += leave_keys
+            args += leave_args
+        result = _get_accept_party_invite_script()(keys=keys, args=args)
+        if result[0] != "retry":
+            break
+    else:
+        abort(http_client.CONFLICT)
+
+    status = result[0]
+    if status == "not_found":
+        abort(http_client.NOT_FOUND)
+    if status == "mismatch":
+        abort(http_client.BAD_REQUEST, message="Invite doesn't match players")
+    if status == "in_party":
+        abort(http_client.BAD_REQUEST, message="You must leave your current party first")
+    if status == "full":
+        log.debug("deleted invite {} since party is full".format(invite_id))
+        abort(http_client.CONFLICT, message="Party is full")
+
+    _, party_id, members, left_party_id, left_party_members = result
+    if left_party_id:
+        _notify_player_left(accepting_player, int(left_party_id), [int(member) for member in left_party_members])
+    return int(party_id), [int(member) for member in members]
 
 
 def get_player_party(player_id):
@@ -117,95 +89,207 @@ def get_party_members(party_id):
 
 
 def set_player_party(player_id, party_id):
-    scoped_party_players_key = make_party_players_key(party_id)
-    scoped_player_party_key = make_player_party_key(player_id)
-    end = time() + OPERATION_TIMEOUT
-
-    with g.redis.conn.pipeline() as pipe:
-        while time() < end:
-            try:
-                pipe.watch(scoped_party_players_key, scoped_player_party_key)
-                current_party = pipe.get(scoped_player_party_key)
-                if current_party == party_id:
-                    return
-
-                if pipe.sismember(scoped_party_players_key, player_id):
-                    return
-
-                pipe.multi()
-                pipe.smembers(scoped_party_players_key)
-                pipe.set(scoped_player_party_key, party_id)
-                pipe.sadd(scoped_party_players_key, player_id)
-                result = pipe.execute()
-                return result[0]
-            except WatchError:
-                pass
-
-    abort(http_client.CONFLICT)
+    result = _get_set_player_party_script()(
+        keys=[make_party_players_key(party_id), make_player_party_key(player_id)], args=[player_id, party_id])
+    return set(result) if result is not None else None
 
 
 def leave_party(player_id, party_id):
-    scoped_party_players_key = make_party_players_key(party_id)
-    scoped_player_party_key = make_player_party_key(player_id)
-    sending_player_invites_key = make_player_invites_key(player_id)
     end = time() + OPERATION_TIMEOUT
-
-    with g.redis.conn.pipeline() as pipe:
-        while time() < end:
-            try:
-                pipe.watch(scoped_party_players_key, scoped_player_party_key)
-                current_party = pipe.get(scoped_player_party_key)
-
-                # Can't leave a party you're not a member of
-                if current_party is None or int(current_party) != party_id:
-                    abort(http_client.BAD_REQUEST, message="You're not a member of this party")
-
-                # If the player has already left, do nothing
-                if not pipe.sismember(scoped_party_players_key, player_id):
-                    return
-
-                outstanding_invites = pipe.zrange(sending_player_invites_key, 0, -1, withscores=True)
-                pipe.multi()
-                for invite_id, _ in outstanding_invites:
-                    pipe.delete(make_party_invite_key(int(invite_id)))
-                pipe.srem(scoped_party_players_key, player_id)
-                pipe.delete(scoped_player_party_key)
-                pipe.delete(sending_player_invites_key)
-                result = pipe.execute()
-
-                if result is None:
-                    abort(http_client.BAD_REQUEST, message="You're not a member of this party")
-
-                current_app.messagebus.publish_message("parties", {"event": "player_left", "player_id": player_id, "party_id": party_id})
-
-                # Notify party members
-                members = get_party_members(party_id)
-                for member in members:
-                    post_message("players", member, "party_notification",
-                                 {
-                                     "event": "player_left",
-                                     "party_id": party_id,
-                                     "party_url": url_for("parties.entry", party_id=party_id, _external=True),
-                                     "player_id": player_id,
-                                     "player_url": url_for("players.entry", player_id=player_id, _external=True),
-                                 })
-
-                # Disband party if only one member is left
-                if len(members) <= 1:
-                    disband_party(party_id)
-                    post_message("players", members[0], "party_notification",
-                                 {
-                                     "event": "disbanded",
-                                     "party_id": party_id,
-                                     "party_url": url_for("parties.entry", party_id=party_id, _external=True),
-                                 })
-
-                return result
-
-            except WatchError:
-                pass
-
-    abort(http_client.CONFLICT)
+    while time() < end:
+        keys, args = _get_leave_party_keys_and_args(player_id, party_id)
+        result = _get_leave_party_script()(keys=keys, args=[party_id, *args])
+        if result[0] != "retry":
+            break
+    else:
+        abort(http_client.CONFLICT)
+
+    status = result[0]
+    # Can't leave a party you're not a member of
+    if status == "not_member":
+        abort(http_client.BAD_REQUEST, message="You're not a member of this party")
+    # If the player has already left, do nothing
+    if status == "already_left":
+        return None
+
+    members = [int(member) for member in result[1]]
+    _notify_player_left(player_id, party_id, members)
+    return members
+
+
+def _get_leave_party_keys_and_args(player_id, party_id):
+    """
+    Return the keys and args for the leave_party Lua function, for the player's current invites and the other
+    members of the party, whose keys it deletes.
+    """
+    with g.redis.conn.pipeline(transaction=False) as pipe:
+        pipe.zrange(make_player_invites_key(player_id), 0, -1)
+        pipe.smembers(make_party_players_key(party_id))
+        invite_ids, members = pipe.execute()
+    member_ids = [member for member in members if member != str(player_id)]
+    keys = [make_party_players_key(party_id), make_player_party_key(player_id), make_player_invites_key(player_id),
+            *[make_party_invite_key(invite_id) for invite_id in invite_ids],
+            *[make_player_party_key(member_id) for member_id in member_ids]]
+    args = [player_id, len(invite_ids), len(member_ids), *invite_ids, *member_ids]
+    return keys, args
+
+
+def _notify_player_left(player_id, party_id, members):
+    current_app.messagebus.publish_message("parties", {"event": "player_left", "player_id": player_id, "party_id": party_id})
+
+    # Notify party members
+    for member in members:
+        post_message("players", member, "party_notification",
+                     {
+                         "event": "player_left",
+                         "party_id": party_id,
+                         "party_url": url_for("parties.entry", party_id=party_id, _external=True),
+                         "player_id": player_id,
+                         "player_url": url_for("players.entry", player_id=player_id, _external=True),
+                     })
+
+    # The party was disbanded if only one member is left
+    if len(members) == 1:
+        post_message("players", members[0], "party_notification",
+                     {
+                         "event": "disbanded",
+                         "party_id": party_id,
+                         "party_url": url_for("parties.entry", party_id=party_id, _external=True),
+                     })
+
+
+# Party state changes are validated and made by Lua scripts, so they're atomic and take a single round trip no matter
+# how many players are inviting, joining and leaving at once. The keys the scripts touch depend on the party ids,
+# invites and members, which are read before running them, so the scripts return 'retry' if those have changed.
+
+# Removes a player from a party, along with their outstanding invites, disbanding the party if at most one member is
+# left. Reads the party players, player party and player invites keys from KEYS[k], KEYS[k + 1] and KEYS[k + 2],
+# followed by the keys of each invite and the party keys of each other member, and the player id, the number of
+# invites and members, the invite ids and the member ids from ARGV[a] on, see _get_leave_party_keys_and_args().
+# Returns the remaining members, 'not_member' if the player isn't in the party, or 'retry'.
+_LEAVE_PARTY_LUA = """
+    local function leave_party(k, a)
+        local party_players_key, player_party_key, player_invites_key = KEYS[k], KEYS[k + 1], KEYS[k + 2]
+        local player_id, num_invites, num_members = ARGV[a], tonumber(ARGV[a + 1]), tonumber(ARGV[a + 2])
+        if redis.call('SISMEMBER', party_players_key, player_id) == 0 then
+            return 'not_member'
+        end
+        if redis.call('ZCARD', player_invites_key) ~= num_invites
+                or redis.call('SCARD', party_players_key) ~= num_members + 1 then
+            return 'retry'
+        end
+        for i = 1, num_invites do
+            if not redis.call('ZSCORE', player_invites_key, ARGV[a + 2 + i]) then
+                return 'retry'
+            end
+        end
+        local members = {}
+        for i = 1, num_members do
+            members[i] = ARGV[a + 2 + num_invites + i]
+            if redis.call('SISMEMBER', party_players_key, members[i]) == 0 then
+                return 'retry'
+            end
+        end
+
+        for i = 1, num_invites do
+            redis.call('DEL', KEYS[k + 2 + i])
+        end
+        redis.call('SREM', party_players_key, player_id)
+        redis.call('DEL', player_party_key, player_invites_key)
+        if num_members <= 1 then
+            for i = 1, num_members do
+                redis.call('DEL', KEYS[k + 2 + num_invites + i])
+            end
+            redis.call('DEL', party_players_key)
+        end
+        return members
+    end
+    """
+
+
+@functools.lru_cache
+def _get_accept_party_invite_script():
+    return g.redis.conn.register_script(textwrap.dedent(_LEAVE_PARTY_LUA) + textwrap.dedent("""
+        local invite_id, sending_player, accepting_player = ARGV[1], ARGV[2], ARGV[3]
+
+        -- Check that everything is valid
+        local invite = redis.call('HMGET', KEYS[1], 'from', 'to')
+        if not invite[1] and not invite[2] then
+            return {'not_found'}
+        end
+        if invite[1] ~= sending_player or invite[2] ~= accepting_player then
+            return {'mismatch'}
+        end
+
+        local party_id = redis.call('GET', KEYS[2])
+        local accepting_player_party_id = redis.call('GET', KEYS[3])
+        if (party_id or '') ~= ARGV[6] or (accepting_player_party_id or '') ~= ARGV[8] then
+            return {'retry'}
+        end
+        if accepting_player_party_id and party_id ~= accepting_player_party_id and ARGV[4] ~= '1' then
+            return {'in_party'}
+        end
+
+        if party_id and redis.call('SCARD', KEYS[5]) >= tonumber(ARGV[5]) then
+            redis.call('DEL', KEYS[1])
+            return {'full'}
+        end
+
+        -- Leave the existing party
+        local left_party_id, left_party_members = '', {}
+        if accepting_player_party_id and party_id ~= accepting_player_party_id then
+            local members = leave_party(6, 9)
+            if members == 'retry' then
+                return {'retry'}
+            end
+            if members ~= 'not_member' then
+                left_party_id, left_party_members = accepting_player_party_id, members
+            end
+        end
+
+        -- If the inviting player is not in a party, form one now
+        if not party_id then
+            party_id = ARGV[7]
+            redis.call('SADD', KEYS[5], sending_player)
+            redis.call('SET', KEYS[2], party_id)
+        end
+
+        redis.call('DEL', KEYS[1])
+        redis.call('ZREM', KEYS[4], invite_id)
+        redis.call('SADD', KEYS[5], accepting_player)
+        redis.call('SET', KEYS[3], party_id)
+        return {'ok', party_id, redis.call('SMEMBERS', KEYS[5]), left_party_id, left_party_members}
+        """))
+
+
+@functools.lru_cache
+def _get_set_player_party_script():
+    return g.redis.conn.register_script(textwrap.dedent("""
+        if redis.call('GET', KEYS[2]) == ARGV[2] or redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 1 then
+            return nil
+        end
+        local members = redis.call('SMEMBERS', KEYS[1])
+        redis.call('SET', KEYS[2], ARGV[2])
+        redis.call('SADD', KEYS[1], ARGV[1])
+        return members
+        """))
+
+
+@functools.lru_cache
+def _get_leave_party_script():
+    return g.redis.conn.register_script(textwrap.dedent(_LEAVE_PARTY_LUA) + textwrap.dedent("""
+        if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+            return {'not_member'}
+        end
+        local members = leave_party(1, 2)
+        if members == 'retry' then
+            return {'retry'}
+        end
+        if members == 'not_member' then
+            return {'already_left'}
+        end
+        return {'ok', members}
+        """))
 
 
 def disband_party(party_id):
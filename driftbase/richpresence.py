@@ -1,7 +1,7 @@
 from __future__ import annotations
 from marshmallow import Schema, fields
 from marshmallow.decorators import post_load
-from driftbase.messages import post_message
+from driftbase.messages import post_messages_bulk
 from driftbase.utils.exceptions import NotFoundException, ForbiddenException
 from driftbase.models.db import Friendship, CorePlayer
 from sqlalchemy.orm import Session
@@ -65,8 +65,8 @@ class RichPresenceService():
         presence = self.get_richpresence(player_id)
         presence_json = RichPresenceSchema(many=False).dump(presence)
 
-        for receiver_id in self._get_friends(player_id):
-            post_message("players", int(receiver_id), "richpresence", presence_json, sender_system=True)
+        receiver_ids = [int(receiver_id) for receiver_id in self._get_friends(player_id)]
+        post_messages_bulk("players", receiver_ids, "richpresence", presence_json, sender_system=True)
 
     def get_richpresence(self, player_id : int) -> PlayerRichPresence:
         """
@@ -11,7 +11,8 @@ from drift.blueprint import abort
 from driftbase import flexmatch
 from driftbase.models.db import Match, Server, CorePlayer
 from driftbase.config import get_server_heartbeat_config
-from driftbase.utils.redis_utils import JsonLock
+from driftbase.heartbeats import server_heartbeat_filter
+from driftbase.utils.redis_utils import JsonLock, KeyNotifier, get_json
 from driftbase.messages import post_message
 from drift.core.extensions.driftconfig import get_tenant_config_value
 
@@ -21,14 +22,14 @@ PLACEMENT_TIMEOUT = 300  # This is the queue timeout, specified in terraform-nex
 PLACEMENT_REDIS_TTL = 90
 MAX_PLAYERS_PER_MATCH = 128
 SANDBOX_MAP_NAME = "L_Play"
-MAX_RECURSION_LEVEL = 20
+PLACEMENT_RECHECK_SECONDS = 5  # Re-read a pending placement this often while waiting, in case a notification is missed
 
 # FIXME: Return the game session arn instead of placement id
 
 def _redis_placement_key(location_id: int, queue: str) -> str:
     return g.redis.make_key(f"{queue}-SB-Experience-{location_id}")
 
-def handle_player_session_request(location_id: int, player_id: int, queue=t.Union[str,None], recursionlevel=0) -> str:
+def handle_player_session_request(location_id: int, player_id: int, queue: t.Union[str, None] = None) -> str:
     """
     Handle a player session request for a sandbox placement.
     """
@@ -38,45 +39,65 @@ def handle_player_session_request(location_id: int, player_id: int, queue=t.Unio
     log.info(f"Player session for player '{player_id}' on kratos location/experience '{location_id}' in queue '{queue}'")
     # Check if there's an existing placement available in db
     game_session_arn: str = get_running_game_session(location_id, queue)
-    placement: t.Union[dict,None] = None
     if not game_session_arn:
-        # Check/Wait for pending placements
-        wait_time = 0
-        sleep_time = 0.5
-        while wait_time < PLACEMENT_TIMEOUT:
-            with JsonLock(_redis_placement_key(location_id, queue)) as placement_lock:
-                placement: dict = placement_lock.value
-                if placement is None or placement["status"] != "pending":
-                    break
-            log.info(f"Placement is pending for location '{location_id}'. Waiting ({wait_time}/{PLACEMENT_TIMEOUT})...")
-            time.sleep(sleep_time)
-            wait_time += sleep_time
-        else:
-            log.warning(f"Exceeded {PLACEMENT_TIMEOUT} seconds for pending placement for location '{location_id}'. Giving up.")
-            if placement:
-                log.warning(f"Nuking sticky placement: {placement}")
-                g.redis.delete(_redis_placement_key(location_id, queue))
-            abort(http_client.SERVICE_UNAVAILABLE, message="Timeout waiting for placement")
-
+        placement: t.Union[dict, None] = _wait_for_placement(location_id, queue)
         if placement is None:
             log.info(f"No game session and no placement for location '{location_id}'. Creating it...")
             return _create_placement(location_id, player_id, queue)
-        elif placement["status"] == "completed": # recurse, we should now have a match entry with game_session_arn
-            sleep_time = 0.5
-            log.info(f"Placement completed while we waited. Recursing in {sleep_time} second to add player session...")
-            time.sleep(sleep_time)
-            if recursionlevel > MAX_RECURSION_LEVEL:
-                log.error(f"Server hasn't registered a match on this experience yet. "
-                          f"It's been {sleep_time*MAX_RECURSION_LEVEL} seconds since it reported ready to gamelift. "
-                          f"Check placement {placement['placement_id']} I'm Giving up.")
-                abort(http_client.SERVICE_UNAVAILABLE, message="Too many recursions. Giving up.")
-            return handle_player_session_request(location_id, player_id, queue, recursionlevel+1)
+        elif placement["status"] == "completed":
+            # The server may not have registered its match yet, but the placement knows which game session it's in
+            log.info(f"Placement '{placement['placement_id']}' for location '{location_id}' is completed.")
+            game_session_arn = placement["game_session_arn"]
         else:
             abort(http_client.SERVICE_UNAVAILABLE, message=f"Pending placement failed ({placement['status']}). Try again later.")
 
     log.info(f"Found existing placement '{game_session_arn}' for location '{location_id}'. Ensuring player session.")
     return _ensure_player_session(game_session_arn, player_id)
 
+
+def _wait_for_placement(location_id: int, queue: str) -> t.Union[dict, None]:
+    """
+    Wait while the placement for the location is pending, and return it, or None if there is no placement.
+
+    Waiting requests are woken up by the notification published when the placement is fulfilled or fails, so any
+    number of players joining the same location while its placement is pending wait on a single placement, re-reading
+    it only when notified, or every PLACEMENT_RECHECK_SECONDS in case a notification is missed.
+    """
+    placement_key = _redis_placement_key(location_id, queue)
+    deadline = time.monotonic() + PLACEMENT_TIMEOUT
+    with _get_placement_notifier().waiter(placement_key) as placement_updated:
+        while True:
+            placement_updated.clear()
+            placement: t.Union[dict, None] = get_json(placement_key)
+            if placement is None or placement["status"] != "pending":
+                return placement
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            log.info(f"Placement is pending for location '{location_id}'. Waiting ({int(remaining)} seconds left)...")
+            placement_updated.wait(min(remaining, PLACEMENT_RECHECK_SECONDS))
+
+    log.warning(f"Exceeded {PLACEMENT_TIMEOUT} seconds for pending placement for location '{location_id}'. Giving up.")
+    log.warning(f"Nuking sticky placement: {placement}")
+    g.redis.conn.delete(placement_key)
+    abort(http_client.SERVICE_UNAVAILABLE, message="Timeout waiting for placement")
+
+
+_placement_notifiers = {}
+
+
+def _get_placement_notifier() -> KeyNotifier:
+    channel = g.redis.make_key("sandbox:placement-updated")
+    notifier = _placement_notifiers.get(channel)
+    if notifier is None:
+        notifier = _placement_notifiers[channel] = KeyNotifier(g.redis.conn, channel)
+    return notifier
+
+
+def _notify_placement_updated(placement_key: str) -> None:
+    g.redis.conn.publish(g.redis.make_key("sandbox:placement-updated"), placement_key)
+
+
 def _create_placement(location_id: int, player_id: int, queue: str) -> str:
     # FIXME: It's probably a good idea to disassociate the game_session_name and the placement_id completely
     # and just store a 'pointer' from the placement_id to the redis key so we can look it up from the placement id.
@@ -89,7 +110,7 @@ def _create_placement(location_id: int, player_id: int, queue: str) -> str:
     with JsonLock(game_session_name, ttl=PLACEMENT_TIMEOUT) as placement_lock:
         placement: dict = placement_lock.value
         if placement is not None:  # Did we lose a race?
-            return handle_player_session_request(location_id, player_id)
+            return handle_player_session_request(location_id, player_id, queue)
         placement_id = f"{uuid.uuid4().hex[:10]}-{game_session_name.split(':')[-1]}"
         player_name: t.Union[str,None] = g.db.query(CorePlayer.player_name). \
             filter(CorePlayer.player_id == player_id).first().player_name
@@ -143,7 +164,7 @@ def get_running_game_session(location_id: int, queue: str) -> t.Union[str,None]:
                 Server.status == "ready",
                 Match.status == "started",
                 Match.game_mode == "Sandbox",
-                Server.heartbeat_date >= datetime.datetime.utcnow() - datetime.timedelta(seconds=heartbeat_timeout)) \
+                server_heartbeat_filter(datetime.datetime.utcnow() - datetime.timedelta(seconds=heartbeat_timeout))) \
         .all()
 
     # FIXME: Do the json field filtering on details in the query
@@ -157,19 +178,17 @@ def get_running_game_session(location_id: int, queue: str) -> t.Union[str,None]:
     return None
 
 def _ensure_player_session(game_session_arn: str, player_id: int) -> str:
-    game_sessions = flexmatch.describe_game_sessions(GameSessionId=game_session_arn)
-    if len(game_sessions["GameSessions"]) == 0:
+    game_session = flexmatch.get_game_session(game_session_arn)
+    if game_session is None:
         log.warning(f"game session '{game_session_arn}' has become invalid.")
         abort(http_client.SERVICE_UNAVAILABLE, message="Game session is no longer valid")
-    game_session = game_sessions["GameSessions"][0]
     game_session_status = game_session["Status"]
     if game_session_status not in ("ACTIVE", "ACTIVATING"):
         log.warning(f"Game session '{game_session_arn}' is in status '{game_session_status}'. "
                     f"Can't manage player sessions for game sessions in that state")
         abort(http_client.SERVICE_UNAVAILABLE, message=f"Game session '{game_session_arn}' is not in an active state")
     # Check if player has a valid player session
-    player_sessions = flexmatch.describe_player_sessions(GameSessionId=game_session_arn)
-    for player_session in player_sessions["PlayerSessions"]:
+    for player_session in flexmatch.get_player_sessions(game_session_arn):
         if player_session["PlayerId"] == str(player_id) and player_session["Status"] in ("RESERVED", "ACTIVE"):
             log.info(f"found existing player session '{player_session}'.")
             break
@@ -204,6 +223,9 @@ def process_placement_event(queue_name: str, message: dict) -> None:
 
     log.info(f"Got '{event_type}' queue event: '{details}'")
 
+    if details.get("gameSessionArn"):
+        flexmatch.invalidate_game_session_cache(details["gameSessionArn"])
+
     fleet_queue_arn = message.get("resources", [""])[0]
     fleet_queue = "default" if not fleet_queue_arn else fleet_queue_arn.split('/')[-1]
 
@@ -229,6 +251,7 @@ def _process_placement_failure(placement_id: str, queue: str, failure: str) -> N
             log.warning(f"_process_placement_failure: Placement '{placement_id}' not found in redis. Ignoring event.")
             return
         placement_lock.value = None
+    _notify_placement_updated(_redis_placement_key(location_id, queue))
     _post_failure(placement["player_ids"][0], placement_id, failure)
 
 
@@ -257,6 +280,7 @@ def _process_fulfilled_event(details: dict, queue: str) -> None:
         for player in players:
             player_connection_info = f"{connection_string}?PlayerSessionId={player['playerSessionId']}?PlayerId={player['playerId']}"
             _post_connection_info(int(player["playerId"]), placement["game_session_arn"], player_connection_info)
+    _notify_placement_updated(_redis_placement_key(location_id, queue))
 
 def _post_connection_info(player_id, game_session_arn, connection_string):
     payload = {
@@ -1,4 +1,6 @@
+import datetime
 import logging
+import re
 from dateutil import parser
 
 import http.client as http_client
@@ -11,6 +13,9 @@ log = logging.getLogger(__name__)
 
 EXPIRE_SECONDS = 86400
 
+# The timestamp format clients send, which can be validated without the full dateutil parser
+_ISO_TIMESTAMP = re.compile(r"(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?")
+
 
 def log_match_event(match_id, player_id, event_type_name, details=None, db_session=None):
 
@@ -46,7 +51,7 @@ def verify_log_request(events, required_keys=None):
                           message="Required key, '%s' missing from event" % key)
         if "timestamp" in event:
             try:
-                parser.parse(event["timestamp"])
+                _parse_timestamp(event["timestamp"])
             except ValueError:
                 log.warning("Invalid log request. Timestamp %s could not be parsed for %s",
                             event["timestamp"], event)
@@ -54,6 +59,16 @@ def verify_log_request(events, required_keys=None):
                       (event["timestamp"], event["event_name"]))
 
 
+def _parse_timestamp(timestamp):
+    match = _ISO_TIMESTAMP.fullmatch(timestamp) if isinstance(timestamp, str) else None
+    if match:
+        try:
+            return datetime.datetime(*(int(part) for part in match.groups()))
+        except ValueError:
+            pass  # Let dateutil have the final say
+    return parser.parse(timestamp)
+
+
 def url_user(user_id):
     return url_for("users.entry", user_id=user_id, _external=True)
 
@@ -0,0 +1,58 @@
+"""
+    Greenlets which outlive the request that started them, bound to the tenant of that request.
+"""
+
+import logging
+
+import gevent
+from drift.core.extensions.driftconfig import get_config_for_request
+from drift.core.resources.postgres import get_sqlalchemy_session
+from drift.core.resources.redis import get_redis_session
+from drift.utils import get_config
+from flask import current_app, g, request
+from werkzeug.local import LocalProxy
+
+log = logging.getLogger(__name__)
+
+# Background tasks running in this worker, by task key
+_tasks = {}
+
+
+def spawn_for_tenant(func, *args, **kwargs):
+    """
+    Spawn a greenlet calling 'func' with the tenant of the current request bound, and g.conf, g.db and g.redis set up
+    as when serving requests. Returns the greenlet.
+    """
+    app = current_app._get_current_object()
+    return gevent.spawn(_run_for_tenant, app, dict(request.environ), func, args, kwargs)
+
+
+def _run_for_tenant(app, environ, func, args, kwargs):
+    # Bind the tenant of the request which spawned the greenlet, the same way it's done when serving requests
+    with app.app_context() as ctx:
+        ctx.driftconfig = get_config()
+        with app.request_context(environ):
+            g.conf = LocalProxy(get_config_for_request)
+            g.db = LocalProxy(get_sqlalchemy_session)
+            g.redis = LocalProxy(get_redis_session)
+            return func(*args, **kwargs)
+
+
+def run_in_background(task_key, task):
+    """
+    Run 'task' in a greenlet bound to the tenant of the current request, so it doesn't hold up the request.
+
+    'task_key' should include the tenant, f.ex. by making it with g.redis.make_key(). A task which is still running
+    in this worker under the same key is not started again. Failures are logged.
+    """
+    running_task = _tasks.get(task_key)
+    if running_task is not None and not running_task.dead:
+        return
+    _tasks[task_key] = spawn_for_tenant(_run_task, task_key, task)
+
+
+def _run_task(task_key, task):
+    try:
+        task()
+    except Exception:
+        log.exception(f"Background task '{task_key}' failed")
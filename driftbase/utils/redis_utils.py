@@ -1,13 +1,26 @@
+import collections
+import contextlib
+import functools
+import logging
 from time import time
+import gevent
+import gevent.event
 from flask import g
 from redis.client import Pipeline
 import typing
 import datetime
 import json
 
+log = logging.getLogger(__name__)
+
 OPERATION_TIMEOUT = 10
 DEFAULT_LOCK_TTL_SECONDS = 60 * 60  # 1 hour
 DEFAULT_LOCK_TIMEOUT_SECONDS = 30
+# How long to wait for a pubsub subscription to be confirmed
+SUBSCRIBE_TIMEOUT_SECONDS = 5
+# Backoff between attempts to re-subscribe to a pubsub channel, doubling up to the max
+LISTENER_RECONNECT_BACKOFF_SECONDS = 0.5
+LISTENER_MAX_RECONNECT_BACKOFF_SECONDS = 10
 
 
 def timeout_pipe(timeout: int = OPERATION_TIMEOUT) -> typing.Generator[Pipeline, None, None]:
@@ -63,3 +76,165 @@ class JsonLock(object):
             return obj.isoformat()
 
         raise TypeError(f"Type {type(obj)} not serializable")
+
+
+def get_json(key: str):
+    """
+    Read a json value which is modified under a JsonLock, without taking the lock.
+
+    JsonLock and update_json write the value atomically, so it's never read half updated.
+    """
+    value = g.redis.conn.get(key)
+    return json.loads(value) if value is not None else None
+
+
+def update_json(key: str, update: typing.Callable[[typing.Any], bool], ttl: int = DEFAULT_LOCK_TTL_SECONDS):
+    """
+    Update a json value which is otherwise modified under a JsonLock, without taking the lock.
+
+    'update' is called with the current value, which it modifies in place, and returns True if it modified it. The
+    modified value is written only if the value hasn't changed and no JsonLock is held on it in the meantime, otherwise
+    'update' is called again with the new value. If the update keeps conflicting, it's done under the lock instead.
+    Returns the value as updated, and whether 'update' modified it.
+    """
+    endtime = time() + OPERATION_TIMEOUT
+    attempt = 0
+    while time() < endtime:
+        current = g.redis.conn.get(key)
+        value = json.loads(current) if current is not None else None
+        if not update(value):
+            return value, False
+        new = json.dumps(value, default=JsonLock._json_serial) if value else ""
+        if _get_compare_and_set_script()(keys=[key, key + "LOCK"], args=[current or "", new, ttl]):
+            return value, True
+        attempt += 1
+        gevent.sleep(min(0.005 * attempt, 0.1))
+
+    log.warning("Updating '%s' kept conflicting, updating it under the lock", key)
+    with JsonLock(key, ttl) as lock:
+        value = lock.value
+        modified = update(value)
+        if modified:
+            lock.value = value
+        return value, modified
+
+
+@functools.lru_cache
+def _get_compare_and_set_script():
+    return g.redis.conn.register_script("""
+        if redis.call('EXISTS', KEYS[2]) == 1 or (redis.call('GET', KEYS[1]) or '') ~= ARGV[1] then
+            return 0
+        end
+        if ARGV[2] == '' then
+            redis.call('DEL', KEYS[1])
+        else
+            redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+        end
+        return 1
+        """)
+
+
+class PubSubListener(object):
+    """
+    Per-worker subscription to a pubsub channel, running in its own greenlet.
+
+    'on_message' is called with the data of every message published on the channel. If the subscription is lost, the
+    greenlet reconnects with backoff, and 'on_missed_messages' is called both when the subscription is lost and once
+    it's re-established, since messages may have been missed in between.
+    """
+
+    def __init__(self, conn, channel: str, on_message: typing.Callable[[str], None],
+                 on_missed_messages: typing.Optional[typing.Callable[[], None]] = None):
+        self._conn = conn
+        self._channel = channel
+        self._on_message = on_message
+        self._on_missed_messages = on_missed_messages
+        self._subscribed = gevent.event.Event()
+        self._greenlet = None
+
+    def ensure_listening(self) -> bool:
+        """
+        Start listening if not already, and wait until the channel is subscribed to, so that messages published
+        after this returns aren't missed.
+
+        Returns False if the subscription wasn't confirmed within SUBSCRIBE_TIMEOUT_SECONDS.
+        """
+        if self._greenlet is None or self._greenlet.dead:
+            self._greenlet = gevent.spawn(self._listen)
+        if not self._subscribed.wait(SUBSCRIBE_TIMEOUT_SECONDS):
+            log.warning("Timed out waiting for the subscription to channel '%s'", self._channel)
+            return False
+        return True
+
+    def _listen(self):
+        backoff = LISTENER_RECONNECT_BACKOFF_SECONDS
+        reconnecting = False
+        while True:
+            pubsub = self._conn.pubsub()
+            try:
+                pubsub.subscribe(self._channel)
+                for message in pubsub.listen():
+                    if message["type"] == "subscribe":
+                        self._subscribed.set()
+                        backoff = LISTENER_RECONNECT_BACKOFF_SECONDS
+                        if reconnecting:
+                            self._missed_messages()
+                    elif message["type"] == "message":
+                        self._on_message(message["data"])
+            except Exception as e:
+                log.warning("Listener on channel '%s' disconnected, reconnecting in %s seconds: %s",
+                            self._channel, backoff, repr(e))
+            finally:
+                self._subscribed.clear()
+                pubsub.close()
+            self._missed_messages()
+            reconnecting = True
+            gevent.sleep(backoff)
+            backoff = min(backoff * 2, LISTENER_MAX_RECONNECT_BACKOFF_SECONDS)
+
+    def _missed_messages(self):
+        if self._on_missed_messages:
+            try:
+                self._on_missed_messages()
+            except Exception:
+                log.exception("Error handling missed messages on channel '%s'", self._channel)
+
+
+class KeyNotifier(object):
+    """
+    Per-worker fan-out of notifications published on a pubsub channel, the message data being the key notified about.
+
+    A single subscription to the channel wakes up only the waiters on the key a notification was published for, so
+    waiting for changes to a key doesn't cost any Redis round trips.
+    """
+
+    def __init__(self, conn, channel: str):
+        self._waiters = collections.defaultdict(set)
+        self._listener = PubSubListener(conn, channel, self._on_message, self._wake_all)
+
+    def ensure_listening(self) -> bool:
+        return self._listener.ensure_listening()
+
+    @contextlib.contextmanager
+    def waiter(self, key: str):
+        self.ensure_listening()
+        event = gevent.event.Event()
+        self._waiters[key].add(event)
+        try:
+            yield event
+        finally:
+            waiters = self._waiters.get(key)
+            if waiters is not None:
+                waiters.discard(event)
+                if not waiters:
+                    del self._waiters[key]
+
+    def _on_message(self, key):
+        for event in list(self._waiters.get(key, ())):
+            event.set()
+
+    def _wake_all(self):
+        # Notifications may have been missed, so let everyone re-check their key
+        for waiters in list(self._waiters.values()):
+            for event in list(waiters):
+                event.set()
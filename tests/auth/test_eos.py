@@ -5,6 +5,7 @@ from unittest import mock
 import jwt
 
 import driftbase.auth.eos as eos
+import driftbase.auth.jwk as auth_jwk
 from driftbase.auth.authenticate import InvalidRequestException, ServiceUnavailableException, \
     UnauthorizedException
 from tests.test_auth import BaseAuthTestCase
@@ -63,6 +64,9 @@ class TestEosValidate(unittest.TestCase):
 
 
 class TestEosGetKeys(unittest.TestCase):
+    def setUp(self):
+        auth_jwk._jwk_clients.clear()
+
     @mock.patch('driftbase.auth.eos.EPIC_PUBLIC_KEYS_URL', 'https://invalid.com/index.html')
     def test_fails_when_failing_to_load_keys(self):
         with self.assertRaises(ServiceUnavailableException) as e:
@@ -0,0 +1,36 @@
+import unittest
+from unittest import mock
+
+import requests
+
+from driftbase.auth import http_session
+from driftbase.auth.http_session import ProviderSession, CircuitOpenError
+
+
+class ProviderSessionTests(unittest.TestCase):
+    def test_default_timeout(self):
+        session = ProviderSession('test')
+        with mock.patch.object(session._session, 'request') as request:
+            request.return_value.status_code = 200
+            session.get('https://example.com')
+            self.assertEqual(request.call_args.kwargs['timeout'],
+                             (http_session.CONNECT_TIMEOUT_SECONDS, http_session.READ_TIMEOUT_SECONDS))
+
+    def test_circuit_opens_after_consecutive_failures(self):
+        session = ProviderSession('test')
+        with mock.patch.object(session._session, 'request') as request:
+            request.side_effect = requests.exceptions.ConnectionError('down')
+            for _ in range(http_session.CIRCUIT_FAILURE_THRESHOLD):
+                with self.assertRaises(requests.exceptions.ConnectionError):
+                    session.get('https://example.com')
+            request.reset_mock()
+            with self.assertRaises(CircuitOpenError):
+                session.get('https://example.com')
+            request.assert_not_called()
+
+    def test_client_errors_keep_circuit_closed(self):
+        session = ProviderSession('test')
+        with mock.patch.object(session._session, 'request') as request:
+            request.return_value.status_code = 401
+            for _ in range(http_session.CIRCUIT_FAILURE_THRESHOLD + 1):
+                self.assertEqual(session.get('https://example.com').status_code, 401)
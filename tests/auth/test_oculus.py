@@ -38,7 +38,7 @@ def setUpModule():
         return response
 
     global patcher
-    patcher = mock.patch('requests.post', requests_post_mock)
+    patcher = mock.patch('driftbase.auth.oculus.session.post', requests_post_mock)
     patcher.start()
 
 
@@ -90,11 +90,11 @@ def setUpModule():
         return response
 
     global patcher_post
-    patcher_post = mock.patch('requests.post', requests_post_mock)
+    patcher_post = mock.patch('driftbase.auth.psn.session.post', requests_post_mock)
     patcher_post.start()
 
     global patcher_get
-    patcher_get = mock.patch('requests.get', requests_get_mock)
+    patcher_get = mock.patch('driftbase.auth.psn.session.get', requests_get_mock)
     patcher_get.start()
 
 
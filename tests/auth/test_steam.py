@@ -8,6 +8,7 @@ from werkzeug.exceptions import Unauthorized, ServiceUnavailable
 from driftbase.auth.steam import run_ticket_validation
 
 patcher = None
+session_patcher = None
 
 
 def setUpModule():
@@ -54,14 +55,17 @@ def setUpModule():
 
         return response
 
-    global patcher
+    global patcher, session_patcher
     patcher = mock.patch('requests.get', requests_get_mock)
     patcher.start()
+    session_patcher = mock.patch('driftbase.auth.steam.session.get', requests_get_mock)
+    session_patcher.start()
 
 
 def tearDownModule():
-    global patcher
+    global patcher, session_patcher
     patcher.stop()
+    session_patcher.stop()
 
 
 class SteamCase(unittest.TestCase):
@@ -0,0 +1,47 @@
+import collections
+import time
+import unittest
+from unittest import mock
+
+from flask import g
+
+from driftbase.auth import util
+from driftbase.utils.test_utils import BaseCloudkitTest
+
+
+class UrlCacheTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(util, '_url_cache', collections.OrderedDict())
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cache_is_bounded(self):
+        with mock.patch.object(util, 'MAX_URL_CACHE_ENTRIES', 2), \
+                mock.patch.object(util, '_aws_s3_sign_url', side_effect=lambda url: url), \
+                mock.patch.object(util.requests, 'get') as get:
+            get.return_value.status_code = 200
+            get.return_value.headers = {}
+            get.return_value.content = 'content'
+            for url in ('https://a', 'https://b', 'https://a', 'https://c'):
+                self.assertEqual(util.fetch_url(url, 'test'), 'content')
+            self.assertEqual(get.call_count, 3)
+            self.assertEqual(list(self.cache), ['https://a', 'https://c'])
+
+    def test_expired_entries_are_dropped(self):
+        with mock.patch.object(util.time, 'time', return_value=100.0):
+            util._cache_url('https://a', 'old', 50.0)
+            util._cache_url('https://b', 'new', 200.0)
+        self.assertEqual(list(self.cache), ['https://b'])
+
+
+class FetchUrlRedisTests(BaseCloudkitTest):
+    def test_redis_ttl_is_used(self):
+        url = "https://example.com/fetch_url_redis_ttl"
+        with self._request_context(), \
+                mock.patch.object(util, '_url_cache', collections.OrderedDict()) as cache, \
+                mock.patch.object(util.requests, 'get') as get:
+            # Another worker fetched the url, with a max-age of a minute
+            g.redis.set("urlget:" + url, "content", expire=60)
+            self.assertTrue(util.fetch_url(url, 'test'))
+            get.assert_not_called()
+            self.assertLessEqual(cache[url][1], time.time() + 60)
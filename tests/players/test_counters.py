@@ -3,9 +3,15 @@
 import datetime
 import http.client as http_client
 import unittest
+from unittest import mock
+
+from flask import g
 
 from drift.test_helpers.systesthelper import setup_tenant, remove_tenant, uuid_string
+from driftbase.utils import background
+from driftbase.counters import flush_counter_buffer, rollup_counter_entries, schedule_rollup
 from driftbase.systesthelper import DriftBaseTestCase
+from driftbase.utils.test_utils import BaseCloudkitTest
 
 
 def setUpModule():
@@ -284,3 +290,80 @@ class CountersTests(DriftBaseTestCase):
                 ]
         r = self.patch(counter_url, data=data)
         self.assertEqual("OK", r.json()[name])
+
+
+class CountersWriteBehindTests(BaseCloudkitTest):
+    def test_counters_write_behind(self):
+        self.auth(username=uuid_string())
+        player_url = self.endpoints["my_player"]
+        r = self.get(player_url)
+        counter_url = r.json()["counter_url"]
+        countertotals_url = r.json()["countertotals_url"]
+        timestamp = datetime.datetime(2016, 1, 1, 10, 2, 2)
+        name = "my_buffered_counter"
+        absolute_name = "my_buffered_absolute_counter"
+        with mock.patch("driftbase.api.players.counters.write_behind_enabled", return_value=True), \
+                mock.patch("driftbase.counters.flush_counter_buffer"):
+            for val in (500, 99):
+                data = [{"name": name, "value": val, "timestamp": timestamp.isoformat(), "counter_type": "count"},
+                        {"name": absolute_name, "value": val, "timestamp": timestamp.isoformat(),
+                         "counter_type": "absolute"}]
+                r = self.patch(counter_url, data=data)
+                self.assertEqual("OK", r.json()[name])
+
+        # Nothing is written until the buffer is flushed
+        r = self.get(countertotals_url)
+        self.assertEqual(len(r.json()), 0)
+
+        with self._request_context():
+            self.assertGreater(flush_counter_buffer(), 0)
+
+        r = self.get(countertotals_url)
+        self.assertEqual(r.json()[name], 500 + 99)
+        self.assertEqual(r.json()[absolute_name], 99)
+        r = self.get(counter_url)
+        self.assertEqual(len(r.json()), 2)
+
+
+class CountersRollupTests(BaseCloudkitTest):
+    def test_counters_rollup(self):
+        self.auth(username=uuid_string())
+        player_url = self.endpoints["my_player"]
+        r = self.get(player_url)
+        counter_url = r.json()["counter_url"]
+        name = "my_rolled_up_counter"
+        absolute_name = "my_rolled_up_absolute_counter"
+        with mock.patch("driftbase.counters.rollups_enabled", return_value=True), \
+                mock.patch("driftbase.counters.schedule_rollup"), \
+                mock.patch("driftbase.api.players.counters.utcnow") as now:
+            # Counts are bucketed by the time they're received, so put them in different 10-second buckets
+            for val, seconds in ((500, 2), (99, 40)):
+                timestamp = datetime.datetime(2016, 1, 1, 10, 2, seconds)
+                now.return_value = timestamp
+                data = [{"name": name, "value": val, "timestamp": timestamp.isoformat(), "counter_type": "count"},
+                        {"name": absolute_name, "value": val, "timestamp": timestamp.isoformat(),
+                         "counter_type": "absolute"}]
+                self.patch(counter_url, data=data)
+
+        counters = {c["name"]: c for c in self.get(counter_url).json()}
+        r = self.get(counters[name]["periods"]["minute"])
+        self.assertEqual(len(r.json()), 0)
+
+        with self._request_context():
+            g.redis.conn.delete(g.redis.make_key("counters:rollup:since"))
+            self.assertGreater(rollup_counter_entries(now=datetime.datetime(2016, 1, 1, 10, 5)), 0)
+
+        for period in ("minute", "hour", "day", "month"):
+            self.assertEqual(list(self.get(counters[name]["periods"][period]).json().values()), [500 + 99])
+            self.assertEqual(list(self.get(counters[absolute_name]["periods"][period]).json().values()), [99])
+        r = self.get(counters[name]["periods"]["second"])
+        self.assertEqual(len(r.json()), 2)
+
+    def test_counters_rollup_runs_in_background(self):
+        self.auth(username=uuid_string())
+        with self._request_context(), mock.patch("driftbase.counters.rollup_counter_entries") as rollup:
+            g.redis.conn.delete(g.redis.make_key("counters:rollup:done"))
+            schedule_rollup()
+            self.assertFalse(rollup.called)
+            background._tasks[g.redis.make_key("counters:rollup")].join(timeout=5)
+            self.assertTrue(rollup.called)
@@ -8,6 +8,7 @@ from drift.utils import get_config
 from mock import patch, MagicMock
 
 from driftbase.systesthelper import DriftBaseTestCase
+from driftbase.models.db import User
 from driftbase.utils.test_utils import BaseCloudkitTest
 
 
@@ -69,6 +70,20 @@ class AuthTests(DriftBaseTestCase):
             self.assertEqual(user['provider_user_id'], f"{data['provider']}:"
                                                        f"{data['provider_details']['user_id']}")
 
+    def test_oculus_validation_cache(self):
+        data = {
+            "provider": "oculus",
+            "provider_details": {
+                "nonce": "140000003DED3B",
+                "user_id": "cachedtestuser"
+            }
+        }
+        with patch('driftbase.auth.util.get_feature_switch', return_value=True), \
+                patch('driftbase.auth.oculus.run_ticket_validation', return_value='cachedtestuser') as validation:
+            self.post('/auth', data=data)
+            self.post('/auth', data=data)
+            validation.assert_called_once()
+
     def test_steam_authentication(self):
         # Steam normal authentication check
         data = {
@@ -411,3 +426,53 @@ class SessionCacheTests(BaseCloudkitTest):
         assert set(cached_info.keys()).issubset(set(user.keys()))
         for k, v in cached_info.items():
             assert v == user[k]
+
+
+class IdentityCacheTests(BaseCloudkitTest):
+    def _provider_data(self, username, password='test'):
+        return {
+            'provider': 'user+pass',
+            'provider_details': {
+                'username': username,
+                'password': password,
+            },
+            'automatic_account_creation': True
+        }
+
+    def test_cached_login_skips_db(self):
+        data = self._provider_data('test_identity_cache_user')
+        with patch('driftbase.auth.authenticate.identity_cache_enabled', return_value=True):
+            token1 = self.post('/auth', data=data, expected_status_code=HTTPStatus.OK).json()['token']
+            with patch('driftbase.auth.authenticate._authenticate') as authenticate:
+                token2 = self.post('/auth', data=data, expected_status_code=HTTPStatus.OK).json()['token']
+                authenticate.assert_not_called()
+            self.post('/auth', data=self._provider_data('test_identity_cache_user', 'wrong'),
+                      expected_status_code=HTTPStatus.METHOD_NOT_ALLOWED)
+        user1 = self.get('/', headers={'Authorization': f"BEARER {token1}"}).json()['current_user']
+        user2 = self.get('/', headers={'Authorization': f"BEARER {token2}"}).json()['current_user']
+        for key in ('identity_id', 'user_id', 'player_id', 'player_uuid', 'provider_user_id', 'roles'):
+            self.assertEqual(user1[key], user2[key])
+
+    def test_player_name_change_invalidates_cache(self):
+        data = self._provider_data('test_identity_cache_rename_user')
+        with patch('driftbase.auth.authenticate.identity_cache_enabled', return_value=True):
+            token = self.post('/auth', data=data, expected_status_code=HTTPStatus.OK).json()['token']
+            headers = {'Authorization': f"BEARER {token}"}
+            user = self.get('/', headers=headers).json()['current_user']
+            self.patch(f"/players/{user['player_id']}", data={'name': 'renamed'}, headers=headers)
+            token = self.post('/auth', data=data, expected_status_code=HTTPStatus.OK).json()['token']
+        user = self.get('/', headers={'Authorization': f"BEARER {token}"}).json()['current_user']
+        self.assertEqual(user['player_name'], 'renamed')
+
+    def test_inactive_user_is_not_logged_in_from_cache(self):
+        data = self._provider_data('test_identity_cache_inactive_user')
+        with patch('driftbase.auth.authenticate.identity_cache_enabled', return_value=True):
+            token = self.post('/auth', data=data, expected_status_code=HTTPStatus.OK).json()['token']
+            user = self.get('/', headers={'Authorization': f"BEARER {token}"}).json()['current_user']
+            with self._request_context():
+                flask.g.db.query(User).filter(User.user_id == user['user_id']).update({'status': 'inactive'})
+                flask.g.db.commit()
+            token = self.post('/auth', data=data, expected_status_code=HTTPStatus.OK).json()['token']
+        # Logging in with an inactive user creates a new one
+        new_user = self.get('/', headers={'Authorization': f"BEARER {token}"}).json()['current_user']
+        self.assertNotEqual(new_user['user_id'], user['user_id'])
@@ -3,6 +3,7 @@ import http.client as http_client
 import json
 from mock import patch
 
+from driftbase.clients import flush_client_heartbeats
 from driftbase.utils.test_utils import BaseCloudkitTest
 
 
@@ -59,6 +60,60 @@ class ClientsTest(BaseCloudkitTest):
             mock_date.return_value = datetime.datetime.utcnow() + datetime.timedelta(minutes=5)
             r = self.put(client_uri, expected_status_code=http_client.NOT_FOUND)
 
+    def test_redis_heartbeat(self):
+        self.auth()
+        clients_uri = self.endpoints["clients"]
+        data = {
+            "client_type": "client_type",
+            "build": "build",
+            "platform_type": "platform_type",
+            "app_guid": "app_guid",
+            "version": "version"
+
+        }
+        r = self.post(clients_uri, data=data, expected_status_code=http_client.CREATED)
+        client_uri = r.json()["url"]
+        with patch("driftbase.api.clients.redis_heartbeats_enabled", return_value=True), \
+                patch("driftbase.clients.redis_heartbeats_enabled", return_value=True), \
+                patch("driftbase.clients.flush_client_heartbeats"):
+            r = self.put(client_uri)
+            self.assertEqual(r.json()["num_heartbeats"], 2)
+            r = self.put(client_uri)
+            self.assertEqual(r.json()["num_heartbeats"], 3)
+
+        # Nothing is written until the heartbeats are flushed
+        r = self.get(client_uri)
+        self.assertEqual(r.json()["num_heartbeats"], 1)
+
+        with self._request_context():
+            self.assertEqual(flush_client_heartbeats(), 1)
+
+        r = self.get(client_uri)
+        self.assertEqual(r.json()["num_heartbeats"], 3)
+
+    def test_redis_heartbeat_clients(self):
+        self.auth()
+        clients_uri = self.endpoints["clients"]
+        data = {
+            "client_type": "client_type",
+            "build": "build",
+            "platform_type": "platform_type",
+            "app_guid": "app_guid",
+            "version": "version"
+
+        }
+        client_id = self.post(clients_uri, data=data, expected_status_code=http_client.CREATED).json()["client_id"]
+        with patch("driftbase.api.clients.redis_heartbeats_enabled", return_value=True), \
+                patch("driftbase.clients.redis_heartbeats_enabled", return_value=True):
+            r = self.get(clients_uri, params={"player_id": self.player_id})
+            self.assertIn(client_id, [c["client_id"] for c in r.json()])
+
+            # Clients are only listed while their heartbeat hasn't timed out, even if the db lags behind
+            with patch("driftbase.api.clients.utcnow") as mock_date:
+                mock_date.return_value = datetime.datetime.utcnow() + datetime.timedelta(minutes=5)
+                r = self.get(clients_uri, params={"player_id": self.player_id})
+            self.assertNotIn(client_id, [c["client_id"] for c in r.json()])
+
     def test_platform(self):
         self.auth()
         clients_uri = self.endpoints["clients"]
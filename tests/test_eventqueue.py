@@ -0,0 +1,30 @@
+from unittest.mock import patch
+
+from flask import g
+
+from driftbase import eventqueue
+from driftbase.utils.test_utils import BaseCloudkitTest
+
+
+class EventQueueTest(BaseCloudkitTest):
+    def test_worker_stops_when_it_loses_the_lock(self):
+        processed = []
+
+        def handler(event):
+            processed.append(event)
+            # The worker lock times out while the event is being processed
+            g.redis.conn.delete(eventqueue._make_stream_key("unittest", "worker"))
+
+        with self._request_context(), \
+                patch.dict(eventqueue._handlers, {"unittest": handler}), \
+                patch.object(eventqueue, "_start_worker"):
+            g.redis.conn.delete(eventqueue._make_stream_key("unittest"))
+            for i in range(2):
+                eventqueue.enqueue_event("unittest", {"i": i})
+
+            self.assertEqual(eventqueue.process_event_stream("unittest", idle_timeout=0), 1)
+            self.assertEqual(processed, [{"i": 0}])
+
+            # The next worker picks up the remaining event
+            self.assertEqual(eventqueue.process_event_stream("unittest", idle_timeout=0), 1)
+            self.assertEqual(processed, [{"i": 0}, {"i": 1}])
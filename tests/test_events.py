@@ -65,6 +65,29 @@ class EventsTest(DriftBaseTestCase):
             expected_status_code=http_client.CREATED,
         )
 
+    def test_compressed_events_invalid(self):
+        self.auth()
+        endpoint = self.endpoints["eventlogs"]
+        self.post(
+            endpoint,
+            data=b"not gzip",
+            headers={'Content-Encoding': 'gzip'},
+            expected_status_code=http_client.BAD_REQUEST,
+        )
+
+    def test_events_batch_record(self):
+        self.auth()
+        endpoint = self.endpoints["eventlogs"]
+        ts = datetime.datetime.utcnow().isoformat() + "Z"
+        events = [{"event_name": "dummy", "timestamp": ts, "index": i} for i in range(3)]
+        with mock.patch("driftbase.api.events.get_feature_switch", return_value=True), \
+                mock.patch("driftbase.api.events.eventlogger.info") as eventlog:
+            self.post(endpoint, data=events, expected_status_code=http_client.CREATED)
+        eventlog.assert_called_once()
+        logged_events = eventlog.call_args.kwargs["extra"]["extra"]["events"]
+        self.assertEqual([event["index"] for event in logged_events], [0, 1, 2])
+        self.assertEqual({event["player_id"] for event in logged_events}, {self.player_id})
+
     def test_events_from_server(self):
         # The event log API should enforce the player_id to the current player, unless
         # the user has role "service" in which case it should only set the player_id if
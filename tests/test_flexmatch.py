@@ -3,10 +3,11 @@ import time
 from contextlib import ExitStack
 
 import mock
+from flask import g
 
 from driftbase.utils.test_utils import BaseCloudkitTest
 from unittest.mock import patch
-from driftbase import flexmatch
+from driftbase import eventqueue, flexmatch
 from driftbase.resources.flexmatch import FLEXMATCH_DEFAULTS
 from drift.core.extensions.driftconfig import get_feature_switch
 from datetime import datetime, date, timezone, timedelta
@@ -724,6 +725,22 @@ class FlexMatchTest(_BaseFlexmatchTest):
             r = self.delete(ticket_url, expected_status_code=http_client.OK).json()
             self.assertEqual("CANCELLED", r["status"])
 
+    def test_locked_tickets_with_expired_ticket(self):
+        self._initiate_matchmaking()
+        with self._request_context():
+            key = flexmatch._get_player_ticket_key(self.player_id)
+            # The ticket expires after it has been looked up
+            g.redis.conn.delete(g.redis.conn.get(key))
+            with flexmatch._LockedTickets([key]) as tickets:
+                self.assertIsNone(tickets[key].ticket)
+
+            # If loading the tickets fails, the locks are released
+            with patch.object(flexmatch._LockedTicket, "_set_loaded_ticket", side_effect=RuntimeError("load failed")):
+                with self.assertRaises(RuntimeError):
+                    with flexmatch._LockedTickets([key]):
+                        pass
+            self.assertFalse(g.redis.conn.exists(key + "LOCK"))
+
 
 class FlexMatchEventTest(_BaseFlexmatchTest):
 
@@ -741,6 +758,24 @@ class FlexMatchEventTest(_BaseFlexmatchTest):
         self.assertIsInstance(notification, dict)
         self.assertTrue(notification["event"] == "MatchmakingSearching")
 
+    def test_queued_searching_event(self):
+        user_name, ticket_url, ticket = self._initiate_matchmaking()
+        ticket_id, player_info = ticket["ticket_id"], {"playerId": str(self.player_id)}
+        with patch.object(eventqueue, "async_events_enabled", return_value=True), \
+                patch.object(eventqueue, "_start_worker"):
+            with self.as_bearer_token_user(EVENTS_ROLE):
+                details = self._get_event_details(ticket_id, player_info, "MatchmakingSearching")
+                data = self._get_event_data(details)
+                self.put(self.endpoints["flexmatch_events"], data=data, expected_status_code=http_client.OK)
+        # The event is only processed by the queue worker
+        self.auth(username=user_name)
+        r = self.get(ticket_url, expected_status_code=http_client.OK).json()
+        self.assertEqual(r['ticket_status'], "QUEUED")
+        with self._request_context():
+            self.assertGreaterEqual(eventqueue.process_event_stream("flexmatch", idle_timeout=0), 1)
+        r = self.get(ticket_url, expected_status_code=http_client.OK).json()
+        self.assertEqual(r['ticket_status'], "SEARCHING")
+
     def test_potential_match_event(self):
         user_name, ticket_url, ticket = self._initiate_matchmaking()
         events_url = self.endpoints["flexmatch_events"]
@@ -1107,3 +1142,28 @@ class MockGameLiftClient(object):
 
     def accept_match(self, **kwargs):
         return {}
+
+
+class GameLiftReadCacheTest(BaseCloudkitTest):
+    def test_game_session_is_cached_until_invalidated(self):
+        arn = f"arn:aws:gamelift:eu-west-1::gamesession/fleet-{uuid.uuid4()}/{uuid.uuid4()}"
+        game_sessions = {"GameSessions": [{"GameSessionId": arn, "Status": "ACTIVE",
+                                           "CreationTime": datetime.now(timezone.utc)}]}
+        with self._request_context(), \
+                patch.object(flexmatch, "gamelift_read_cache_enabled", return_value=True), \
+                patch.object(flexmatch, "describe_game_sessions", return_value=game_sessions) as describe_mock:
+            self.assertEqual(flexmatch.get_game_session(arn)["Status"], "ACTIVE")
+            self.assertEqual(flexmatch.get_game_session(arn)["Status"], "ACTIVE")
+            self.assertEqual(describe_mock.call_count, 1)
+            flexmatch.invalidate_game_session_cache(arn)
+            flexmatch.get_game_session(arn)
+            self.assertEqual(describe_mock.call_count, 2)
+
+    def test_missing_game_session_is_cached(self):
+        arn = f"arn:aws:gamelift:eu-west-1::gamesession/fleet-{uuid.uuid4()}/{uuid.uuid4()}"
+        with self._request_context(), \
+                patch.object(flexmatch, "gamelift_read_cache_enabled", return_value=True), \
+                patch.object(flexmatch, "describe_game_sessions", return_value={"GameSessions": []}) as describe_mock:
+            self.assertEqual(flexmatch.get_game_sessions([arn, arn]), {arn: None})
+            self.assertIsNone(flexmatch.get_game_session(arn))
+            self.assertEqual(describe_mock.call_count, 1)
@@ -0,0 +1,67 @@
+import time
+
+import prometheus_client
+from flask import g
+from sqlalchemy import text
+
+from driftbase.extensions import instrumentation
+from driftbase.utils.test_utils import BaseCloudkitTest
+
+
+def get_sample_value(name, labels):
+    return prometheus_client.REGISTRY.get_sample_value(name, labels) or 0
+
+
+class InstrumentationTest(BaseCloudkitTest):
+    """
+    Tests for the per-endpoint request instrumentation
+    """
+
+    def test_counts_sql_statements_and_redis_commands(self):
+        with self._request_context():
+            # Make sure the connections are set up before counting
+            g.redis.conn.ping()
+            g.db.execute(text("SELECT 1"))
+
+            instrumentation._before_request()
+            g.redis.conn.get(g.redis.make_key("instrumentation:test"))
+            with g.redis.conn.pipeline() as pipe:
+                pipe.get(g.redis.make_key("instrumentation:test"))
+                pipe.get(g.redis.make_key("instrumentation:test"))
+                pipe.execute()
+            g.db.execute(text("SELECT 1"))
+            g.db.execute(text("SELECT 2"))
+
+            self.assertEqual(g.request_stats.num_redis_commands, 3)
+            self.assertEqual(sum(g.request_stats.sql_statements.values()), 2)
+
+    def test_endpoint_counts(self):
+        self.make_player()
+        labels = {"endpoint": "messages.exchange"}
+        num_requests = get_sample_value("driftbase_request_redis_commands_count", labels)
+        num_redis_commands = get_sample_value("driftbase_request_redis_commands_sum", labels)
+        num_sql_statements = get_sample_value("driftbase_request_sql_statements_sum", labels)
+
+        self.get(self.endpoints["my_messages"])
+
+        self.assertEqual(get_sample_value("driftbase_request_redis_commands_count", labels), num_requests + 1)
+        self.assertEqual(get_sample_value("driftbase_request_sql_statements_count", labels), num_requests + 1)
+        # Reading the messages is all Redis
+        self.assertGreater(get_sample_value("driftbase_request_redis_commands_sum", labels), num_redis_commands)
+        self.assertEqual(get_sample_value("driftbase_request_sql_statements_sum", labels), num_sql_statements)
+
+    def test_streamed_request_is_recorded_when_sent(self):
+        self.make_player()
+        labels = {"endpoint": "messages.exchange", "method": "GET", "status": "200"}
+        num_requests = get_sample_value("driftbase_request_duration_seconds_count", labels)
+        total_latency = get_sample_value("driftbase_request_duration_seconds_sum", labels)
+
+        # A long poll with no messages is sent after it times out
+        self.get(self.endpoints["my_messages"] + "?timeout=1")
+
+        end = time.time() + 5
+        while get_sample_value("driftbase_request_duration_seconds_count", labels) == num_requests \
+                and time.time() < end:
+            time.sleep(0.1)
+        self.assertEqual(get_sample_value("driftbase_request_duration_seconds_count", labels), num_requests + 1)
+        self.assertGreaterEqual(get_sample_value("driftbase_request_duration_seconds_sum", labels) - total_latency, 1)
@@ -2,11 +2,16 @@ import http.client as http_client
 import copy
 import typing
 import datetime
+import uuid
+
+from flask import g
 
 from driftbase.utils.test_utils import BaseCloudkitTest
 from unittest.mock import patch
 from driftbase import flexmatch, lobbies, parties
 from driftbase.utils.exceptions import NotFoundException, UnauthorizedException, InvalidRequestException
+from driftbase.utils import redis_utils
+from driftbase.utils.redis_utils import JsonLock, get_json
 
 MOCK_LOBBY = {
     "create_date": "2021-09-24T16:15:08.758448",
@@ -387,10 +392,89 @@ class TestLobbyMemberAPI(_BaseLobbyTest):
 
             self._assert_error(response, expected_description=MOCK_ERROR)
 
+
+# /lobbies/public
+class TestPublicLobbiesAPI(_BaseLobbyTest):
+    def test_get_api(self):
+        map_name = f"map {uuid.uuid4()}"
+        self.make_player()
+        self.assertIn("public_lobbies", self.endpoints)
+        public_lobbies_url = self.endpoints["public_lobbies"]
+        self.create_lobby({"team_capacity": 4, "team_names": ["1", "2"], "lobby_name": "Public Lobby",
+                           "map_name": map_name, "public": True})
+        public_lobby_id = self.lobby_id
+        public_lobby_members_url = self.lobby_members_url
+
+        self.make_player()
+        self.create_lobby({"team_capacity": 4, "team_names": ["1", "2"], "lobby_name": "Private Lobby",
+                           "map_name": map_name})
+        private_lobby_id = self.lobby_id
+
+        response = self.get(public_lobbies_url, params={"map_name": map_name}).json()
+        self.assertEqual([lobby["lobby_id"] for lobby in response], [public_lobby_id])
+        self.assertEqual(response[0]["free_slots"], 7)
+        self.assertEqual(response[0]["lobby_members_url"], public_lobby_members_url)
+
+        response = self.get(public_lobbies_url, params={"map_name": map_name, "lobby_name": "PUBLIC"}).json()
+        self.assertEqual(len(response), 1)
+        response = self.get(public_lobbies_url, params={"map_name": map_name, "lobby_name": "private"}).json()
+        self.assertEqual(len(response), 0)
+        response = self.get(public_lobbies_url, params={"map_name": map_name, "min_free_slots": 8}).json()
+        self.assertEqual(len(response), 0)
+
+        # Private lobbies aren't listed, even if they find their way into the index
+        with self._request_context():
+            private_lobby = get_json(lobbies._get_lobby_key(private_lobby_id))
+            lobbies._update_public_lobby_index(private_lobby_id, dict(private_lobby, public=True))
+        response = self.get(public_lobbies_url, params={"map_name": map_name}).json()
+        self.assertEqual([lobby["lobby_id"] for lobby in response], [public_lobby_id])
+
+        # Joining and leaving updates the free slots
+        self.make_player()
+        self.join_lobby(public_lobby_members_url)
+        response = self.get(public_lobbies_url, params={"map_name": map_name}).json()
+        self.assertEqual(response[0]["free_slots"], 6)
+        self.leave_lobby()
+        response = self.get(public_lobbies_url, params={"map_name": map_name}).json()
+        self.assertEqual(response[0]["free_slots"], 7)
+
+        # Making the lobby private removes it
+        self.make_player()
+        self.create_lobby({"team_capacity": 1, "team_names": ["1"], "map_name": map_name, "public": True})
+        response = self.get(public_lobbies_url, params={"map_name": map_name, "min_free_slots": 0}).json()
+        self.assertEqual(len(response), 2)
+        self.patch(self.lobby_url, data={"public": False}, expected_status_code=http_client.NO_CONTENT)
+        response = self.get(public_lobbies_url, params={"map_name": map_name, "min_free_slots": 0}).json()
+        self.assertEqual([lobby["lobby_id"] for lobby in response], [public_lobby_id])
+
+    def test_expired_lobby_is_removed(self):
+        map_name = f"map {uuid.uuid4()}"
+        self.make_player()
+        public_lobbies_url = self.endpoints["public_lobbies"]
+        self.create_lobby({"team_capacity": 4, "team_names": ["1", "2"], "map_name": map_name, "public": True})
+        with self._request_context():
+            lobby_key = lobbies._get_lobby_key(self.lobby_id)
+            map_index_key = lobbies._get_public_lobbies_map_key(map_name)
+            g.redis.conn.delete(lobby_key)
+            # A lobby being created with the same id is locked, and isn't dropped from the indexes
+            g.redis.conn.set(lobby_key + "LOCK", "token")
+
+        self.assertEqual(self.get(public_lobbies_url, params={"map_name": map_name}).json(), [])
+        with self._request_context():
+            self.assertIsNotNone(g.redis.conn.zscore(map_index_key, self.lobby_id))
+            g.redis.conn.delete(lobby_key + "LOCK")
+
+        self.assertEqual(self.get(public_lobbies_url, params={"map_name": map_name}).json(), [])
+        with self._request_context():
+            self.assertIsNone(g.redis.conn.zscore(map_index_key, self.lobby_id))
+            self.assertIsNone(g.redis.conn.zscore(lobbies._get_public_lobbies_key(), self.lobby_id))
+
+
 """
 Lobby implementation
 """
 
+
 class LobbiesTest(_BaseLobbyTest):
     # Get lobby
 
@@ -433,12 +517,10 @@ class LobbiesTest(_BaseLobbyTest):
         self.make_player()
         self.create_lobby()
 
-        with patch.object(lobbies, "JsonLock", _MockJsonLock) as mocked_lobby_lock:
-            mocked_lobby = copy.deepcopy(self.lobby)
-            mocked_lobby["status"] = "started"
-            mocked_lobby["connection_string"] = "1.1.1.1:1337"
-            mocked_lobby_lock.mocked_value = mocked_lobby
-
+        mocked_lobby = copy.deepcopy(self.lobby)
+        mocked_lobby["status"] = "started"
+        mocked_lobby["connection_string"] = "1.1.1.1:1337"
+        with patch.object(lobbies, "get_json", return_value=mocked_lobby):
             self.load_player_lobby()
 
             self.assertIn("connection_options", self.lobby)
@@ -452,12 +534,10 @@ class LobbiesTest(_BaseLobbyTest):
         self.put(self.lobby_member_url, data={"team_name": "1"}, expected_status_code=http_client.NO_CONTENT)
         self.load_player_lobby()
 
-        with patch.object(lobbies, "JsonLock", _MockJsonLock) as mocked_lobby_lock:
-            mocked_lobby = copy.deepcopy(self.lobby)
-            mocked_lobby["status"] = "started"
-            mocked_lobby["connection_string"] = "1.1.1.1:1337"
-            mocked_lobby_lock.mocked_value = mocked_lobby
-
+        mocked_lobby = copy.deepcopy(self.lobby)
+        mocked_lobby["status"] = "started"
+        mocked_lobby["connection_string"] = "1.1.1.1:1337"
+        with patch.object(lobbies, "get_json", return_value=mocked_lobby):
             mocked_player_session_id = "PlayerSession=123456"
             with patch.object(lobbies, "_ensure_player_session", return_value=mocked_player_session_id):
                 self.load_player_lobby()
@@ -1393,6 +1473,60 @@ class LobbiesTest(_BaseLobbyTest):
         self.assertEqual(notification_data["lobby_id"], self.lobby_id)
         self.assertIn("members", notification_data)
 
+    def test_update_lobby_member_retries_on_conflicting_update(self):
+        self.make_player()
+        self.create_lobby()
+
+        attempts = []
+
+        def conflicting_update_json(key, update):
+            def update_lobby(lobby):
+                attempts.append(lobby)
+                if len(attempts) == 1:
+                    # Someone else updates the lobby under the lock before this update is written
+                    with JsonLock(key) as lobby_lock:
+                        lobby_lock.value = dict(lobby_lock.value, lobby_name="Renamed")
+                return update(lobby)
+            return redis_utils.update_json(key, update_lobby)
+
+        with self._request_context(), patch.object(lobbies, "update_json", side_effect=conflicting_update_json):
+            lobbies.update_lobby_member(self.player_id, self.player_id, self.lobby_id, "1", None)
+
+        self.assertEqual(len(attempts), 2)
+        self.load_player_lobby()
+        self.assertEqual(self.lobby["lobby_name"], "Renamed")
+        self.assertEqual(self.get_lobby_member()["team_name"], "1")
+
+    def test_update_lobby_member_lobby_deleted_while_updating(self):
+        self.make_player()
+        self.create_lobby()
+
+        def disappearing_update_json(key, update):
+            def update_lobby(lobby):
+                if lobby is not None:
+                    # The lobby expires after it's read, but before the update is written
+                    g.redis.conn.delete(key)
+                return update(lobby)
+            return redis_utils.update_json(key, update_lobby)
+
+        with self._request_context(), patch.object(lobbies, "update_json", side_effect=disappearing_update_json):
+            with self.assertRaises(NotFoundException):
+                lobbies.update_lobby_member(self.player_id, self.player_id, self.lobby_id, "1", None)
+
+    def test_update_lobby_member_falls_back_to_lock(self):
+        self.make_player()
+        self.create_lobby()
+
+        # Every attempt to write the update conflicts, until it's made under the lock
+        with self._request_context(), patch.object(redis_utils, "OPERATION_TIMEOUT", 0.1), \
+                patch.object(redis_utils, "_get_compare_and_set_script", return_value=lambda keys, args: 0):
+            lobbies.update_lobby_member(self.player_id, self.player_id, self.lobby_id, "1", None)
+            self.assertFalse(g.redis.conn.exists(lobbies._get_lobby_key(self.lobby_id) + "LOCK"))
+
+        self.load_player_lobby()
+        self.assertEqual(self.get_lobby_member()["team_name"], "1")
+
+
 class _MockJsonLock(object):
     mocked_value = None
 
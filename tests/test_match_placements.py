@@ -4,6 +4,7 @@ import copy
 
 from driftbase.utils.test_utils import BaseCloudkitTest
 from unittest.mock import patch
+from flask import g
 from driftbase import match_placements, lobbies, flexmatch
 from driftbase.utils.exceptions import NotFoundException, UnauthorizedException, InvalidRequestException, ForbiddenException
 from tests import test_lobbies
@@ -511,6 +512,71 @@ class MatchPlacementsTest(_BaseMatchPlacementTest):
         self.assertGreaterEqual(len(placements), 1)
         self.assertIn(self.match_placement, placements)
 
+    def test_public_match_placements_drop_terminated_game_sessions(self):
+        self.make_player()
+        self.create_match_placement({
+            "queue": "yup",
+            "identifier": "1234",
+            "map_name": "map",
+            "max_players": 2,
+            "is_public": True
+        })
+        placements_url = f"{self.endpoints['public_match_placements']}"
+        with self.as_bearer_token_user("flexmatch_event"):
+            event = copy.deepcopy(MOCK_GAMELIFT_QUEUE_EVENT)
+            event["detail"]["placementId"] = self.match_placement_id
+            self.put(self.endpoints["flexmatch_queue"], data=event, expected_status_code=http_client.OK)
+            self.match_placement["status"] = "completed"
+
+        self.make_player()
+        game_sessions = copy.deepcopy(MOCK_GAME_SESSIONS)
+        game_sessions["GameSessions"][0]["Status"] = "TERMINATED"
+        with patch.object(flexmatch, "describe_game_sessions", return_value=game_sessions) as describe_mock:
+            placements = self.get(placements_url, expected_status_code=http_client.OK).json()
+            self.assertNotIn(self.match_placement_id, [p["placement_id"] for p in placements])
+            self.assertTrue(describe_mock.called)
+
+        # Terminated game sessions are dropped from the index, so GameLift isn't asked again
+        game_sessions["GameSessions"][0]["Status"] = "ACTIVE"
+        with patch.object(flexmatch, "describe_game_sessions", return_value=game_sessions):
+            placements = self.get(placements_url, expected_status_code=http_client.OK).json()
+        self.assertNotIn(self.match_placement_id, [p["placement_id"] for p in placements])
+
+    def test_public_match_placements_are_backfilled(self):
+        self.make_player()
+        self.create_match_placement({
+            "queue": "yup",
+            "identifier": "1235",
+            "map_name": "map",
+            "max_players": 2,
+            "is_public": True
+        })
+        with self.as_bearer_token_user("flexmatch_event"):
+            event = copy.deepcopy(MOCK_GAMELIFT_QUEUE_EVENT)
+            event["detail"]["placementId"] = self.match_placement_id
+            self.put(self.endpoints["flexmatch_queue"], data=event, expected_status_code=http_client.OK)
+            self.match_placement["status"] = "completed"
+
+        # Forget the placement was ever indexed, as if it completed before the index existed
+        with self._request_context():
+            g.redis.conn.zrem(match_placements._get_public_match_placements_key(), self.match_placement_id)
+            g.redis.conn.delete(match_placements._get_public_match_placements_backfilled_key())
+
+            # A backfill which doesn't complete is retried once its marker expires
+            with patch.object(g.redis.conn, "scan_iter", side_effect=ConnectionError("scan failed")):
+                with self.assertRaises(ConnectionError):
+                    match_placements._backfill_public_match_placements()
+            backfilled_key = match_placements._get_public_match_placements_backfilled_key()
+            self.assertGreater(g.redis.conn.ttl(backfilled_key), 0)
+            g.redis.conn.delete(backfilled_key)
+
+        self.make_player()
+        game_sessions = copy.deepcopy(MOCK_GAME_SESSIONS)
+        game_sessions["GameSessions"][0]["Status"] = "ACTIVE"
+        with patch.object(flexmatch, "describe_game_sessions", return_value=game_sessions):
+            placements = self.get(self.endpoints["public_match_placements"], expected_status_code=http_client.OK).json()
+        self.assertIn(self.match_placement_id, [p["placement_id"] for p in placements])
+
     def test_join_active_public_match_placement(self):
         self.make_player()
         self.create_match_placement({
@@ -126,6 +126,25 @@ class MatchesTest(BaseMatchTest):
         self.assertIn("players", match)
         self.assertIn("teams", match)
 
+    def test_get_matches_keyset_pagination(self):
+        self.auth_service()
+        for _ in range(5):
+            self._create_match()
+
+        params = {"keyset_pagination": True, "per_page": 2, "include_match_players": True}
+        resp_json = self.get("/matches", params=dict(params, include_total=True)).json()
+        self.assertTrue(resp_json["total"] >= 5)
+        self.assertEqual(len(resp_json["items"]), 2)
+        self.assertIn("players", resp_json["items"][0])
+        self.assertIn("teams", resp_json["items"][0])
+
+        match_ids = [m["match_id"] for m in resp_json["items"]]
+        next_resp = self.get("/matches", params=dict(params, before_match_id=resp_json["next_before_match_id"])).json()
+        self.assertNotIn("total", next_resp)
+        match_ids += [m["match_id"] for m in next_resp["items"]]
+        self.assertEqual(match_ids, sorted(match_ids, reverse=True))
+        self.assertEqual(len(set(match_ids)), 4)
+
     def test_match_information(self):
         self.make_player()
         player_id_1 = self.player_id
@@ -621,6 +640,34 @@ class MatchesTest(BaseMatchTest):
         resp = self.get(self.endpoints["active_matches"])
         self.assertEqual(len(self._filter_matches(resp, [match_id])), 0)
 
+    def test_active_matches_player_filter_applies_before_rows(self):
+        self.auth(username=uuid_string())
+        player_id = self.player_id
+        self.auth_service()
+
+        match = self._create_match(max_players=4)
+        match_id = match["match_id"]
+        self.post(match["teams_url"], data={}, expected_status_code=http_client.CREATED)
+        team_id = self.get(match["teams_url"]).json()[0]["team_id"]
+        self.post(match["matchplayers_url"], data={"player_id": player_id, "team_id": team_id},
+                  expected_status_code=http_client.CREATED)
+        # Fuller matches are listed first, so these would fill the page if the player filter came after the limit
+        for _ in range(2):
+            other = self._create_match(max_players=4)
+            self.post(other["teams_url"], data={}, expected_status_code=http_client.CREATED)
+            other_team_id = self.get(other["teams_url"]).json()[0]["team_id"]
+            for _ in range(2):
+                self.auth(username=uuid_string())
+                other_player_id = self.player_id
+                self.auth_service()
+                self.post(other["matchplayers_url"], data={"player_id": other_player_id, "team_id": other_team_id},
+                          expected_status_code=http_client.CREATED)
+
+        resp = self.get(self.endpoints["active_matches"] + "?rows=1&player_id=%s" % player_id)
+        self.assertEqual(len(resp.json()), 1)
+        self.assertEqual(resp.json()[0]["match_id"], match_id)
+        self.assertEqual([p["player_id"] for p in resp.json()[0]["players"]], [player_id])
+
     def test_unique_match(self):
         self.auth_service()
         # Create a match with a unique_key
@@ -1,8 +1,11 @@
 import collections
 import datetime
 import http.client as http_client
+from flask import g
 from mock import patch
 from drift.test_helpers.systesthelper import uuid_string
+from driftbase.config import get_server_heartbeat_config
+from driftbase.models.db import Server
 from driftbase.utils.test_utils import BaseMatchTest
 
 
@@ -199,6 +202,35 @@ class MatchQueueTest(BaseMatchTest):
 
             r = self.get(matchqueueplayer_url, expected_status_code=http_client.NOT_FOUND)
 
+    def test_matchqueue_redis_server_heartbeats(self):
+        self.auth_service()
+        self.clear_queue()
+        match = self._create_match()
+        server = self.get(match["server_url"]).json()
+        matchqueue_url = self.endpoints["matchqueue"]
+        with patch("driftbase.heartbeats.redis_heartbeats_enabled", return_value=True), \
+                patch("driftbase.api.servers.redis_heartbeats_enabled", return_value=True), \
+                patch("driftbase.heartbeats.flush_server_heartbeats"):
+            self.put(server["heartbeat_url"])
+
+            # The heartbeat flushed to the db has timed out but the one recorded in Redis hasn't
+            with self._request_context():
+                _, heartbeat_timeout = get_server_heartbeat_config()
+                heartbeat_date = datetime.datetime.utcnow() - datetime.timedelta(seconds=heartbeat_timeout + 1)
+                g.db.query(Server).filter(Server.server_id == server["server_id"]) \
+                    .update({Server.heartbeat_date: heartbeat_date})
+                g.db.commit()
+
+            for _ in range(2):
+                self.make_player()
+                data = {"player_id": self.player_id}
+                self.post(matchqueue_url, data=data, expected_status_code=http_client.CREATED)
+
+            r = self.get(matchqueue_url + "?status=matched")
+            self.assertEqual(len(r.json()), 2)
+            self.assertEqual(r.json()[0]["match_id"], match["match_id"])
+            self.assertEqual(r.json()[1]["match_id"], match["match_id"])
+
     def test_matchqueue_lock_conflict(self):
         # create a match
         self.auth_service()
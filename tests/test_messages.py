@@ -1,8 +1,10 @@
 import datetime
 import http.client
 import urllib
+from flask import g
 from mock import patch
 
+import driftbase.messages
 from driftbase.utils.test_utils import BaseCloudkitTest
 
 
@@ -226,6 +228,33 @@ class MessagesTest(BaseCloudkitTest):
         for queue, messages in r.items():
             self.assertEqual(len(messages), num_messages_per_queue)
 
+    def test_messages_bulk(self):
+        receivers = []
+        for _ in range(3):
+            self.make_player()
+            receivers.append((self.player_id, self.endpoints["my_messages"], dict(self.headers)))
+        player_ids = [r[0] for r in receivers]
+
+        # the same payload to every player, and a different payload to each player
+        payloads = {player_id: {"Hello": player_id} for player_id in player_ids}
+        with self._request_context():
+            bulk_result = driftbase.messages.post_messages_bulk("players", player_ids, "bulkqueue",
+                                                                {"Hello": "World"}, sender_system=True)
+            batch_result = driftbase.messages.post_messages_batch("players", "batchqueue", payloads,
+                                                                  sender_system=True)
+        self.assertEqual(set(bulk_result.keys()), set(player_ids))
+        self.assertEqual(set(batch_result.keys()), set(player_ids))
+
+        for player_id, messages_url, headers in receivers:
+            self.headers = headers
+            r = self.get(messages_url).json()
+            for queue, result, payload in (("bulkqueue", bulk_result, {"Hello": "World"}),
+                                           ("batchqueue", batch_result, payloads[player_id])):
+                self.assertEqual(len(r[queue]), 1)
+                self.assertEqual(r[queue][0]["message_id"], result[player_id]["message_id"])
+                self.assertEqual(r[queue][0]["exchange_id"], player_id)
+                self.assertEqual(r[queue][0]["payload"], payload)
+
     def test_messages_longpoll(self):
         player_receiver_endpoint, receiver_headers = self.make_player_message_endpoint_and_session()
         messagequeue_url_template, messages_url = self.get_messages_url(player_receiver_endpoint)
@@ -247,6 +276,78 @@ class MessagesTest(BaseCloudkitTest):
         self.assertIn("payload", r.json()["testqueue"][0])
         self.assertIn("Hello", r.json()["testqueue"][0]["payload"])
 
+    def test_messages_longpoll_idle(self):
+        player_receiver_endpoint, receiver_headers = self.make_player_message_endpoint_and_session()
+        messagequeue_url_template, messages_url = self.get_messages_url(player_receiver_endpoint)
+
+        # an idle long poll checks for messages when it starts and once more when it times out, not while waiting
+        with patch("driftbase.messages.fetch_messages", wraps=driftbase.messages.fetch_messages) as fetch_messages:
+            r = self.get(messages_url + "?timeout=3")
+        self.assertEqual(r.json(), {})
+        self.assertEqual(fetch_messages.call_count, 2)
+
+    def test_messages_listener_reconnects(self):
+        self.make_player()
+        with self._request_context():
+            with driftbase.messages.wait_for_messages("players", self.player_id) as new_messages:
+                # the channel is subscribed to once waiting starts, so a message posted right away isn't missed
+                driftbase.messages.post_message("players", self.player_id, "testqueue", {}, sender_system=True)
+                self.assertTrue(new_messages.wait(1))
+
+                # waiters are woken when the subscription is lost, since messages may be missed
+                new_messages.clear()
+                g.redis.conn.client_kill_filter(_type="pubsub")
+                self.assertTrue(new_messages.wait(1))
+
+                # and the listener subscribes again by itself
+                with driftbase.messages.wait_for_messages("players", self.player_id):
+                    pass
+                new_messages.clear()
+                driftbase.messages.post_message("players", self.player_id, "testqueue", {}, sender_system=True)
+                self.assertTrue(new_messages.wait(1))
+
+    def test_messages_stream(self):
+        player_receiver_endpoint, receiver_headers = self.make_player_message_endpoint_and_session()
+        messagequeue_url_template, messages_url = self.get_messages_url(player_receiver_endpoint)
+        stream_url = self.endpoints["my_messages_stream"]
+
+        # send two messages from another player
+        player_sender = self.make_player()
+        messagequeue_url = messagequeue_url_template.format(queue="testqueue")
+        first_message_id = self.post(messagequeue_url, data={"message": {"Hello": "World"}},
+                                     expected_status_code=http.client.OK).json()["message_id"]
+        second_message_id = self.post(messagequeue_url, data={"message": {"Hello": "Again"}},
+                                      expected_status_code=http.client.OK).json()["message_id"]
+
+        # switch to the receiver player
+        self.headers = receiver_headers
+
+        r = self.get(stream_url + "?timeout=1")
+        self.assertTrue(r.headers["Content-Type"].startswith("text/event-stream"))
+        events = [e for e in r.text.split("\n\n") if e.startswith("id:")]
+        self.assertEqual(len(events), 2)
+        self.assertTrue(events[0].startswith("id: {}\n".format(first_message_id)))
+        self.assertIn("World", events[0])
+        self.assertTrue(events[1].startswith("id: {}\n".format(second_message_id)))
+
+        # resume after the first message
+        self.headers["Last-Event-ID"] = first_message_id
+        r = self.get(stream_url + "?timeout=1")
+        events = [e for e in r.text.split("\n\n") if e.startswith("id:")]
+        self.assertEqual(len(events), 1)
+        self.assertIn("Again", events[0])
+
+    def test_messages_stream_idle(self):
+        self.make_player_message_endpoint_and_session()
+        stream_url = self.endpoints["my_messages_stream"]
+
+        # an idle stream checks for messages on every keepalive, in case a notification was missed
+        with patch("driftbase.api.messages.STREAM_KEEPALIVE_SECONDS", 1), \
+                patch("driftbase.messages.fetch_messages", wraps=driftbase.messages.fetch_messages) as fetch_messages:
+            r = self.get(stream_url + "?timeout=3")
+        self.assertIn(": keepalive", r.text)
+        self.assertGreater(fetch_messages.call_count, 1)
+
     def test_message_expiry(self):
         player_receiver_endpoint, receiver_headers = self.make_player_message_endpoint_and_session()
         messagequeue_url_template, messages_url = self.get_messages_url(player_receiver_endpoint)
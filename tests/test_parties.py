@@ -3,6 +3,8 @@ from unittest.mock import patch
 
 import http.client as http_client
 
+from flask import g
+
 from driftbase import parties
 from driftbase.utils.test_utils import BaseCloudkitTest
 
@@ -433,6 +435,97 @@ class PartiesTest(BaseCloudkitTest):
             notification, message_number = self.get_party_notification('invite')
             self.patch(notification['invite_url'], data={'inviter_id': host_id}, expected_status_code=http_client.CONFLICT).json()
 
+    def test_accept_party_invite_leaving_a_party_of_two_disbands_it(self):
+        host_user_1 = self.make_user_name("Host 1")
+        guest_user = self.make_user_name("Guest")
+        host_user_2 = self.make_user_name("Host 2")
+
+        self.make_named_player(guest_user, "Amy")
+        guest_id = self.player_id
+        self.make_named_player(host_user_2, "Alice")
+        host_2_id = self.player_id
+        self.make_named_player(host_user_1, "Joe")
+        host_1_id = self.player_id
+
+        # Form a party of host 1 and the guest
+        self.post(self.endpoints["party_invites"], data={'player_id': guest_id}, expected_status_code=http_client.CREATED)
+        self.auth(username=guest_user)
+        notification, message_number = self.get_party_notification('invite')
+        old_party_url = self.patch(notification['invite_url'], data={'inviter_id': host_1_id}).json()['party_url']
+
+        # Host 2 isn't in a party, so accepting their invite forms a new party
+        self.auth(username=host_user_2)
+        self.post(self.endpoints["party_invites"], data={'player_id': guest_id}, expected_status_code=http_client.CREATED)
+        self.auth(username=guest_user)
+        notification, _ = self.get_party_notification('invite', message_number)
+        accept = self.patch(notification['invite_url'],
+                            data={'inviter_id': host_2_id, "leave_existing_party": True}).json()
+        self.assertNotEqual(accept['party_url'], old_party_url)
+        party = self.get(accept['party_url']).json()
+        self.check_expected_players_in_party(party, [(host_2_id, "Alice"), (guest_id, "Amy")])
+
+        # Host 1 was left alone, so the old party was disbanded
+        self.auth(username=host_user_1)
+        self.get(self.endpoints["parties"], expected_status_code=http_client.NOT_FOUND)
+        notification, _ = self.get_party_notification('disbanded')
+        self.assertIsNotNone(notification)
+
+    def test_accept_party_invite_to_full_party_keeps_existing_party(self):
+        with patch.object(parties, 'get_max_players_per_party', return_value=2):
+            guest_user = self.make_user_name("Guest")
+            self.make_named_player(guest_user)
+            guest_id = self.player_id
+            other_user = self.make_user_name("Other")
+            self.make_named_player(other_user)
+            other_id = self.player_id
+            host_user_2 = self.make_user_name("Host 2")
+            self.make_named_player(host_user_2)
+            host_2_id = self.player_id
+            host_user_1 = self.make_user_name("Host 1")
+            self.make_named_player(host_user_1)
+            host_1_id = self.player_id
+
+            # Invite the guest to host 1's party before it fills up
+            self.post(self.endpoints["party_invites"], data={'player_id': guest_id},
+                      expected_status_code=http_client.CREATED)
+            self.post(self.endpoints["party_invites"], data={'player_id': other_id},
+                      expected_status_code=http_client.CREATED)
+            self.auth(username=other_user)
+            notification, _ = self.get_party_notification('invite')
+            self.patch(notification['invite_url'], data={'inviter_id': host_1_id}, expected_status_code=http_client.OK)
+
+            # The guest joins host 2's party
+            self.auth(username=host_user_2)
+            self.post(self.endpoints["party_invites"], data={'player_id': guest_id},
+                      expected_status_code=http_client.CREATED)
+            self.auth(username=guest_user)
+            invites = [message['payload'] for message in self.get(self.endpoints["my_messages"]).json()['party_notification']
+                       if message['payload'].get('event') == 'invite']
+            invite_urls = {invite['inviting_player_id']: invite['invite_url'] for invite in invites}
+            party_url = self.patch(invite_urls[host_2_id], data={'inviter_id': host_2_id}).json()['party_url']
+
+            # Host 1's party is full, so the guest stays in host 2's party
+            self.patch(invite_urls[host_1_id], data={'inviter_id': host_1_id, "leave_existing_party": True},
+                       expected_status_code=http_client.CONFLICT)
+            party = self.get(self.endpoints["parties"], expected_status_code=http_client.OK).json()
+            self.assertEqual(party['url'], party_url)
+            self.assertEqual({member['id'] for member in party['members']}, {host_2_id, guest_id})
+
+    def test_set_player_party_is_idempotent(self):
+        self.make_player()
+        player_1_id = self.player_id
+        self.make_player()
+        player_2_id = self.player_id
+        with self._request_context():
+            party_id = g.redis.conn.incr(g.redis.make_key("party:id:"))
+            self.assertEqual(parties.set_player_party(player_1_id, party_id), set())
+            self.assertEqual(parties.set_player_party(player_2_id, party_id), {str(player_1_id)})
+            # Setting the party again changes nothing
+            self.assertIsNone(parties.set_player_party(player_2_id, party_id))
+            self.assertIsNone(parties.set_player_party(player_1_id, party_id))
+            self.assertEqual(sorted(parties.get_party_members(party_id)), sorted([player_1_id, player_2_id]))
+            self.assertEqual(parties.get_player_party(player_2_id), party_id)
+
     def check_expected_players_in_party(self, party, expected_players):
         """
         Check that all players in expected_players are in the party, and nobody else
@@ -128,6 +128,30 @@ class SandboxTest(BaseCloudkitTest):
         self.assertIn("game_session", data)
         self.assertIn("connection_info", data)
 
+    def test_join_completed_placement_before_match_is_registered(self):
+        self.make_player()
+        location_id = self.location_id()
+        placement_id = f"SB-Experience-{location_id}"
+        with patch.object(flexmatch, "start_game_session_placement", return_value={"placement_id": placement_id}):
+            self.put(f"{self.endpoints['sandbox']}/{location_id}", expected_status_code=http_client.CREATED)
+        event = json.loads(MOCK_GAMELIFT_QUEUE_EVENT % dict(placement_id=placement_id, player_id=self.player_id,
+                                                 event_type="PlacementFulfilled"))
+        with patch.object(flexmatch, "_get_flexmatch_config_value",
+                          return_value=f"arn:aws:iam::{event.get('account')}:role/dg-drift-flexmatch"):
+            with self.as_bearer_token_user(EVENTS_ROLE):
+                self.put(self.endpoints["flexmatch_queue"], data=event, expected_status_code=http_client.OK)
+
+        # Another player joins before the server has registered its match, and goes straight to the game session
+        self.make_player()
+        game_sessions = json.loads(MOCK_GAME_SESSIONS % dict(status="ACTIVE"))
+        player_sessions = json.loads(MOCK_PLAYER_SESSIONS % dict(player_id=self.player_id, status="ACTIVE"))
+        with patch.object(flexmatch, "describe_game_sessions", return_value=game_sessions) as describe_game_sessions, \
+                patch.object(flexmatch, "describe_player_sessions", return_value=player_sessions):
+            response = self.put(f"{self.endpoints['sandbox']}/{location_id}",
+                                expected_status_code=http_client.CREATED).json()
+        self.assertEqual(response["placement_id"], "string")
+        self.assertEqual(describe_game_sessions.call_args.kwargs["GameSessionId"], event["detail"]["gameSessionArn"])
+
     def test_failed_placement_posts_message_and_nukes_cache(self):
         username = self.make_player()
         location_id = self.location_id()
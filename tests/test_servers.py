@@ -3,8 +3,13 @@ import datetime
 import http.client as http_client
 from unittest.mock import patch
 
+from flask import g
+
 from driftbase.api.servers import ServersPostResponseSchema, ServerPutResponseSchema, ServerHeartbeatPutResponseSchema
+from driftbase.heartbeats import flush_server_heartbeats
 from driftbase.systesthelper import DriftBaseTestCase
+from driftbase.utils import background
+from driftbase.utils.test_utils import BaseCloudkitTest
 
 
 class ServersTest(DriftBaseTestCase):
@@ -257,3 +262,39 @@ class ServersTest(DriftBaseTestCase):
         self.assertEqual("completed", resp.json()["status"])
         self.assertIsNotNone(resp.json()["status_date"])
         self.assertEqual(details, resp.json()["details"])
+
+
+class ServerRedisHeartbeatsTest(BaseCloudkitTest):
+    def test_server_redis_heartbeat(self):
+        self.auth_service()
+        machine_id = self._create_machine()["machine_id"]
+        url = self._create_server(machine_id)["url"]
+        heartbeat_url = self.get(url).json()["heartbeat_url"]
+        with patch("driftbase.heartbeats.redis_heartbeats_enabled", return_value=True), \
+                patch("driftbase.api.servers.redis_heartbeats_enabled", return_value=True), \
+                patch("driftbase.heartbeats.flush_server_heartbeats"):
+            for _ in range(2):
+                resp = self.put(heartbeat_url).json()
+                self.assertDictEqual(ServerHeartbeatPutResponseSchema().validate(resp), {})
+
+        # Nothing is written until the heartbeats are flushed
+        self.assertEqual(self.get(url).json()["heartbeat_count"], 0)
+
+        with self._request_context():
+            self.assertGreaterEqual(flush_server_heartbeats(), 1)
+
+        self.assertEqual(self.get(url).json()["heartbeat_count"], 2)
+
+    def test_server_redis_heartbeat_flushes_in_background(self):
+        self.auth_service()
+        machine_id = self._create_machine()["machine_id"]
+        url = self._create_server(machine_id)["url"]
+        heartbeat_url = self.get(url).json()["heartbeat_url"]
+        with self._request_context():
+            g.redis.conn.delete(g.redis.make_key("servers:heartbeats:flushed"))
+            flush_task_key = g.redis.make_key("servers:heartbeats:flush")
+        with patch("driftbase.heartbeats.redis_heartbeats_enabled", return_value=True), \
+                patch("driftbase.api.servers.redis_heartbeats_enabled", return_value=True):
+            self.put(heartbeat_url)
+        background._tasks[flush_task_key].join(timeout=5)
+        self.assertEqual(self.get(url).json()["heartbeat_count"], 1)